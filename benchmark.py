@@ -0,0 +1,648 @@
+"""
+Benchmarks for MyOwnMocker, run them with `./manage.py bench`.
+
+Each scenario seeds its own data in the database given (a temporary
+SQLite file by default) and prints latency percentiles in milliseconds.
+The cold, warm and mixed scenarios seed N tokens x M paths x K headers
+(`--seed`) and measure register, setup and use_api both in-process and
+over HTTP against a local gunicorn. Every result can be saved as JSON
+(`--output`) and compared with an earlier run (`--compare`).
+"""
+
+import contextlib
+import datetime
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+
+SEED = (10, 100, 5)
+results = []
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    samples = sorted(samples)
+    return dict(
+        ('p%d' % p, samples[min(len(samples) - 1, int(len(samples) * p / 100.0))] * 1000)
+        for p in points
+    )
+
+
+def timed(func, times):
+    samples = []
+    for _ in xrange(times):
+        start = time.time()
+        func()
+        samples.append(time.time() - start)
+    return samples
+
+
+def report(name, samples):
+    p = percentiles(samples)
+    print '%-30s p50 %8.3fms    p99 %8.3fms' % (name, p['p50'], p['p99'])
+    results.append(dict(p, name=name, count=len(samples), throughput=len(samples) / sum(samples)))
+
+
+def report_load(name, stats):
+    """Print and record the result of `load`"""
+    if not stats['count']:
+        print '%-30s all %d requests failed' % (name, stats['errors'])
+    else:
+        print '%-30s %8.1f req/s    p50 %8.3fms    p99 %8.3fms    %d errors' % (
+            name, stats['throughput'], stats['p50'], stats['p99'], stats['errors'],
+        )
+    results.append(dict(stats, name=name))
+
+
+def seed_token(mom, token, paths=100, headers=5):
+    """Create `token` with `paths` paths, each with `headers` custom headers"""
+    mom.db.session.add(mom.MockToken(token))
+    for i in xrange(paths):
+        pt = mom.MockPath(token, 'path/%d/' % i)
+        pt.status_code = 200
+        pt.content_type = 'application/json'
+        pt.body = json.dumps({'id': i})
+        pt.set_custom_headers(dict(('X-Header-%d' % h, str(h)) for h in xrange(headers)))
+        mom.db.session.add(pt)
+    mom.db.session.commit()
+
+
+def seed_tokens(mom, prefix, tokens, paths, headers):
+    """
+    Create `tokens` tokens named after `prefix`, each with `paths` paths of
+    `headers` custom headers, through the configured storage. Returns the tokens.
+    """
+    names = ['%s%0*d' % (prefix, 16 - len(prefix), i) for i in xrange(tokens)]
+    mom.storage.add_tokens(names)
+    for token in names:
+        mom.save_paths(token, (mom.path_fields(dict(
+            path='path/%d/' % i,
+            status_code=200,
+            content_type='application/json',
+            body=json.dumps({'id': i}),
+            custom_headers=dict(('X-Header-%d' % h, str(h)) for h in xrange(headers)),
+        )) for i in xrange(paths)))
+    mom.storage.commit()
+    return names
+
+
+def unmigrate_headers(mom, token):
+    """Turn the paths of `token` back into the `mock_header` row layout"""
+    for pt in mom.db.session.query(mom.MockPath).filter_by(token_id=token):
+        for name, value in pt.custom_headers().iteritems():
+            mom.db.session.add(mom.MockHeader(pt.id, name, value))
+        pt.headers_json = None
+    mom.db.session.commit()
+
+
+def bench_lookup(mom, client, requests):
+    """use_api without the response cache, headers as rows versus headers_json"""
+    seed_token(mom, 'benchjsonheader0')
+    seed_token(mom, 'benchrowheaders0')
+    unmigrate_headers(mom, 'benchrowheaders0')
+
+    cache_size = mom.response_cache.max_size
+    mom.response_cache.max_size = 0
+    try:
+        for label, token in (('use_api (mock_header rows)', 'benchrowheaders0'),
+                             ('use_api (headers_json)', 'benchjsonheader0')):
+            counter = [0]
+
+            def hit():
+                counter[0] += 1
+                client.get('/mock/%s/path/%d/' % (token, counter[0] % 100))
+
+            report(label, timed(hit, requests))
+    finally:
+        mom.response_cache.max_size = cache_size
+
+
+def bench_setup(mom, client, requests):
+    """setup one path per call versus bulk setup of the same paths"""
+    paths = min(requests, 300)
+    definitions = [
+        dict(path='path/%d/' % i, status_code=200, content_type='application/json', body=json.dumps({'id': i}),
+             custom_headers=dict(('X-Header-%d' % h, str(h)) for h in xrange(5)))
+        for i in xrange(paths)
+    ]
+    for token in ('benchsinglesetup', 'benchbulksetup00'):
+        mom.db.session.add(mom.MockToken(token))
+    mom.db.session.commit()
+
+    def single():
+        for definition in definitions:
+            client.post('/setup/benchsinglesetup/', content_type='application/json', data=json.dumps(definition))
+
+    def bulk():
+        client.post('/setup/benchbulksetup00/bulk/', content_type='application/json', data=json.dumps(definitions))
+
+    for label, func in (('%d x setup' % paths, single), ('bulk setup of %d' % paths, bulk)):
+        report(label, timed(func, 5))
+
+
+def bench_patterns(mom, client, requests):
+    """use_api without the response cache on a token with 10k pattern paths"""
+    patterns = 10000
+    token = 'benchpatterns000'
+    mom.db.session.add(mom.MockToken(token))
+    mom.db.session.commit()
+    mom.save_paths(token, (
+        mom.path_fields(dict(path='resource%d/{id}/details/' % i, status_code=200, content_type='text/plain'))
+        for i in xrange(patterns)
+    ))
+    mom.save_paths(token, [mom.path_fields(dict(path='exact/', status_code=200, content_type='text/plain'))])
+    mom.db.session.commit()
+
+    start = time.time()
+    index = mom.PatternIndex(path for (path,) in mom.db.session.query(mom.MockPath.path).filter_by(
+        token_id=token, is_pattern=True))
+    print '%-30s %8.3fms' % ('index build (%d patterns)' % patterns, (time.time() - start) * 1000)
+    counter = [0]
+
+    def match():
+        counter[0] += 1
+        index.match('resource%d/%d/details/' % (counter[0] % patterns, counter[0]))
+
+    report('PatternIndex.match', timed(match, requests))
+
+    cache_size = mom.response_cache.max_size
+    mom.response_cache.max_size = 0
+    try:
+        report('use_api (exact)', timed(lambda: client.get('/mock/%s/exact/' % token), requests))
+
+        def hit():
+            counter[0] += 1
+            client.get('/mock/%s/resource%d/%d/details/' % (token, counter[0] % patterns, counter[0]))
+
+        report('use_api (pattern)', timed(hit, requests))
+    finally:
+        mom.response_cache.max_size = cache_size
+
+
+def bench_variants(mom, client, requests):
+    """use_api from the response cache, a single response versus 50 variants"""
+    token = 'benchvariants000'
+    mom.db.session.add(mom.MockToken(token))
+    mom.save_paths(token, [
+        mom.path_fields(dict(path='single/', status_code=200, content_type='text/plain', body='single')),
+        mom.path_fields(dict(path='variants/', status_code=200, content_type='text/plain', body='default', variants=[
+            dict(match=dict(method='GET', query=dict(page=i)), body='page %d' % i) for i in xrange(50)
+        ])),
+    ])
+    mom.db.session.commit()
+
+    report('use_api (single response)', timed(lambda: client.get('/mock/%s/single/' % token), requests))
+    report('use_api (last of 50 variants)', timed(lambda: client.get('/mock/%s/variants/?page=49' % token), requests))
+
+
+def bench_metrics(mom, client, requests):
+    """use_api from the response cache, with and without MOCK_METRICS"""
+    token = 'benchmetrics0000'
+    mom.db.session.add(mom.MockToken(token))
+    mom.save_paths(token, [mom.path_fields(dict(path='value/', status_code=200, content_type='text/plain', body='v'))])
+    mom.db.session.commit()
+
+    enabled = mom.app.config['MOCK_METRICS']
+    try:
+        for label, value in (('use_api (metrics off)', False), ('use_api (metrics on)', True)):
+            mom.app.config['MOCK_METRICS'] = value
+            report(label, timed(lambda: client.get('/mock/%s/value/' % token), requests))
+    finally:
+        mom.app.config['MOCK_METRICS'] = enabled
+
+
+def bench_templates(mom, client, requests):
+    """use_api from the response cache, a static body versus a template"""
+    token = 'benchtemplates00'
+    mom.storage.add_tokens([token])
+    mom.save_paths(token, [
+        mom.path_fields(dict(path='static/1', status_code=200, content_type='application/json',
+                             body='{"id": 1, "seq": 1, "q": "x"}')),
+        mom.path_fields(dict(path='template/{id}', status_code=200, content_type='application/json', template=True,
+                             body='{"id": {{ params.id }}, "seq": {{ counter() }}, "q": "{{ args.q }}"}')),
+    ])
+    mom.storage.commit()
+
+    report('use_api (static)', timed(lambda: client.get('/mock/%s/static/1?q=x' % token), requests))
+    report('use_api (template)', timed(lambda: client.get('/mock/%s/template/1?q=x' % token), requests))
+
+
+def bench_compression(mom, client, requests):
+    """use_api from the response cache, identity versus gzip and br: bytes sent and the first (compressing) request"""
+    token = 'benchcompression'
+    mom.storage.add_tokens([token])
+    items = [dict(id=i, name='item %d' % i, tags=['a', 'b'], active=i % 2 == 0) for i in xrange(1000)]
+    bodies = (('4k', json.dumps(items[:60])), ('64k', json.dumps(items)))
+    mom.save_paths(token, [
+        mom.path_fields(dict(path=label, status_code=200, content_type='application/json', body=body))
+        for label, body in bodies
+    ])
+    mom.storage.commit()
+
+    for label, body in bodies:
+        for encoding in ('identity', 'gzip', 'br') if mom.brotli is not None else ('identity', 'gzip'):
+            url = '/mock/%s/%s' % (token, label)
+            headers = {'Accept-Encoding': encoding}
+            start = time.time()
+            size = len(client.get(url, headers=headers).data)
+            first = (time.time() - start) * 1000
+            name = 'use_api (%s, %s)' % (label, encoding)
+            report(name, timed(lambda: client.get(url, headers=headers), requests))
+            print '%-30s %8d bytes, %3.0f%% saved, first request %.3fms' % (
+                '', size, 100 - 100.0 * size / len(body), first,
+            )
+            results[-1].update(bytes=size, first_ms=first)
+
+
+def bench_storage(mom, client, requests):
+    """register, setup and use_api without the response cache, sqlalchemy versus memory storage"""
+    sql_storage = mom.storage
+    cache_size = mom.response_cache.max_size
+    mom.response_cache.max_size = 0
+    try:
+        for label, storage in (('sqlalchemy', sql_storage), ('memory', mom.MemoryStorage())):
+            mom.storage = storage
+            token = json.loads(client.get('/register/').data)['token']
+            counter = [0]
+
+            def setup():
+                counter[0] += 1
+                client.post('/setup/%s/' % token, data=json.dumps(dict(
+                    path='path/%d/' % (counter[0] % 100), status_code=200, content_type='text/plain', body='b',
+                )), content_type='application/json')
+
+            def hit():
+                counter[0] += 1
+                client.get('/mock/%s/path/%d/' % (token, counter[0] % 100))
+
+            report('register (%s)' % label, timed(lambda: client.get('/register/'), min(requests, 500)))
+            report('setup (%s)' % label, timed(setup, min(requests, 500)))
+            report('use_api (%s)' % label, timed(hit, requests))
+    finally:
+        mom.storage = sql_storage
+        mom.response_cache.max_size = cache_size
+
+
+def endpoint_targets(tokens, paths, count, writes=0.0, rng=None):
+    """
+    `count` requests as (method, path, body): use_api reads of random seeded
+    paths and, a `writes` fraction of the time, setup of one of them
+    """
+    rng = rng or random.Random(0)
+    targets = []
+    for _ in xrange(count):
+        token = rng.choice(tokens)
+        path = 'path/%d/' % rng.randrange(paths)
+        if rng.random() < writes:
+            targets.append(('POST', '/setup/%s/' % token, json.dumps(dict(
+                path=path, status_code=200, content_type='application/json', body=json.dumps({'v': rng.random()}),
+            ))))
+        else:
+            targets.append(('GET', '/mock/%s/%s' % (token, path), None))
+    return targets
+
+
+def replay(client, targets):
+    """Samples of sending each of `targets` through the Flask test client"""
+    samples = []
+    for method, path, body in targets:
+        start = time.time()
+        if body is None:
+            client.open(path, method=method)
+        else:
+            client.open(path, method=method, data=body, content_type='application/json')
+        samples.append(time.time() - start)
+    return samples
+
+
+def endpoints(mom, client, requests, prefix, cache_size, writes=0.0, warm=False, concurrency=50):
+    """
+    register, setup and use_api on seeded tokens, in-process and over HTTP,
+    with the response cache at `cache_size` and use_api mixed with a
+    `writes` fraction of setups
+    """
+    tokens, paths, headers = SEED
+    names = seed_tokens(mom, prefix, tokens, paths, headers)
+    reads = endpoint_targets(names, paths, requests, writes)
+    setups = endpoint_targets(names, paths, min(requests, 500), 1.0, random.Random(1))
+    use_api = 'use_api' if not writes else 'use_api + %d%% setup' % (writes * 100)
+
+    original_size = mom.response_cache.max_size
+    mom.response_cache.max_size = cache_size
+    try:
+        mom.response_cache.clear()
+        if warm:
+            replay(client, endpoint_targets(names, paths, tokens * paths * 3, rng=random.Random(2)))
+        report('%s (in-process)' % use_api, replay(client, reads))
+        report('register (in-process)', timed(lambda: client.get('/register/'), min(requests, 500)))
+        report('setup (in-process)', replay(client, setups))
+    finally:
+        mom.response_cache.max_size = original_size
+
+    try:
+        import gevent
+        import gunicorn
+    except ImportError:
+        print 'skipped over HTTP, requires gevent and gunicorn'
+        return
+    with http_server(mom, dict(MOCK_CACHE_SIZE=str(cache_size))) as base_url:
+        if warm:
+            run_load(base_url, endpoint_targets(names, paths, tokens * paths * 3, rng=random.Random(2)), concurrency)
+        report_load('%s (http)' % use_api, run_load(base_url, reads, concurrency))
+        report_load('register (http)', run_load(base_url, [('GET', '/register/', None)] * min(requests, 500), concurrency))
+        report_load('setup (http)', run_load(base_url, setups, concurrency))
+
+
+def bench_cold(mom, client, requests):
+    """register, setup and use_api on seeded tokens, without the response cache"""
+    endpoints(mom, client, requests, 'cold', 0)
+
+
+def bench_warm(mom, client, requests):
+    """register, setup and use_api on seeded tokens, every path in the response cache"""
+    tokens, paths, _ = SEED
+    endpoints(mom, client, requests, 'warm', max(tokens * paths, mom.app.config['MOCK_CACHE_SIZE']), warm=True)
+
+
+def bench_mixed(mom, client, requests):
+    """use_api reads mixed with 10% setup writes on seeded tokens, with the response cache"""
+    tokens, paths, _ = SEED
+    endpoints(mom, client, requests, 'mixd', max(tokens * paths, mom.app.config['MOCK_CACHE_SIZE']), writes=0.1)
+
+
+@contextlib.contextmanager
+def http_server(mom, env=None, workers=4):
+    """Run MOM under gunicorn with `workers` sync workers on the benchmark database, yielding its base URL"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, DATABASE_URL=str(mom.db.engine.url), **(env or {}))
+    port = free_port()
+    with open(os.devnull, 'w') as devnull:
+        server = subprocess.Popen([
+            sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()',
+            '-w', str(workers), '-b', '127.0.0.1:%d' % port, 'myownmocker:app',
+        ], cwd=here, env=env, stdout=devnull, stderr=devnull)
+        try:
+            wait_for_port(port)
+            yield 'http://127.0.0.1:%d' % port
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def bench_servers(mom, client, requests, concurrency=1000):
+    """use_api over HTTP at 1000 concurrent connections, gunicorn sync workers versus manage.py serve"""
+    try:
+        import gevent
+        import gunicorn
+    except ImportError:
+        print 'skipped, requires gevent and gunicorn'
+        return
+    token = 'benchservers0000'
+    mom.db.session.add(mom.MockToken(token))
+    mom.save_paths(token, [mom.path_fields(dict(path='path/', status_code=200, content_type='text/plain', body='ok'))])
+    mom.db.session.commit()
+
+    targets = [('GET', '/mock/%s/path/' % token, None)] * max(requests, 5 * concurrency)
+    with http_server(mom) as base_url:
+        report_load('gunicorn (4 sync workers)', run_load(base_url, targets, concurrency))
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, DATABASE_URL=str(mom.db.engine.url))
+    port = free_port()
+    bind = '127.0.0.1:%d' % port
+    with open(os.devnull, 'w') as devnull:
+        server = subprocess.Popen([sys.executable, 'manage.py', 'serve', '-b', bind], cwd=here, env=env,
+                                  stdout=devnull, stderr=devnull)
+        try:
+            wait_for_port(port)
+            report_load('manage.py serve (gevent)', run_load('http://%s' % bind, targets, concurrency))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def bench_startup(mom, client, requests, runs=5):
+    """Cold start: importing myownmocker, and launching gunicorn (4 sync workers) until it serves a first mock"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    samples = []
+    for _ in xrange(runs):
+        output = subprocess.check_output([
+            sys.executable, '-c', 'import time; start = time.time(); import myownmocker; print time.time() - start',
+        ], cwd=here)
+        samples.append(float(output))
+    report('import myownmocker', samples)
+
+    try:
+        import gunicorn
+    except ImportError:
+        print 'skipped gunicorn, requires gunicorn'
+        return
+    import urllib2
+    token = 'benchstartup0000'
+    mom.storage.add_tokens([token])
+    mom.save_paths(token, [mom.path_fields(dict(path='path/', status_code=200, content_type='text/plain', body='ok'))])
+    mom.storage.commit()
+    env = dict(os.environ, DATABASE_URL=str(mom.db.engine.url), GUNICORN_WORKER_CLASS='sync')
+    for label, options in (('gunicorn', []), ('gunicorn, preloaded', ['-c', 'gunicorn_config.py'])):
+        samples = []
+        for _ in xrange(runs):
+            port = free_port()
+            url = 'http://127.0.0.1:%d/mock/%s/path/' % (port, token)
+            with open(os.devnull, 'w') as devnull:
+                start = time.time()
+                server = subprocess.Popen([
+                    sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()',
+                    '-w', '4', '-b', '127.0.0.1:%d' % port,
+                ] + options + ['myownmocker:app'], cwd=here, env=env, stdout=devnull, stderr=devnull)
+                try:
+                    while True:
+                        try:
+                            urllib2.urlopen(url, timeout=5).read()
+                            break
+                        except (urllib2.URLError, socket.error):
+                            if time.time() - start > 30:
+                                raise
+                            time.sleep(0.005)
+                    samples.append(time.time() - start)
+                finally:
+                    server.terminate()
+                    server.wait()
+        report('first mock (%s)' % label, samples)
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def wait_for_port(port, timeout=30):
+    limit = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            if time.time() > limit:
+                raise
+            time.sleep(0.1)
+
+
+def run_load(base_url, targets, concurrency):
+    """`load` in a separate, gevent patched, process"""
+    with tempfile.NamedTemporaryFile(suffix='.json') as f:
+        json.dump(targets, f)
+        f.flush()
+        output = subprocess.check_output([
+            sys.executable, os.path.abspath(__file__).replace('.pyc', '.py'), 'load', base_url, f.name, str(concurrency),
+        ])
+    return json.loads(output)
+
+
+def load(base_url, targets, concurrency):
+    """
+    Send `targets`, (method, path, body) tuples, to `base_url` over
+    `concurrency` connections at once, from a gevent patched process.
+    Returns the throughput and latency.
+    """
+    import gevent.pool
+    import urllib2
+    samples = []
+    errors = [0]
+    pending = iter(targets)
+
+    def client():
+        for method, path, body in pending:
+            req = urllib2.Request(base_url + path, data=body, headers={'Content-Type': 'application/json'})
+            req.get_method = lambda: method
+            start = time.time()
+            try:
+                urllib2.urlopen(req, timeout=60).read()
+            except urllib2.HTTPError as e:
+                # mock paths may well answer errors on purpose
+                e.read()
+                samples.append(time.time() - start)
+            except Exception:
+                errors[0] += 1
+            else:
+                samples.append(time.time() - start)
+
+    pool = gevent.pool.Pool(concurrency)
+    start = time.time()
+    for _ in xrange(concurrency):
+        pool.spawn(client)
+    pool.join()
+    elapsed = time.time() - start
+    stats = dict(count=len(samples), errors=errors[0], throughput=len(samples) / elapsed)
+    if samples:
+        stats.update(percentiles(samples))
+    return stats
+
+
+SCENARIOS = (
+    bench_cold,
+    bench_warm,
+    bench_mixed,
+    bench_lookup,
+    bench_setup,
+    bench_patterns,
+    bench_variants,
+    bench_metrics,
+    bench_templates,
+    bench_compression,
+    bench_storage,
+    bench_servers,
+    bench_startup,
+)
+
+
+def run(mom, database=None, requests=2000, scenarios=None, seed=None, output=None, compare=None):
+    global SEED
+    if seed is not None:
+        SEED = tuple(int(n) for n in seed.split('x'))
+    tmpdir = None
+    if database is None:
+        tmpdir = tempfile.mkdtemp()
+        database = 'sqlite:///%s' % os.path.join(tmpdir, 'bench.db')
+    mom.app.config['SQLALCHEMY_DATABASE_URI'] = database
+    # benchmarks send far more requests than any rate limit allows, also those of the servers they start
+    os.environ.update(MOCK_RATE_REGISTER='none', MOCK_RATE_SETUP='none', MOCK_RATE_MOCK='none')
+    mom.load_environ(mom.app.config)
+    print 'Using database %s' % mom.db.engine.url
+    mom.db.drop_all()
+    mom.db.create_all()
+    del results[:]
+    try:
+        client = mom.app.test_client()
+        for scenario in SCENARIOS:
+            name = scenario.__name__[len('bench_'):]
+            if scenarios is not None and name not in scenarios:
+                continue
+            print '## %s' % scenario.__doc__
+            start = len(results)
+            scenario(mom, client, requests)
+            for result in results[start:]:
+                result['scenario'] = name
+    finally:
+        mom.db.session.remove()
+        mom.db.drop_all()
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+    run_info = dict(
+        commit=git_commit(),
+        date=datetime.datetime.utcnow().isoformat(),
+        python=sys.version.split()[0],
+        database=database if tmpdir is None else 'sqlite (temporary file)',
+        storage=mom.app.config['MOCK_STORAGE'],
+        requests=requests,
+        seed='x'.join(str(n) for n in SEED),
+        results=results,
+    )
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(run_info, f, indent=2, sort_keys=True)
+        print 'Saved results to %s' % output
+    if compare is not None:
+        with open(compare) as f:
+            compare_results(json.load(f), run_info)
+    return run_info
+
+
+def git_commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=devnull,
+            ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(old, new):
+    """Print how the p50 and p99 of each result in `new` changed from `old`"""
+    print '## compared with %s (%s)' % ((old['commit'] or 'unknown')[:10], old['date'])
+    previous = dict(((r.get('scenario'), r['name']), r) for r in old['results'])
+    for result in new['results']:
+        before = previous.get((result.get('scenario'), result['name']))
+        if before is None or 'p50' not in before or 'p50' not in result:
+            continue
+        print '%-10s %-30s p50 %+7.1f%%    p99 %+7.1f%%' % (
+            result.get('scenario'), result['name'],
+            (result['p50'] / before['p50'] - 1) * 100, (result['p99'] / before['p99'] - 1) * 100,
+        )
+
+
+if __name__ == '__main__' and sys.argv[1:2] == ['load']:
+    from gevent import monkey
+    monkey.patch_all()
+    with open(sys.argv[3]) as f:
+        print json.dumps(load(sys.argv[2], [tuple(target) for target in json.load(f)], int(sys.argv[4])))
@@ -0,0 +1,68 @@
+"""
+gunicorn settings for MOM, used by the Procfile:
+
+    MOCK_TRUSTED_PROXIES=1 gunicorn -c gunicorn_config.py myownmocker:app
+
+The app is imported and warmed up once, in the master (`preload_app`),
+then every worker starts as a fork of it instead of importing on its
+own. Database connections are opened by each worker after the fork.
+The master exits instead if the database still needs `./manage.py migrate`,
+or if several workers would each keep their own memory storage.
+Unless `MOCK_METRICS_DIR` is set, the workers share their metrics in a
+temporary directory of the master, so any of them reports the totals.
+"""
+
+import os
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+preload_app = True
+
+if worker_class == 'gevent':
+    # the preloaded app creates its locks already patched, like the workers
+    from gevent import monkey
+    monkey.patch_all()
+
+
+def when_ready(server):
+    import myownmocker
+    try:
+        with myownmocker.app.app_context():
+            missing = myownmocker.missing_columns()
+    except Exception:
+        server.log.exception('Failed to check the database')
+        missing = []
+    if missing:
+        server.log.error('Run ./manage.py migrate first, the database lacks %s', ', '.join(missing))
+        server.halt(exit_status=1)
+    config = myownmocker.app.config
+    if config['MOCK_STORAGE'] == 'memory' and config['MOCK_STORAGE_DIR'] is None and server.num_workers > 1:
+        server.log.error('Set MOCK_STORAGE_DIR, or run a single worker: each worker would have its own tokens')
+        server.halt(exit_status=1)
+    try:
+        with myownmocker.app.app_context():
+            server.log.info('Warmed up %d paths', myownmocker.warm_up())
+    except Exception:
+        server.log.exception('Failed to warm up')
+    # nothing for the workers to inherit
+    myownmocker.db.engine.dispose()
+    if config['MOCK_METRICS_DIR'] is None:
+        import tempfile
+        config['MOCK_METRICS_DIR'] = tempfile.mkdtemp(prefix='myownmocker-metrics-')
+        server.metrics_dir = config['MOCK_METRICS_DIR']
+        myownmocker.metrics = myownmocker.make_metrics(config)
+
+
+def post_fork(server, worker):
+    import myownmocker
+    myownmocker.post_fork()
+
+
+def worker_exit(server, worker):
+    import myownmocker
+    myownmocker.worker_exit()
+
+
+def on_exit(server):
+    if getattr(server, 'metrics_dir', None) is not None:
+        import shutil
+        shutil.rmtree(server.metrics_dir, ignore_errors=True)
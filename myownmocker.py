@@ -7,13 +7,47 @@ This code is running live in https://mom.skmobi.com/ so whenever you need, just
 """
 
 __version__ = '1.1'
+import base64
+import binascii
+import bisect
+import datetime
+import errno
+import hashlib
+import httplib
+import json
+import math
 import random
+import re
+import socket
 import string
 import os
-from flask import Flask, jsonify, request, abort, Response, redirect
+import struct
+import sys
+import threading
+import time
+import urlparse
+import uuid
+import zlib
+from collections import OrderedDict
+from flask import Flask, jsonify, request, abort, Response, redirect, stream_with_context, g, _app_ctx_stack
 from flask.ext.sqlalchemy import SQLAlchemy
+from jinja2 import TemplateError, evalcontextfilter, nodes
+from jinja2.compiler import CodeGenerator
+from jinja2.sandbox import SandboxedEnvironment, SecurityError
+from sqlalchemy import bindparam, event, orm
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DisconnectionError, IntegrityError
+from sqlalchemy.ext import baked
+from sqlalchemy.pool import Pool, QueuePool
 from werkzeug.exceptions import default_exceptions
-from werkzeug.exceptions import HTTPException
+from werkzeug.wsgi import wrap_file
+from werkzeug.http import http_date, parse_accept_header, parse_date, parse_etags, quote_etag
+from werkzeug.exceptions import HTTPException, InternalServerError, TooManyRequests
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 
 def make_json_app(import_name, **kwargs):
@@ -30,6 +64,8 @@ def make_json_app(import_name, **kwargs):
         if isinstance(ex, HTTPException):
             response = jsonify(message=ex.description)
             response.status_code = ex.code
+            if getattr(ex, 'retry_after', None) is not None:
+                response.headers['Retry-After'] = str(int(math.ceil(ex.retry_after)))
         else:
             response = jsonify(message=str(ex))
             response.status_code = 500
@@ -47,227 +83,4106 @@ app = make_json_app(__name__)
 app.config.update(dict(
     SQLALCHEMY_DATABASE_URI='sqlite:///dev.db',
     SQLALCHEMY_TRACK_MODIFICATIONS=False,
+    SQLALCHEMY_BINDS=None,
+    MOCK_POOL_PRE_PING=False,
+    MOCK_REPLICA_CACHE_TTL=10.0,
+    MOCK_CACHE_SIZE=1024,
+    MOCK_CACHE_CHANNEL='file',
+    MOCK_CACHE_CHANNEL_FILE=None,
+    MOCK_CACHE_MAX_STALE=1.0,
+    MOCK_PATTERN_CACHE_SIZE=256,
+    MOCK_BODY_STORE=None,
+    MOCK_INLINE_BODY_SIZE=500,
+    MOCK_RECORD_REQUESTS=False,
+    MOCK_RECORD_LIMIT=100,
+    MOCK_METRICS=True,
+    MOCK_METRICS_DIR=None,
+    MOCK_REGISTER_MAX_COUNT=100,
+    MOCK_EXPIRE_DAYS=2,
+    MOCK_EXPIRE_ON_LAST_USE=False,
+    MOCK_PURGE_INTERVAL=None,
+    MOCK_PURGE_LOCK_FILE=None,
+    MOCK_PURGE_BATCH_SIZE=500,
+    MOCK_STORAGE='sqlalchemy',
+    MOCK_STORAGE_DIR=None,
+    MOCK_TEMPLATE_TIMEOUT=0.1,
+    MOCK_TEMPLATE_MAX_OUTPUT=65536,
+    MOCK_TEMPLATE_MAX_RANGE=1000,
+    MOCK_TEMPLATE_CACHE_SIZE=256,
+    MOCK_COUNTERS='file',
+    MOCK_COUNTERS_FILE=None,
+    MOCK_COUNTERS_PER_TOKEN=1000,
+    MOCK_PROXY=False,
+    MOCK_PROXY_PRIVATE=False,
+    MOCK_PROXY_TIMEOUT=10,
+    MOCK_PROXY_POOL_SIZE=10,
+    MOCK_COMPRESS_MIN_SIZE=1024,
+    MOCK_GZIP_LEVEL=9,
+    MOCK_BROTLI_QUALITY=9,
+    MOCK_RATE_LIMIT_FILE=None,
+    MOCK_RATE_REGISTER=(100, 3600),
+    MOCK_RATE_SETUP=None,
+    MOCK_RATE_MOCK=None,
+    MOCK_MAX_PATHS=None,
+    MOCK_TRUSTED_PROXIES=0,
+    MOCK_MAX_DELAY=30.0,
+    MOCK_MIN_BANDWIDTH=100.0,
 ))
 
-if 'DATABASE_URL' in os.environ:
-    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
 
-db = SQLAlchemy(app)
 
+def load_environ(config, environ=os.environ):
+    """Override `config` with the settings given as environment variables"""
+    if 'DATABASE_URL' in environ:
+        config['SQLALCHEMY_DATABASE_URI'] = environ['DATABASE_URL']
+    if 'REPLICA_DATABASE_URL' in environ:
+        config['SQLALCHEMY_BINDS'] = dict(config['SQLALCHEMY_BINDS'] or {}, replica=environ['REPLICA_DATABASE_URL'])
 
-@app.route('/')
-def index():
-    return redirect('http://fopina.github.io/myownmocker/')
+    # pool settings, handed to every engine by Flask-SQLAlchemy
+    for name in (
+        'SQLALCHEMY_POOL_SIZE', 'SQLALCHEMY_MAX_OVERFLOW', 'SQLALCHEMY_POOL_TIMEOUT', 'SQLALCHEMY_POOL_RECYCLE',
+    ):
+        if name in environ:
+            config[name] = int(environ[name])
+    for name in ('MOCK_POOL_PRE_PING', 'MOCK_PROXY', 'MOCK_PROXY_PRIVATE', 'MOCK_EXPIRE_ON_LAST_USE'):
+        if name in environ:
+            config[name] = environ[name].lower() in ('1', 'true', 'yes')
 
+    for name in (
+        'MOCK_METRICS_DIR', 'MOCK_STORAGE', 'MOCK_STORAGE_DIR', 'MOCK_COUNTERS', 'MOCK_COUNTERS_FILE',
+        'MOCK_PURGE_LOCK_FILE', 'MOCK_BODY_STORE',
+    ):
+        if name in environ:
+            config[name] = environ[name]
 
-@app.route('/register/', methods=['GET'])
-def register():
+    for name in ('MOCK_CACHE_SIZE', 'MOCK_MAX_PATHS', 'MOCK_TRUSTED_PROXIES', 'MOCK_COUNTERS_PER_TOKEN'):
+        if name in environ:
+            config[name] = int(environ[name])
+
+    # limits as requests/seconds, such as 100/3600, or none
+    for name in ('MOCK_RATE_REGISTER', 'MOCK_RATE_SETUP', 'MOCK_RATE_MOCK'):
+        if name in environ:
+            value = environ[name]
+            config[name] = None if value.lower() == 'none' else tuple(int(n) for n in value.split('/'))
+
+    for name in ('MOCK_PURGE_INTERVAL', 'MOCK_MAX_DELAY', 'MOCK_MIN_BANDWIDTH'):
+        if name in environ:
+            config[name] = float(environ[name])
+
+load_environ(app.config)
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """
+    `SQLAlchemy` that also pools connections to SQLite files when given
+    `SQLALCHEMY_POOL_SIZE`, and pings them before use with `MOCK_POOL_PRE_PING`
     """
-    #### Register
-    Register for a mock token.
 
-    This is the first call you need to make to generate a mock API token to create mock API paths later
+    def apply_driver_hacks(self, app, info, options):
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        # a connection the database (or a firewall) dropped while idle in
+        # the pool is replaced instead of failing a request
+        options['pool_pre_ping'] = app.config['MOCK_POOL_PRE_PING']
+        # SQLAlchemy picks a NullPool for them, which takes no pool settings
+        if info.drivername == 'sqlite' and options.get('pool_size') and 'poolclass' not in options:
+            options['poolclass'] = QueuePool
 
-        GET /register/
 
-    ###### Example Response
+# the engines, and their connection pools, are only created on first use
+db = PooledSQLAlchemy(app)
 
-        < HTTP/1.1 200 OK
-        < Content-Type: application/json
+if 'gevent' in sys.modules:
+    from gevent import monkey
+    if monkey.is_module_patched('socket'):
+        # gevent workers: let other greenlets run while waiting on postgres
+        try:
+            from psycogreen.gevent import patch_psycopg
+            patch_psycopg()
+        except ImportError:
+            pass
 
-        {
-          "token": "MeB3aNo4yDXrtNH6",
-          "setup_url": "http://mom.skmobi.com/setup/MeB3aNo4yDXrtNH6/",
-          "setup_secure_url": "https://mom.skmobi.com/setup/MeB3aNo4yDXrtNH6/",
-          "mock_base_url": "http://mom.skmobi.com/mock/MeB3aNo4yDXrtNH6/",
-          "mock_base_secure_url": "https://mom.skmobi.com/mock/MeB3aNo4yDXrtNH6/"
-        }
+
+class MissingBody(InternalServerError):
+    """A body file that is gone, such as removed by hand, answered as a JSON 500"""
+
+    def __init__(self, digest):
+        InternalServerError.__init__(self, 'Body file %s is missing, set the path up again' % digest)
+
+
+class BodyStore(object):
+    """
+    Content-addressed files for bodies too large (or too binary) to be
+    stored in `mock_path`. Files are named after the SHA-256 of their
+    content, so identical bodies are stored once whatever the token.
     """
-    token = None
 
-    for t in xrange(5):
-        ttoken = ''.join(random.SystemRandom().choice(string.letters + string.digits) for _ in range(16))
-        if db.session.query(MockToken).filter_by(token=ttoken).first() is None:
-            token = ttoken
-            break
+    def __init__(self, directory):
+        self.directory = directory
 
-    if token is not None:
-        db.session.add(MockToken(token))
-        db.session.commit()
-        return jsonify(
-            token=token,
-            setup_url='%ssetup/%s/' % (request.url_root, token),
-            setup_secure_url='%ssetup/%s/' % (request.url_root.replace('http://', 'https://'), token),
-            mock_base_url='%smock/%s/' % (request.url_root, token),
-            mock_base_secure_url='%smock/%s/' % (request.url_root.replace('http://', 'https://'), token),
-        )
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def put(self, data):
+        """Store `data` unless already there and return its digest"""
+        digest = hashlib.sha256(data).hexdigest()
+        filename = self.path(digest)
+        try:
+            # used again, `purge` must not take it for an old unreferenced file
+            os.utime(filename, None)
+        except OSError:
+            import tempfile
+            if not os.path.isdir(os.path.dirname(filename)):
+                try:
+                    os.makedirs(os.path.dirname(filename))
+                except OSError:
+                    if not os.path.isdir(os.path.dirname(filename)):
+                        raise
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, filename)
+        return digest
+
+    def open(self, digest):
+        try:
+            return open(self.path(digest), 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise MissingBody(digest)
+            raise
+
+    def get(self, digest):
+        with self.open(digest) as f:
+            return f.read()
+
+    def size(self, digest):
+        try:
+            return os.path.getsize(self.path(digest))
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                raise MissingBody(digest)
+            raise
+
+    def encode(self, digest, encoding):
+        """
+        The name of the copy of a file compressed with `encoding`, written
+        next to it on first use
+        """
+        name = '%s.%s' % (digest, encoding)
+        filename = self.path(name)
+        if not os.path.exists(filename):
+            import tempfile
+            f = self.open(digest)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename))
+            with os.fdopen(fd, 'wb') as out, f:
+                for chunk in compress_chunks(iter(lambda: f.read(65536), b''), encoding):
+                    out.write(chunk)
+            os.rename(tmp, filename)
+        return name
+
+    def purge(self, referenced, min_age=3600):
+        """
+        Remove the files whose digest is not in `referenced`, unless
+        written less than `min_age` seconds ago (a setup may not have
+        committed its path yet). Returns the number of files removed.
+        """
+        removed = 0
+        if not os.path.isdir(self.directory):
+            return removed
+        limit = time.time() - min_age
+        for prefix in os.listdir(self.directory):
+            subdir = os.path.join(self.directory, prefix)
+            for digest in os.listdir(subdir):
+                filename = os.path.join(subdir, digest)
+                # compressed copies go with their file
+                if digest.split('.', 1)[0] not in referenced and os.path.getmtime(filename) < limit:
+                    os.remove(filename)
+                    removed += 1
+        return removed
+
+
+def make_body_store(config):
+    directory = config['MOCK_BODY_STORE']
+    if directory is None:
+        import tempfile
+        directory = os.path.join(tempfile.gettempdir(), 'myownmocker-bodies')
+    return BodyStore(directory)
+
+
+COMPRESSIBLE_RE = re.compile(
+    r'^(text/|application/(json|javascript|xml|x-ndjson)\b|application/[^;]*\+(json|xml)\b|image/svg\+xml\b)'
+)
+
+
+def compress_chunks(chunks, encoding):
+    """Compress the `chunks` of a body with `encoding`, `gzip` or `br`"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=app.config['MOCK_BROTLI_QUALITY'])
+        compress, finish = compressor.process, compressor.finish
     else:
-        abort(503, 'Unable to generate a token, please try again')
+        compressor = zlib.compressobj(app.config['MOCK_GZIP_LEVEL'], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compress, finish = compressor.compress, compressor.flush
+    for chunk in chunks:
+        yield compress(chunk)
+    yield finish()
 
 
-@app.route('/setup/<token>/', methods=['POST'])
-def setup(token):
+accepted_encodings = {}
+
+
+def accepted_encoding(environ):
+    """The encoding the client prefers among `br` (if available) and `gzip`, None for neither"""
+    header = environ.get('HTTP_ACCEPT_ENCODING')
+    if not header:
+        return None
+    try:
+        return accepted_encodings[header]
+    except KeyError:
+        pass
+    accept = parse_accept_header(header)
+    encoding = None
+    quality = 0
+    for name in ('br', 'gzip') if brotli is not None else ('gzip',):
+        if accept[name] > quality:
+            encoding, quality = name, accept[name]
+    # clients send few distinct values, parse each once
+    if len(accepted_encodings) >= 256:
+        accepted_encodings.clear()
+    accepted_encodings[header] = encoding
+    return encoding
+
+
+def response_etag(status_code, content_type, custom_headers, body, body_file):
+    """Strong validator of a response definition"""
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    digest = hashlib.sha256(json.dumps(
+        [status_code, content_type, sorted(custom_headers.items()), body_file],
+    ))
+    if body is not None:
+        digest.update(body)
+    return digest.hexdigest()[:32]
+
+
+class CompiledResponse(object):
     """
-    ### Setup
-    Setup a mock path.
+    A mock response ready to be served: status, content type,
+    merged headers and the encoded body, or the `body_store` digest
+    and size of the body when it is file-backed.
 
-    This is the call to setup (create or replace) mock API paths
+    200 responses carry an `ETag` (and a `Last-Modified` when known)
+    unless the mock defines its own, and conditional requests are
+    answered with a 304 before the body is even looked at.
 
-        POST /setup/:token/
-        Content-Type: application/json
+    Text bodies of at least `MOCK_COMPRESS_MIN_SIZE` bytes are served
+    compressed to the clients that accept it, each encoding compressed
+    on first use and kept, inline or in `body_store`, as another
+    `CompiledResponse` with its own `ETag`.
+    """
+    __slots__ = (
+        'status_code', 'content_type', 'headers', 'body', 'body_file', 'body_size', 'etag', 'last_modified',
+        'validators', 'compressible', '_encoded',
+    )
 
-    ###### Parameters
+    def __init__(self, status_code, content_type, headers, body, body_file=None, body_size=None, etag=None,
+                 last_modified=None, compressible=False):
+        self.status_code = status_code
+        self.content_type = content_type
+        self.body = body
+        self.body_file = body_file
+        self.body_size = body_size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.compressible = compressible
+        self._encoded = {}
+        if compressible:
+            headers = headers + [('Vary', 'Accept-Encoding')]
+        self.validators = []
+        if etag is not None:
+            self.validators.append(('ETag', quote_etag(etag)))
+        if last_modified is not None:
+            self.validators.append(('Last-Modified', http_date(last_modified)))
+        self.headers = headers + self.validators
 
-    | Name              | Type       | Description   |
-    | :---------------: |:----------:| :------------:|
-    | path              | string     | **Required**. The API method path (such as *login/* or *user/fopina/details/*) |
-    | status_code       | int        | **Required**. The HTTP response status code              |
-    | content_type      | string     | **Required**. The HTTP response content type             |
-    | custom_headers    | dictionary | Optional. Extra HTTP headers to include in the response  |
-    | body              | string     | Optional. The body of the response                       |
+    @classmethod
+    def build(cls, status_code, content_type, custom_headers, body, body_file=None, etag=None, last_modified=None):
+        defined = set(name.lower() for name in custom_headers)
+        if status_code != 200 or 'etag' in defined:
+            etag = None
+        elif etag is None:
+            etag = response_etag(status_code, content_type, custom_headers, body, body_file)
+        if status_code != 200 or 'last-modified' in defined:
+            last_modified = None
+        elif last_modified is not None:
+            last_modified = last_modified.replace(microsecond=0)
 
-    ###### Example Input
+        if body_file is not None:
+            body_size = body_store.size(body_file)
+        elif body is None:
+            body = b''
+        elif isinstance(body, unicode):
+            body = body.encode('utf-8')
+        if body_file is None:
+            body_size = len(body)
+        min_size = app.config['MOCK_COMPRESS_MIN_SIZE']
+        compressible = (
+            min_size is not None and body_size >= min_size and status_code not in (204, 304) and
+            'content-encoding' not in defined and COMPRESSIBLE_RE.match(content_type or '') is not None
+        )
+        return cls(status_code, content_type, custom_headers.items(), body, body_file, body_size, etag, last_modified,
+                   compressible)
 
-        {
-            "path": "login/",
-            "status_code": 400,
-            "content_type": "application/json",
-            "custom_headers": { "X-My-API-Version": "1" },
-            "body": "{\\\"code\\\": \\\"invalid_login\\\"}"
-        }
+    def encoded(self, encoding):
+        """This response compressed with `encoding`, None if that is not smaller"""
+        try:
+            return self._encoded[encoding]
+        except KeyError:
+            pass
+        headers = [header for header in self.headers if header not in self.validators]
+        headers.append(('Content-Encoding', encoding))
+        if self.body_file is not None:
+            body_file = body_store.encode(self.body_file, encoding)
+            body, body_size = None, body_store.size(body_file)
+        else:
+            body_file, body = None, b''.join(compress_chunks([self.body], encoding))
+            body_size = len(body)
+        encoded = None
+        if body_size < self.body_size:
+            encoded = CompiledResponse(
+                self.status_code, self.content_type, headers, body, body_file, body_size,
+                None if self.etag is None else '%s-%s' % (self.etag, encoding), self.last_modified,
+            )
+        self._encoded[encoding] = encoded
+        return encoded
 
-    ###### Example Response
+    def not_modified(self, environ):
+        if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            return False
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            return self.etag is not None and parse_etags(if_none_match).contains_weak(self.etag)
+        if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since is not None and self.last_modified is not None:
+            if_modified_since = parse_date(if_modified_since)
+            return if_modified_since is not None and self.last_modified <= if_modified_since
+        return False
 
-        < HTTP/1.1 200 OK
-        < Content-Type: application/json
+    def to_response(self):
+        if self.compressible:
+            encoding = accepted_encoding(request.environ)
+            if encoding is not None:
+                encoded = self.encoded(encoding)
+                if encoded is not None:
+                    return encoded.to_response()
+        if self.validators and self.not_modified(request.environ):
+            return Response(status=304, headers=self.validators)
+        if self.body_file is not None:
+            return self._file_response()
+        return Response(
+            self.body,
+            content_type=self.content_type,
+            status=self.status_code,
+            headers=self.headers,
+        )
 
-        {
-            "message": "ok",
-            "path_url": "http://mom.skmobi.com/mock/MeB3aNo4yDXrtNH6/login/",
-            "path_secure_url": "https://mom.skmobi.com/mock/MeB3aNo4yDXrtNH6/login/"
-        }
+    def _file_response(self):
+        # handed to the WSGI server as a file so it can use sendfile,
+        # ranges are answered by seeking in it
+        f = body_store.open(self.body_file)
+        resp = Response(
+            wrap_file(request.environ, f),
+            content_type=self.content_type,
+            status=self.status_code,
+            headers=self.headers,
+            direct_passthrough=True,
+        )
+        resp.content_length = self.body_size
+        if self.status_code != 200:
+            return resp
+        try:
+            return resp.make_conditional(request, accept_ranges=True, complete_length=self.body_size)
+        except Exception:
+            f.close()
+            raise
+
+
+class TemplateResponse(object):
+    """
+    A mock response whose body and header values are templates, rendered
+    for every request with `template_context`
     """
+    __slots__ = ('status_code', 'content_type', 'headers', 'body')
 
-    mt = db.session.query(MockToken).filter_by(token=token).first()
+    def __init__(self, status_code, content_type, headers, body):
+        self.status_code = status_code
+        self.content_type = content_type
+        self.headers = headers
+        self.body = body
 
-    if mt is None:
-        abort(404, 'Invalid token')
+    @classmethod
+    def build(cls, status_code, content_type, custom_headers, body, body_file=None, etag=None, last_modified=None):
+        # no validators, the body changes with every request
+        if body_file is not None:
+            body = body_store.get(body_file).decode('utf-8')
+        return cls(
+            status_code,
+            content_type,
+            [(name, compile_template(value)) for name, value in custom_headers.iteritems()],
+            compile_template(body or u''),
+        )
 
-    data = request.get_json()
-    try:
-        path = data['path']
-        if path[0] == '/':
-            path = path[1:]
-        pt = mt.paths.filter_by(path=path).first()
-        if pt is None:
-            pt = MockPath(mt.token, path)
-        pt.status_code = data['status_code']
-        pt.content_type = data['content_type']
-        pt.body = data.get('body')
-        db.session.add(pt)
-        custom_headers = data.get('custom_headers')
-        pt.headers.delete()
-        if type(custom_headers) == dict:
-            for h_name, h_value in custom_headers.iteritems():
-                header = MockHeader(pt.id, h_name, h_value)
-                db.session.add(header)
-        db.session.commit()
-    except KeyError as e:
-        abort(400, 'Missing required field: %s' % e.args[0])
-    return jsonify(
-        message='ok',
-        path_url='%smock/%s/%s' % (request.url_root, token, path),
-        path_secure_url='%smock/%s/%s' % (request.url_root.replace('http://', 'https://'), token, path),
-    )
+    def to_response(self):
+        context = template_context()
+        try:
+            body = templates.render(self.body, context)
+            headers = [(name, templates.render(template, context)) for name, template in self.headers]
+        except (TemplateError, TemplateLimitError, CounterLimitError) as e:
+            abort(500, 'Template failed: %s' % e)
+        return Response(body, content_type=self.content_type, status=self.status_code, headers=headers)
 
 
-@app.route('/mock/<token>/<path:path>', methods=['GET', 'POST'])
-def use_api(token, path):
+class TemplateLimitError(SecurityError):
+    pass
+
+
+class TemplateCodeGenerator(CodeGenerator):
+    """
+    Compiles every `for` loop to iterate through `environment._loop`, which
+    checks the time budget at each step, and `~` to `environment._concat`,
+    which checks the size of the result before building it
     """
-    ### Mock
-    Your mock API base URL.
 
-    This is your mock API "new" base URL. All the mock API paths you setup are available under `/mock/:token/` for both `GET`and `POST`methods.
-    Example (using token and path created in `register`and `setup`section examples):
+    def visit_For(self, node, frame):
+        node.iter = nodes.Call(nodes.EnvironmentAttribute('_loop'), [node.iter], [], None, None, lineno=node.lineno)
+        CodeGenerator.visit_For(self, node, frame)
 
-        $ curl -v https://mom.skmobi.com/mock/MeB3aNo4yDXrtNH6/login/
-        < HTTP/1.1 400 BAD REQUEST
-        < Content-Type: application/json
-        < Content-Length: 25
-        <
-        {"code": "invalid_login"}
+    def visit_Concat(self, node, frame):
+        self.write('environment._concat((')
+        for arg in node.nodes:
+            self.visit(arg, frame)
+            self.write(', ')
+        self.write('))')
+
+
+class TemplateEnvironment(SandboxedEnvironment):
+    """
+    Sandboxed Jinja2 environment with a budget per render: `range` gives
+    at most `max_range` items, operators, filters and string or list
+    methods cannot build values past `max_output` (their size is worked
+    out before they are built), at most `max_output` characters come out
+    and rendering stops after `timeout` seconds, checked at every call,
+    operator, loop and `range` step.
     """
-    pt = db.session.query(MockPath).filter_by(token_id=token, path=path).first()
+    code_generator_class = TemplateCodeGenerator
+    intercepted_binops = frozenset(['*', '**', '%', '+'])
+    FORMAT_WIDTH_RE = re.compile(r'%[-#0 +]*(\*|\d{6,})')
+    # string methods whose first argument is the width of the result
+    WIDTH_METHODS = frozenset(['center', 'ljust', 'rjust', 'zfill'])
 
-    if pt is None:
-        abort(404, 'Method not found')
+    def __init__(self, timeout=0.1, max_output=65536, max_range=1000):
+        SandboxedEnvironment.__init__(self)
+        self.timeout = timeout
+        self.max_output = max_output
+        self.max_range = max_range
+        self.globals['range'] = self._range
+        del self.globals['lipsum']
+        for name in ('center', 'indent', 'wordwrap', 'batch', 'slice'):
+            # their width or count is the only size these filters do not take from their input
+            del self.filters[name]
+        replace, join, format_ = self.filters['replace'], self.filters['join'], self.filters['format']
 
-    custom_headers = {}
+        @evalcontextfilter
+        def do_replace(eval_ctx, s, old, new, count=None):
+            s = self._string(s)
+            self._check_size(self._replace_size(s, self._string(old), self._string(new), count))
+            return replace(eval_ctx, s, old, new, count)
 
-    for header in pt.headers.all():
-        custom_headers[header.name] = header.value
+        @evalcontextfilter
+        def do_join(eval_ctx, value, d=u'', attribute=None):
+            value = list(value)
+            self._check_size(self._join_size(d, value))
+            return join(eval_ctx, value, d, attribute)
 
-    resp = Response(
-        pt.body,
-        content_type=pt.content_type,
-        status=pt.status_code,
-        headers=custom_headers,
-    )
-    return resp
+        def do_format(value, *args, **kwargs):
+            self._check_size(self._percent_size(self._string(value), kwargs or args))
+            return format_(value, *args, **kwargs)
 
+        self.filters.update(replace=do_replace, join=do_join, format=do_format)
+        self._local = threading.local()
 
-def purge_tokens(keep_days=2):
-    import datetime
-    last_date = datetime.datetime.now() - datetime.timedelta(days=keep_days)
-    r = db.session.query(MockToken).filter(MockToken.created_on < last_date).delete(synchronize_session=False)
-    db.session.commit()
-    return r
+    def render(self, template, context):
+        self._local.deadline = time.time() + self.timeout
+        output = []
+        size = 0
+        for chunk in template.generate(context):
+            size += len(chunk)
+            if size > self.max_output:
+                raise TemplateLimitError('output larger than %d characters' % self.max_output)
+            self._check()
+            output.append(chunk)
+        return u''.join(output)
 
+    def _check(self):
+        if time.time() > getattr(self._local, 'deadline', float('inf')):
+            raise TemplateLimitError('took longer than %gs' % self.timeout)
 
-class MockToken(db.Model):
-    token = db.Column(db.String(16), primary_key=True)
-    created_on = db.Column(db.DateTime, server_default=db.func.now())
+    def _loop(self, iterable):
+        for item in iterable:
+            self._check()
+            yield item
 
-    def __init__(self, token=None):
-        self.token = token
+    def _range(self, *args):
+        items = xrange(*args)
+        if len(items) > self.max_range:
+            raise TemplateLimitError('range larger than %d' % self.max_range)
+        for item in items:
+            self._check()
+            yield item
 
-    def __repr__(self):
-        return '<MockToken %r>' % (self.token)
+    def _size(self, value, _parents=()):
+        """
+        About how many characters `value` takes as a string, counting
+        stops once past `max_output`
+        """
+        if isinstance(value, basestring):
+            return len(value)
+        if isinstance(value, (int, long)):
+            return value.bit_length() // 3 + 1
+        if not isinstance(value, (list, tuple, dict)):
+            return 0
+        if id(value) in _parents:
+            # shown as [...]
+            return 3
+        if len(_parents) > 100:
+            raise TemplateLimitError('values nested deeper than 100')
+        _parents += (id(value),)
+        size = len(value)
+        for item in (value.iteritems() if isinstance(value, dict) else value):
+            size += self._size(item, _parents)
+            if size > self.max_output:
+                break
+        return size
 
+    def _check_size(self, size):
+        if size > self.max_output:
+            raise TemplateLimitError('result larger than %d' % self.max_output)
 
-class MockPath(db.Model):
-    __table_args__ = (
-        db.UniqueConstraint('path', 'token_id', name='_path_token_uc'),
-        db.Index('_token_path_ix', 'token_id', 'path')
+    def _string(self, value):
+        """`value` as a string, checking its size first"""
+        if isinstance(value, basestring):
+            return value
+        self._check_size(self._size(value))
+        return unicode(value)
+
+    def _replace_size(self, s, old, new, count=None):
+        replaced = s.count(old) if old else len(s) + 1
+        if count is not None and count >= 0:
+            replaced = min(replaced, count)
+        return len(s) + replaced * max(len(new) - len(old), 0)
+
+    def _join_size(self, separator, items):
+        return len(separator) * max(len(items) - 1, 0) + sum(self._size(item) for item in items)
+
+    def _percent_size(self, fmt, values):
+        if self.FORMAT_WIDTH_RE.search(fmt):
+            raise TemplateLimitError('format width too large')
+        return len(fmt) + fmt.count('%') * self._size(values)
+
+    def _format_size(self, fmt, args, kwargs):
+        try:
+            fields = list(string.Formatter().parse(fmt))
+        except ValueError:
+            # left for `format` to report
+            return 0
+        size = 0
+        automatic = 0
+        for literal, field, spec, conversion in fields:
+            size += len(literal)
+            if field is None:
+                continue
+            if '{' in (spec or ''):
+                raise TemplateLimitError('format width too large')
+            name = re.match(r'[^.[]*', field).group()
+            if name == '':
+                name, automatic = str(automatic), automatic + 1
+            if name.isdigit():
+                value = args[int(name)] if int(name) < len(args) else None
+            else:
+                value = kwargs.get(name)
+            size += self._size(value) + 2 + max([int(n) for n in re.findall(r'\d+', spec or '')] or [0])
+        return size
+
+    def _concat(self, values):
+        self._check_size(sum(self._size(value) for value in values))
+        return u''.join(unicode(value) for value in values)
+
+    def call_binop(self, context, operator, left, right):
+        self._check()
+        if operator == '**' and isinstance(right, (int, long)) and right > 64:
+            raise TemplateLimitError('exponent larger than 64')
+        if operator == '*':
+            for sequence, times in ((left, right), (right, left)):
+                if isinstance(sequence, (basestring, list, tuple)) and isinstance(times, (int, long)):
+                    self._check_size(self._size(sequence) * times)
+        if operator == '+' and isinstance(left, (basestring, list, tuple)):
+            self._check_size(self._size(left) + self._size(right))
+        if operator == '%' and isinstance(left, basestring):
+            self._check_size(self._percent_size(left, right))
+        return SandboxedEnvironment.call_binop(self, context, operator, left, right)
+
+    def call(__self, __context, __obj, *args, **kwargs):
+        __self._check()
+        owner = getattr(__obj, '__self__', None)
+        name = getattr(__obj, '__name__', None)
+        if isinstance(owner, basestring):
+            if name == 'replace' and len(args) >= 2:
+                __self._check_size(__self._replace_size(owner, *args[:3]))
+            elif name == 'join' and len(args) == 1:
+                args = (list(args[0]),)
+                __self._check_size(__self._join_size(owner, args[0]))
+            elif name == 'format':
+                __self._check_size(__self._format_size(owner, args, kwargs))
+            elif name in __self.WIDTH_METHODS and args and isinstance(args[0], (int, long)):
+                __self._check_size(args[0])
+            elif name == 'expandtabs':
+                __self._check_size(len(owner) * (args[0] if args and isinstance(args[0], (int, long)) else 8))
+        elif isinstance(owner, list) and name in ('append', 'extend', 'insert'):
+            __self._check_size(__self._size(owner) + __self._size(args))
+        return SandboxedEnvironment.call(__self, __context, __obj, *args, **kwargs)
+
+
+compiled_templates = OrderedDict()
+compiled_templates_lock = threading.Lock()
+
+
+def compile_template(source):
+    """
+    `source` compiled by `templates`, parsed only the first time and kept
+    in an LRU of `MOCK_TEMPLATE_CACHE_SIZE` for every path that uses it
+    """
+    with compiled_templates_lock:
+        template = compiled_templates.pop(source, None)
+        if template is not None:
+            compiled_templates[source] = template
+            return template
+    template = templates.from_string(source)
+    with compiled_templates_lock:
+        compiled_templates[source] = template
+        while len(compiled_templates) > app.config['MOCK_TEMPLATE_CACHE_SIZE']:
+            compiled_templates.popitem(last=False)
+    return template
+
+
+def template_context():
+    """What templates can use about the request being answered"""
+    token = request.view_args['token']
+
+    def counter(name='default'):
+        if not isinstance(name, basestring) or len(name) > 100:
+            raise TemplateLimitError('counter names are strings of up to 100 characters')
+        return counters.incr(token, 'counter/%s' % name)
+
+    return dict(
+        method=request.method,
+        path=request.view_args['path'],
+        params=getattr(g, 'mock_params', None) or {},
+        args=request.args.to_dict(),
+        headers=dict(request.headers),
+        json=request.get_json(silent=True),
+        body=request.get_data().decode('utf-8', 'replace'),
+        counter=counter,
+        now=datetime.datetime.utcnow,
+        uuid=lambda: str(uuid.uuid4()),
     )
 
-    id = db.Column(db.Integer, primary_key=True)
-    token_id = db.Column(db.String(16), db.ForeignKey('mock_token.token'), nullable=False)
-    path = db.Column(db.String(200), nullable=False)
-    status_code = db.Column(db.Integer, nullable=False)
-    content_type = db.Column(db.String(100), nullable=False)
-    body = db.Column(db.String(500))
 
-    token = db.relationship('MockToken', backref=db.backref('paths', lazy='dynamic'))
+class CounterLimitError(Exception):
+    pass
 
-    def __init__(self, token, path):
-        self.token_id = token
+
+class LocalCounters(object):
+    """
+    Counters of templates and response sequences, for a single process.
+
+    A token can have up to `max_per_token` counters, `incr` of one more
+    raises `CounterLimitError`.
+    """
+
+    def __init__(self, max_per_token=None):
+        self.max_per_token = max_per_token
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def incr(self, token, name):
+        """Add one to the `name` counter of `token` and return it, counters start at 0"""
+        with self._lock:
+            if (token, name) not in self._values and self.max_per_token is not None and sum(
+                1 for key in self._values if key[0] == token
+            ) >= self.max_per_token:
+                raise CounterLimitError('Too many counters, the limit is %d per token' % self.max_per_token)
+            value = self._values[token, name] = self._values.get((token, name), 0) + 1
+        return value
+
+    def reset(self, token, name=None):
+        """Set the `name` counter of `token` or, without `name`, all of them back to 0"""
+        with self._lock:
+            for key in self._values.keys():
+                if key[0] == token and name in (None, key[1]):
+                    del self._values[key]
+
+    def purge(self, tokens):
+        """Forget every counter of `tokens`"""
+        for token in tokens:
+            self.reset(token)
+
+
+class MappedFile(object):
+    """
+    The first `size` bytes of `filename` mapped in memory as `map`, so
+    every process opening the file shares them. Without a `filename` the
+    memory is private to this process.
+    """
+
+    def __init__(self, filename, size):
+        import mmap
+        self.filename = filename
+        self.size = size
+        self._lock = threading.Lock()
+        if filename is None:
+            self._fd = None
+            self.map = mmap.mmap(-1, size)
+        else:
+            self._fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+            self.map = mmap.mmap(self._fd, size)
+
+    def locked(self, apply, length=0, offset=0):
+        """
+        Call `apply` holding the `length` bytes at `offset` (the whole file
+        by default) against the other threads and processes
+        """
+        import fcntl
+        with self._lock:
+            if self._fd is None:
+                return apply()
+            # record locks are per process, so they also hold across forked workers
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, length, offset)
+            try:
+                return apply()
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, offset)
+
+
+class FileCounters(object):
+    """
+    Counters of templates and response sequences, shared by every
+    process on the same host.
+
+    An open addressing hash table in a memory-mapped file: each slot
+    holds the 16 byte digest of its (token, name) key, 8 bytes of the
+    token digest, so all counters of a token can be found, and the
+    value. Keys are compared in full, two never share a counter.
+    Every update holds a lock on the file, so increments are atomic
+    across gunicorn workers.
+
+    A key only ever takes one of the `PROBES` slots following its hash,
+    so deleted slots left behind cost no more than that to skip. When
+    all of them are in use, a counter of any token is evicted (and
+    starts over). Each token also has a slot with how many counters it
+    has, up to `max_per_token`, past which `incr` raises
+    `CounterLimitError`, so no token can take the whole table.
+    """
+    SLOT = struct.Struct('<16s8sQ')
+    EMPTY = b'\0' * 16
+    DELETED = b'\xff' * 16
+    PROBES = 32
+
+    def __init__(self, filename, slots=65536, max_per_token=None):
+        self.filename = filename
+        self.slots = slots
+        self.max_per_token = max_per_token
+        self._file = MappedFile(filename, slots * self.SLOT.size)
+        self._map = self._file.map
+
+    def _digest(self, token, name):
+        return hashlib.md5(('%s\0%s' % (token, name)).encode('utf-8')).digest()
+
+    def _token_digest(self, token):
+        return hashlib.md5(token.encode('utf-8')).digest()[:8]
+
+    def _count_digest(self, token_digest):
+        return hashlib.md5(b'count\0' + token_digest).digest()
+
+    def _locked(self, apply):
+        return self._file.locked(apply)
+
+    def _window(self, digest):
+        start = struct.unpack_from('<Q', digest)[0] % self.slots
+        return [(start + i) % self.slots for i in xrange(min(self.PROBES, self.slots))]
+
+    def _find(self, digest, insert=False):
+        """The slot of `digest` or, with `insert`, the one it can take (None if all are in use)"""
+        free = None
+        for index in self._window(digest):
+            key = self.SLOT.unpack_from(self._map, index * self.SLOT.size)[0]
+            if key == digest:
+                return index
+            if key == self.DELETED:
+                if free is None:
+                    free = index
+            elif key == self.EMPTY:
+                return (index if free is None else free) if insert else None
+        return free if insert else None
+
+    def _take(self, digest):
+        """A slot for the new key `digest`, evicting the counter in it if need be"""
+        index = self._find(digest, insert=True)
+        if index is not None:
+            return index
+        for index in self._window(digest):
+            key, token_digest, _ = self.SLOT.unpack_from(self._map, index * self.SLOT.size)
+            count_digest = self._count_digest(token_digest)
+            if key != count_digest:
+                self._add_count(count_digest, -1)
+                return index
+        raise CounterLimitError('No free counter slots in %s' % self.filename)
+
+    def _add_count(self, count_digest, delta):
+        index = self._find(count_digest)
+        if index is not None:
+            key, token_digest, value = self.SLOT.unpack_from(self._map, index * self.SLOT.size)
+            self.SLOT.pack_into(self._map, index * self.SLOT.size, key, token_digest, max(value + delta, 0))
+
+    def incr(self, token, name):
+        """Add one to the `name` counter of `token` and return it, counters start at 0"""
+        digest = self._digest(token, name)
+
+        def apply():
+            index = self._find(digest)
+            if index is not None:
+                key, token_digest, value = self.SLOT.unpack_from(self._map, index * self.SLOT.size)
+                self.SLOT.pack_into(self._map, index * self.SLOT.size, key, token_digest, value + 1)
+                return value + 1
+
+            token_digest = self._token_digest(token)
+            count_digest = self._count_digest(token_digest)
+            count_index = self._find(count_digest)
+            count = 0
+            if count_index is not None:
+                count = self.SLOT.unpack_from(self._map, count_index * self.SLOT.size)[2]
+            if self.max_per_token is not None and count >= self.max_per_token:
+                raise CounterLimitError('Too many counters, the limit is %d per token' % self.max_per_token)
+            if count_index is None:
+                count_index = self._take(count_digest)
+            self.SLOT.pack_into(self._map, count_index * self.SLOT.size, count_digest, token_digest, count + 1)
+            self.SLOT.pack_into(self._map, self._take(digest) * self.SLOT.size, digest, token_digest, 1)
+            return 1
+        return self._locked(apply)
+
+    def reset(self, token, name=None):
+        """Set the `name` counter of `token` or, without `name`, all of them back to 0"""
+        if name is None:
+            self.purge([token])
+            return
+
+        def apply():
+            index = self._find(self._digest(token, name))
+            if index is not None:
+                self.SLOT.pack_into(self._map, index * self.SLOT.size, self.DELETED, b'', 0)
+                self._add_count(self._count_digest(self._token_digest(token)), -1)
+        self._locked(apply)
+
+    def purge(self, tokens):
+        """Forget every counter of `tokens`"""
+        token_digests = set(self._token_digest(token) for token in tokens)
+
+        def apply():
+            for index in xrange(self.slots):
+                key, token_digest, _ = self.SLOT.unpack_from(self._map, index * self.SLOT.size)
+                if token_digest in token_digests and key not in (self.EMPTY, self.DELETED):
+                    self.SLOT.pack_into(self._map, index * self.SLOT.size, self.DELETED, b'', 0)
+        self._locked(apply)
+
+
+def make_counters(config):
+    """
+    Build the counters described by `MOCK_COUNTERS`: `'local'`, `'file'`
+    or any object with the `LocalCounters` methods
+    """
+    kind = config['MOCK_COUNTERS']
+    if kind == 'local':
+        return LocalCounters(config['MOCK_COUNTERS_PER_TOKEN'])
+    if kind == 'file':
+        import tempfile
+        filename = config['MOCK_COUNTERS_FILE'] or os.path.join(tempfile.gettempdir(), 'myownmocker-counters')
+        return FileCounters(filename, max_per_token=config['MOCK_COUNTERS_PER_TOKEN'])
+    return kind
+
+
+class Chaos(object):
+    """
+    Artificial latency, bandwidth limit and random failures of a mock path.
+
+    Delays go through `time.sleep`, which only blocks the current
+    greenlet when served by gevent workers (see the Procfile). Delays are
+    at most `MOCK_MAX_DELAY` seconds, bandwidths at least
+    `MOCK_MIN_BANDWIDTH`, and the body is sped up if needed so that a
+    response never takes much longer than `MOCK_MAX_DELAY` overall.
+    """
+    __slots__ = ('delay', 'bandwidth', 'failure_rate', 'failure_status')
+
+    def __init__(self, delay=None, bandwidth=None, failure_rate=0, failure_status=503):
+        self.delay = delay
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build from `setup` input, raising `ValueError` when invalid"""
+        try:
+            bandwidth = data.get('bandwidth')
+            if bandwidth is not None:
+                bandwidth = float(bandwidth)
+                if not bandwidth >= app.config['MOCK_MIN_BANDWIDTH'] or not bandwidth > 0:
+                    raise ValueError
+            failure_rate = float(data.get('failure_rate', 0))
+            if not 0 <= failure_rate <= 1:
+                raise ValueError
+            failure_status = int(data.get('failure_status', 503))
+            return cls(cls._delay(data.get('delay')), bandwidth, failure_rate, failure_status)
+        except (TypeError, ValueError, KeyError, IndexError, AttributeError):
+            raise ValueError('Invalid chaos')
+
+    @staticmethod
+    def _delay(delay):
+        """
+        A function returning a delay in seconds, from a delay definition in
+        milliseconds, raising `ValueError` for delays past `MOCK_MAX_DELAY`
+        """
+        if delay is None:
+            return None
+        max_delay = app.config['MOCK_MAX_DELAY']
+
+        def seconds(value):
+            value = float(value) / 1000
+            if not 0 <= value <= max_delay:
+                raise ValueError
+            return value
+
+        if not isinstance(delay, dict):
+            delay = seconds(delay)
+            return lambda: delay
+        if 'uniform' in delay:
+            low, high = [seconds(value) for value in delay['uniform']]
+            return lambda: random.uniform(low, high)
+        if 'normal' in delay:
+            mean, stddev = [seconds(value) for value in delay['normal']]
+            return lambda: min(max(0, random.gauss(mean, stddev)), max_delay)
+        if 'percentiles' in delay:
+            # linear interpolation between the given percentiles, from 0ms at p0
+            points = [(0.0, 0.0)] + sorted(
+                (float(p), seconds(value)) for p, value in delay['percentiles'].iteritems()
+            )
+            if not points[-1][0] <= 100:
+                raise ValueError
+
+            def percentile():
+                p = random.uniform(0, 100)
+                for (p0, v0), (p1, v1) in zip(points, points[1:]):
+                    if p <= p1:
+                        return v0 + (v1 - v0) * (p - p0) / ((p1 - p0) or 1)
+                return points[-1][1]
+            return percentile
+        raise ValueError
+
+    def serve(self, response):
+        """Serve the `CompiledResponse` in the worst possible way"""
+        delay = 0
+        if self.delay is not None:
+            delay = self.delay()
+            time.sleep(delay)
+        if self.failure_rate and random.random() < self.failure_rate:
+            resp = jsonify(message='Simulated failure')
+            resp.status_code = self.failure_status
+            return resp
+        resp = response.to_response()
+        if self.bandwidth is not None and resp.status_code != 304:
+            bandwidth = self.bandwidth
+            if resp.content_length:
+                # what is left of MOCK_MAX_DELAY, and at least a second, for the body
+                bandwidth = max(bandwidth, resp.content_length / max(app.config['MOCK_MAX_DELAY'] - delay, 1.0))
+            resp.response = throttle(resp.response, bandwidth)
+        return resp
+
+
+def throttle(chunks, bandwidth, interval=0.1):
+    """Yield `chunks` again, at `bandwidth` bytes per second"""
+    size = max(1, int(bandwidth * interval))
+    try:
+        for chunk in chunks:
+            for start in xrange(0, len(chunk), size):
+                piece = chunk[start:start + size]
+                yield piece
+                time.sleep(len(piece) / float(bandwidth))
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+class CompiledMock(object):
+    """
+    Everything a `MockPath` can answer with: its default response and
+    its variants, grouped by HTTP method.
+
+    Building one requires the `MockPath` row, picking the response
+    for a request requires nothing else.
+    """
+    __slots__ = ('default', 'chaos', 'path', 'params', 'sequence', 'cycle', '_methods', '_any_method')
+
+    def __init__(self, default, variants=(), chaos=None, path=None, params=None, sequence=None, cycle=False):
+        # variants are (method, query items, header items, response), in priority order
+        self.default = default
+        self.chaos = chaos
         self.path = path
+        self.params = params
+        # responses served in turn instead of `default`, then again from the first or the last one forever
+        self.sequence = sequence
+        self.cycle = cycle
+        self._any_method = [variant[1:] for variant in variants if variant[0] is None]
+        self._methods = {}
+        for method in set(variant[0] for variant in variants if variant[0] is not None):
+            self._methods[method] = [variant[1:] for variant in variants if variant[0] in (method, None)]
 
+    @classmethod
+    def from_path(cls, pt, params=None):
+        build = TemplateResponse.build if pt.template else CompiledResponse.build
+        default = build(
+            pt.status_code, pt.content_type, pt.custom_headers(), pt.body, pt.body_file, pt.etag, pt.updated_on,
+        )
+        variants = []
+        for variant in pt.variants():
+            match = variant['match']
+            variants.append((
+                match.get('method'),
+                match.get('query', {}).items(),
+                match.get('headers', {}).items(),
+                build(
+                    variant['status_code'], variant['content_type'], variant['custom_headers'], variant['body'],
+                    variant.get('body_file'), variant.get('etag'), pt.updated_on,
+                ),
+            ))
+        chaos = None
+        if pt.chaos_json is not None:
+            chaos = Chaos.from_dict(json.loads(pt.chaos_json))
+        sequence = None
+        cycle = False
+        if pt.sequence_json is not None:
+            definition = json.loads(pt.sequence_json)
+            cycle = definition['mode'] == 'cycle'
+            sequence = [
+                build(
+                    response['status_code'], response['content_type'], response['custom_headers'], response['body'],
+                    response.get('body_file'), response.get('etag'), pt.updated_on,
+                ) for response in definition['responses']
+            ]
+        return cls(default, variants, chaos, pt.path, params, sequence, cycle)
 
-class MockHeader(db.Model):
-    __table_args__ = (
-        db.UniqueConstraint('path_id', 'name', name='_path_name_uc'),
-    )
+    def select(self, request):
+        """
+        The `CompiledResponse` for `request`: the first variant it matches,
+        or the default (the next one of the sequence, if any)
+        """
+        method = 'GET' if request.method == 'HEAD' else request.method
+        variants = self._methods.get(method, self._any_method)
+        if not variants:
+            return self._default(request)
+        args = request.args
+        request_headers = request.headers
+        for query, headers, response in variants:
+            for name, value in query:
+                if args.get(name) != value:
+                    break
+            else:
+                for name, value in headers:
+                    if request_headers.get(name) != value:
+                        break
+                else:
+                    return response
+        return self._default(request)
 
-    id = db.Column(db.Integer, primary_key=True)
-    path_id = db.Column(db.Integer, db.ForeignKey('mock_path.id'), nullable=False, index=True)
-    name = db.Column(db.String(100), nullable=False)
-    value = db.Column(db.String(100), nullable=False)
+    def _default(self, request):
+        if self.sequence is None:
+            return self.default
+        try:
+            position = counters.incr(request.view_args['token'], 'sequence/%s' % self.path) - 1
+        except CounterLimitError as e:
+            abort(429, str(e))
+        if self.cycle:
+            return self.sequence[position % len(self.sequence)]
+        return self.sequence[min(position, len(self.sequence) - 1)]
 
-    path = db.relationship('MockPath', backref=db.backref('headers', lazy='dynamic'))
 
-    def __init__(self, path_id, name, value):
-        self.path_id = path_id
-        self.name = name
-        self.value = value
+class LocalChannel(object):
+    """
+    Invalidation channel for a single process.
+
+    There is no one else to tell, so versions never change.
+    """
+
+    def version(self, key):
+        return 0
+
+    def bump(self, key):
+        pass
+
+
+class FileChannel(object):
+    """
+    Invalidation channel for every process on the same host.
+
+    A memory-mapped file holds `slots` version counters. Keys are hashed
+    into a slot, a change bumps its counter and readers compare the
+    counter with the one they saw when they cached the entry.
+    Collisions only cause extra invalidations, never stale reads.
+    """
+
+    def __init__(self, filename, slots=65536):
+        self.filename = filename
+        self.slots = slots
+        self._file = MappedFile(filename, slots * 8)
+        self._map = self._file.map
+
+    def _offset(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return ((zlib.crc32(key) & 0xffffffff) % self.slots) * 8
+
+    def version(self, key):
+        return struct.unpack_from('<Q', self._map, self._offset(key))[0]
+
+    def bump(self, key):
+        offset = self._offset(key)
+
+        def apply():
+            value = struct.unpack_from('<Q', self._map, offset)[0]
+            struct.pack_into('<Q', self._map, offset, (value + 1) & 0xffffffffffffffff)
+        self._file.locked(apply, 8, offset)
+
+
+def make_channel(config):
+    """
+    Build the invalidation channel described by `MOCK_CACHE_CHANNEL`:
+    `'local'`, `'file'` or any object with `version(key)` and `bump(key)`
+    """
+    channel = config['MOCK_CACHE_CHANNEL']
+    if channel == 'local':
+        return LocalChannel()
+    if channel == 'file':
+        import tempfile
+        filename = config['MOCK_CACHE_CHANNEL_FILE'] or os.path.join(
+            tempfile.gettempdir(), 'myownmocker-versions'
+        )
+        return FileChannel(filename)
+    return channel
+
+
+class ResponseCache(object):
+    """
+    Bounded LRU of `CompiledMock` keyed by (token, path).
+
+    Invalidations are broadcast through `channel` so other processes
+    drop their copies too. Each process checks an entry against the
+    channel at most once every `max_stale` seconds, which bounds how
+    long it can serve a stale response. An entry put with a `ttl` is
+    also dropped that many seconds later, whatever the channel says.
+
+    A `max_size` of 0 disables caching.
+    """
+
+    def __init__(self, max_size=1024, channel=None, max_stale=0):
+        self.max_size = max_size
+        self.channel = channel or LocalChannel()
+        self.max_stale = max_stale
+        self._entries = OrderedDict()
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stamp(self, token, path):
+        """
+        Channel versions of (token, path), to be taken *before* reading
+        the database and handed to `put`
+        """
+        return (self.channel.version(token), self.channel.version(token + '/' + path))
+
+    def get(self, token, path):
+        key = (token, path)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[3] is not None and now >= entry[3]:
+                self._forget(token, path)
+                entry = None
+            if entry is not None and now - entry[2] >= self.max_stale:
+                if entry[1] == self.stamp(token, path):
+                    entry[2] = now
+                else:
+                    self._forget(token, path)
+                    entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, token, path, compiled, stamp=None, ttl=None):
+        if self.max_size <= 0:
+            return
+        if stamp is None:
+            stamp = self.stamp(token, path)
+        key = (token, path)
+        now = time.time()
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = [compiled, stamp, now, None if ttl is None else now + ttl]
+            self._tokens.setdefault(token, set()).add(path)
+            while len(self._entries) > self.max_size:
+                (old_token, old_path), _ = self._entries.popitem(last=False)
+                self._forget(old_token, old_path)
+                self.evictions += 1
+
+    def invalidate(self, token, path=None):
+        """
+        Drop a single (token, path) entry or, without `path`, every entry
+        of `token`, in this process and, through the channel, in all others
+        """
+        if path is None:
+            self.channel.bump(token)
+        else:
+            self.channel.bump(token + '/' + path)
+        with self._lock:
+            if path is None:
+                paths = self._tokens.pop(token, ())
+            else:
+                paths = (path,)
+                self._forget(token, path)
+            for p in paths:
+                self._entries.pop((token, p), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tokens.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                size=len(self._entries),
+                max_size=self.max_size,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+            )
+
+    def _forget(self, token, path):
+        paths = self._tokens.get(token)
+        if paths is not None:
+            paths.discard(path)
+            if not paths:
+                del self._tokens[token]
+
+
+def is_pattern(path):
+    return '{' in path or '*' in path
+
+
+class PatternIndex(object):
+    """
+    Segment trie of the pattern paths of a token.
+
+    A `{name}` segment matches any single segment and a `*` segment
+    matches the rest of the path (or any single segment when it is not
+    the last one). Literal segments take priority over `{name}`, which
+    takes priority over `*`, so resolution costs about one dictionary
+    lookup per segment instead of a scan over every pattern.
+    """
+
+    def __init__(self, patterns=()):
+        # node: [literal children, placeholder child, glob match, match]
+        self._root = [{}, None, None, None]
+        for pattern in patterns:
+            self.add(pattern)
+
+    def add(self, pattern):
+        node = self._root
+        names = []
+        segments = pattern.split('/')
+        for i, segment in enumerate(segments):
+            if segment == '*' and i == len(segments) - 1:
+                node[2] = (pattern, names + ['*'])
+                return
+            if segment == '*' or (segment.startswith('{') and segment.endswith('}')):
+                names.append(segment[1:-1] or segment)
+                if node[1] is None:
+                    node[1] = [{}, None, None, None]
+                node = node[1]
+            else:
+                node = node[0].setdefault(segment, [{}, None, None, None])
+        node[3] = (pattern, names)
+
+    def match(self, path):
+        """Return the best matching pattern and its parameters, or `(None, None)`"""
+        found = self._match(self._root, path.split('/'), 0, [])
+        if found is None:
+            return None, None
+        (pattern, names), values = found
+        return pattern, dict(zip(names, values))
+
+    def _match(self, node, segments, i, values):
+        if i == len(segments):
+            if node[3] is not None:
+                return node[3], values
+            return None
+        child = node[0].get(segments[i])
+        if child is not None:
+            found = self._match(child, segments, i + 1, values)
+            if found is not None:
+                return found
+        if node[1] is not None:
+            found = self._match(node[1], segments, i + 1, values + [segments[i]])
+            if found is not None:
+                return found
+        if node[2] is not None:
+            return node[2], values + ['/'.join(segments[i:])]
+        return None
+
+
+def invalidate(token, path=None):
+    """
+    Forget the cached responses of (token, path) or, without `path`, all
+    of `token`. Changing a pattern path affects every path it matches,
+    so it forgets the whole token.
+    """
+    if path is None or is_pattern(path):
+        response_cache.invalidate(token)
+        pattern_cache.invalidate(token)
+    else:
+        response_cache.invalidate(token, path)
+
+
+def process_exists(pid):
+    """Whether a process with this pid is running on this host"""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class Metrics(object):
+    """
+    Request counts, latency histograms and database query counts per
+    route, plus cache counters, rendered in the Prometheus text format.
+
+    Values are a flat array of doubles. Given a `directory`, each
+    process keeps its array in a memory-mapped file there and `collect`
+    sums the files of the processes still running, so any gunicorn
+    worker can answer a scrape for all of them. Otherwise only this
+    process is reported. `routes` are the endpoint names to report, any
+    other request is counted as `other`.
+    """
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+    CACHES = ('response', 'pattern')
+
+    def __init__(self, directory=None, routes=()):
+        self.directory = directory
+        self.routes = tuple(sorted(set(routes) - set(['other']))) + ('other',)
+        # per route: requests, duration sum, queries, then one slot per bucket
+        self._route_size = 3 + len(self.BUCKETS)
+        self._routes = dict((route, i * self._route_size) for i, route in enumerate(self.routes))
+        # per cache: hits, misses, evictions
+        self._caches = dict(
+            (cache, len(self.routes) * self._route_size + i * 3) for i, cache in enumerate(self.CACHES)
+        )
+        self.size = len(self.routes) * self._route_size + len(self.CACHES) * 3
+        self._lock = threading.Lock()
+        self._pid = None
+        self._buffer = None
+
+    def _values(self):
+        # a new array per process, forked workers must not share their parent's
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            if self.directory is None:
+                self._buffer = bytearray(self.size * 8)
+            else:
+                import mmap
+                fd = os.open(self._filename(self._pid), os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+                os.ftruncate(fd, self.size * 8)
+                self._buffer = mmap.mmap(fd, self.size * 8)
+                os.close(fd)
+        return self._buffer
+
+    def _filename(self, pid):
+        return os.path.join(self.directory, 'metrics-%d-%d.bin' % (self.size, pid))
+
+    def close(self):
+        """Remove the file of this process, when it exits"""
+        if self.directory is not None and self._pid == os.getpid():
+            try:
+                os.unlink(self._filename(self._pid))
+            except OSError:
+                pass
+            self._pid = None
+            self._buffer = None
+
+    def observe(self, route, duration, queries):
+        offset = self._routes.get(route, self._routes['other'])
+        bucket = bisect.bisect_left(self.BUCKETS, duration)
+        with self._lock:
+            values = self._values()
+            for i, value in ((0, 1), (1, duration), (2, queries), (3 + bucket, 1)):
+                position = (offset + i) * 8
+                struct.pack_into('<d', values, position, struct.unpack_from('<d', values, position)[0] + value)
+
+    def set_cache(self, name, cache):
+        offset = self._caches[name]
+        with self._lock:
+            struct.pack_into('<3d', self._values(), offset * 8, cache.hits, cache.misses, cache.evictions)
+
+    def collect(self):
+        """Values summed over every process"""
+        with self._lock:
+            values = list(struct.unpack_from('<%dd' % self.size, self._values()))
+        if self.directory is None:
+            return values
+        values = [0.0] * self.size
+        prefix = 'metrics-%d-' % self.size
+        for filename in os.listdir(self.directory):
+            if not filename.startswith(prefix) or not filename.endswith('.bin'):
+                continue
+            try:
+                pid = int(filename[len(prefix):-len('.bin')])
+            except ValueError:
+                continue
+            if not process_exists(pid):
+                # left by a worker that died without removing it
+                try:
+                    os.unlink(os.path.join(self.directory, filename))
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(os.path.join(self.directory, filename), 'rb') as f:
+                    data = f.read(self.size * 8)
+            except IOError:
+                continue
+            if len(data) == self.size * 8:
+                values = [a + b for a, b in zip(values, struct.unpack('<%dd' % self.size, data))]
+        return values
+
+    def render(self, rows=None, pools=None):
+        values = self.collect()
+        lines = [
+            '# HELP mom_requests_total Requests handled, by route.',
+            '# TYPE mom_requests_total counter',
+        ]
+        for route, offset in sorted(self._routes.iteritems()):
+            lines.append('mom_requests_total{route="%s"} %r' % (route, values[offset]))
+        lines.append('# HELP mom_request_duration_seconds Time spent handling requests, by route.')
+        lines.append('# TYPE mom_request_duration_seconds histogram')
+        for route, offset in sorted(self._routes.iteritems()):
+            cumulative = 0
+            for i, le in enumerate(self.BUCKETS):
+                cumulative += values[offset + 3 + i]
+                lines.append('mom_request_duration_seconds_bucket{route="%s",le="%s"} %r' % (
+                    route, '+Inf' if le == float('inf') else repr(le), cumulative,
+                ))
+            lines.append('mom_request_duration_seconds_sum{route="%s"} %r' % (route, values[offset + 1]))
+            lines.append('mom_request_duration_seconds_count{route="%s"} %r' % (route, values[offset]))
+        lines.append('# HELP mom_db_queries_total Database queries made while handling requests, by route.')
+        lines.append('# TYPE mom_db_queries_total counter')
+        for route, offset in sorted(self._routes.iteritems()):
+            lines.append('mom_db_queries_total{route="%s"} %r' % (route, values[offset + 2]))
+        for i, name in enumerate(('hits', 'misses', 'evictions')):
+            lines.append('# HELP mom_cache_%s_total Cache %s, by cache.' % (name, name))
+            lines.append('# TYPE mom_cache_%s_total counter' % name)
+            for cache, offset in sorted(self._caches.iteritems()):
+                lines.append('mom_cache_%s_total{cache="%s"} %r' % (name, cache, values[offset + i]))
+        if rows is not None:
+            lines.append('# HELP mom_rows Rows currently stored, by table.')
+            lines.append('# TYPE mom_rows gauge')
+            for table, count in sorted(rows.iteritems()):
+                lines.append('mom_rows{table="%s"} %d' % (table, count))
+        if pools is not None:
+            for i, (name, description) in enumerate((
+                ('size', 'Connections kept open'),
+                ('checked_out', 'Connections in use'),
+                ('overflow', 'Connections opened over the pool size'),
+            )):
+                lines.append('# HELP mom_db_pool_%s %s by this process, by database.' % (name, description))
+                lines.append('# TYPE mom_db_pool_%s gauge' % name)
+                for bind, stats in sorted(pools.iteritems()):
+                    lines.append('mom_db_pool_%s{database="%s"} %d' % (name, bind, stats[i]))
+        return '\n'.join(lines) + '\n'
+
+
+class RateLimiter(object):
+    """
+    Rate limits shared by every process on the same host, with the
+    generic cell rate algorithm: all a key needs is the time its next
+    request is due (its theoretical arrival time), kept in a slot of a
+    memory-mapped file, so checking a limit writes nothing else. A limit
+    of `rate` requests per `period` seconds allows bursts of `rate`, then
+    one every `period / rate` seconds.
+
+    Keys are hashed into one of `slots` slots along with their digest.
+    A key taking a slot over from another starts afresh, so collisions
+    can only let requests through, never refuse them. Processes only lock
+    the slot they check. Without a `filename` the limits are private to
+    this process.
+    """
+    SLOT = struct.Struct('<8sd')
+
+    def __init__(self, filename=None, slots=65536):
+        self.filename = filename
+        self.slots = slots
+        self._file = MappedFile(filename, slots * self.SLOT.size)
+        self._map = self._file.map
+
+    def hit(self, key, rate, period, cost=1):
+        """
+        Count `cost` requests of `key` against `rate` per `period` seconds.
+        Returns 0 if they are allowed, or else the seconds until they would
+        be (and counts nothing).
+        """
+        digest = hashlib.md5(key.encode('utf-8')).digest()[:8]
+        offset = (struct.unpack('<Q', digest)[0] % self.slots) * self.SLOT.size
+        interval = float(period) / rate
+
+        def apply():
+            owner, due = self.SLOT.unpack_from(self._map, offset)
+            now = time.time()
+            if owner != digest or due < now:
+                due = now
+            due += interval * cost
+            retry_after = due - interval * rate - now
+            if retry_after > 0:
+                return retry_after
+            self.SLOT.pack_into(self._map, offset, digest, due)
+            return 0
+        return self._file.locked(apply, self.SLOT.size, offset)
+
+
+def make_rate_limiter(config):
+    import tempfile
+    return RateLimiter(config['MOCK_RATE_LIMIT_FILE'] or os.path.join(tempfile.gettempdir(), 'myownmocker-limits'))
+
+
+class RateLimited(TooManyRequests):
+    """A 429 telling the client, in `Retry-After`, when to try again"""
+
+    def __init__(self, description, retry_after):
+        TooManyRequests.__init__(self, description)
+        self.retry_after = retry_after
+
+
+def client_address():
+    """
+    The address of the client, as seen by the first of the
+    `MOCK_TRUSTED_PROXIES` proxies in front of MOM (such as Heroku's router)
+    """
+    proxies = app.config['MOCK_TRUSTED_PROXIES']
+    forwarded = [address.strip() for address in request.headers.get('X-Forwarded-For', '').split(',')]
+    if proxies and len(forwarded) >= proxies and forwarded[-proxies]:
+        return forwarded[-proxies]
+    return request.remote_addr
+
+
+def rate_limit(name, key, cost=1):
+    """Abort with a 429 once `key` goes over the `MOCK_RATE_<NAME>` limit"""
+    limit = app.config['MOCK_RATE_' + name.upper()]
+    if limit is None:
+        return
+    retry_after = rate_limiter.hit('%s/%s' % (name, key), limit[0], limit[1], cost)
+    if retry_after:
+        raise RateLimited(
+            'Rate limit exceeded (%d per %ds), retry in %ds' % (limit[0], limit[1], math.ceil(retry_after)),
+            retry_after,
+        )
+
+
+# limited per token, before even checking it exists
+RATE_LIMITED_ENDPOINTS = {
+    'setup': 'setup',
+    'setup_bulk': 'setup',
+    'setup_import': 'setup',
+    'setup_reset': 'setup',
+    'setup_proxy': 'setup',
+    'use_api': 'mock',
+}
+
+
+@app.before_request
+def limit_rates():
+    name = RATE_LIMITED_ENDPOINTS.get(request.endpoint)
+    if name is not None:
+        rate_limit(name, request.view_args['token'])
+
+
+def check_path_quota(token, paths, max_paths=None):
+    """Abort with a 429 if creating `paths` would leave `token` with more than `max_paths` paths"""
+    if max_paths is None:
+        return
+    added = len(set(paths) - set(storage.existing_paths(token, paths)))
+    if added and storage.count_paths(token) + added > max_paths:
+        abort(429, 'Too many paths, the limit is %d per token' % max_paths)
+
+
+query_counter = threading.local()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(*args):
+    query_counter.count = getattr(query_counter, 'count', 0) + 1
+
+
+@app.before_request
+def start_metrics():
+    if app.config['MOCK_METRICS']:
+        g.metrics_started = time.time()
+        query_counter.count = 0
+
+
+@app.after_request
+def observe_metrics(resp):
+    if app.config['MOCK_METRICS'] and 'metrics_started' in g:
+        metrics.observe(request.endpoint, time.time() - g.metrics_started, query_counter.count)
+        metrics.set_cache('response', response_cache)
+        metrics.set_cache('pattern', pattern_cache)
+    return resp
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    pools = pool_stats() if app.config['MOCK_STORAGE'] == 'sqlalchemy' else None
+    return Response(metrics.render(storage.count_rows(), pools), content_type='text/plain; version=0.0.4')
+
+
+@app.route('/')
+def index():
+    return redirect('http://fopina.github.io/myownmocker/')
+
+
+@app.route('/register/', methods=['GET'])
+def register():
+    """
+    #### Register
+    Register for a mock token.
+
+    This is the first call you need to make to generate a mock API token to create mock API paths later
+
+        GET /register/
+
+    ###### Example Response
+
+        < HTTP/1.1 200 OK
+        < Content-Type: application/json
+
+        {
+          "token": "MeB3aNo4yDXrtNH6",
+          "setup_url": "http://mom.skmobi.com/setup/MeB3aNo4yDXrtNH6/",
+          "setup_secure_url": "https://mom.skmobi.com/setup/MeB3aNo4yDXrtNH6/",
+          "mock_base_url": "http://mom.skmobi.com/mock/MeB3aNo4yDXrtNH6/",
+          "mock_base_secure_url": "https://mom.skmobi.com/mock/MeB3aNo4yDXrtNH6/"
+        }
+
+    To get several tokens in one call (up to 100), such as one per job of a CI run, pass `count`.
+    The response then lists them under `tokens`, each with the fields above.
+
+        GET /register/?count=20
+
+    Each address gets up to 100 tokens per hour, further calls get a `429 Too Many Requests` telling, in `Retry-After`,
+    how many seconds to wait.
+    """
+    count = request.args.get('count')
+    if count is None:
+        rate_limit('register', client_address())
+        tokens = allocate_tokens(1)
+    else:
+        try:
+            count = int(count)
+        except ValueError:
+            abort(400, 'Invalid count')
+        # more than the rate limit would never get through
+        max_count = app.config['MOCK_REGISTER_MAX_COUNT']
+        if app.config['MOCK_RATE_REGISTER'] is not None:
+            max_count = min(max_count, app.config['MOCK_RATE_REGISTER'][0])
+        if not 0 < count <= max_count:
+            abort(400, 'count must be between 1 and %d' % max_count)
+        rate_limit('register', client_address(), count)
+        tokens = allocate_tokens(count)
+
+    if tokens is None:
+        abort(503, 'Unable to generate a token, please try again')
+    if count is None:
+        return jsonify(**token_urls(tokens[0]))
+    return jsonify(tokens=[token_urls(token) for token in tokens])
+
+
+TOKEN_ALPHABET = string.letters + string.digits
+
+
+def generate_tokens(count, length=16):
+    """
+    `count` random tokens of `length` characters from TOKEN_ALPHABET.
+
+    All the entropy comes from a single os.urandom call, topped up only when
+    rejection sampling (which keeps the characters uniform) discards too much.
+    """
+    limit = 256 - 256 % len(TOKEN_ALPHABET)
+    needed = count * length
+    chars = []
+    while len(chars) < needed:
+        missing = needed - len(chars)
+        for byte in bytearray(os.urandom(missing + missing // 8 + 8)):
+            if byte < limit:
+                chars.append(TOKEN_ALPHABET[byte % len(TOKEN_ALPHABET)])
+    return [''.join(chars[i:i + length]) for i in xrange(0, needed, length)]
+
+
+def allocate_tokens(count, attempts=5):
+    """
+    Insert `count` new tokens and return them, or None if every attempt collided.
+
+    Uniqueness is left to the primary key: a batch is inserted as is and drawn
+    again if any of it already exists, so concurrent workers never race
+    between checking and inserting.
+    """
+    for _ in xrange(attempts):
+        tokens = generate_tokens(count)
+        if len(set(tokens)) < count:
+            continue
+        if storage.add_tokens(tokens):
+            return tokens
+    return None
+
+
+def token_urls(token):
+    return dict(
+        token=token,
+        setup_url='%ssetup/%s/' % (request.url_root, token),
+        setup_secure_url='%ssetup/%s/' % (request.url_root.replace('http://', 'https://'), token),
+        mock_base_url='%smock/%s/' % (request.url_root, token),
+        mock_base_secure_url='%smock/%s/' % (request.url_root.replace('http://', 'https://'), token),
+    )
+
+
+@app.route('/setup/<token>/', methods=['POST'])
+def setup(token):
+    """
+    ### Setup
+    Setup a mock path.
+
+    This is the call to setup (create or replace) mock API paths
+
+        POST /setup/:token/
+        Content-Type: application/json
+
+    ###### Parameters
+
+    | Name              | Type       | Description   |
+    | :---------------: |:----------:| :------------:|
+    | path              | string     | **Required**. The API method path (such as *login/* or *user/fopina/details/*) |
+    | status_code       | int        | **Required**. The HTTP response status code              |
+    | content_type      | string     | **Required**. The HTTP response content type             |
+    | custom_headers    | dictionary | Optional. Extra HTTP headers to include in the response  |
+    | body              | string     | Optional. The body of the response                       |
+    | body_base64       | string     | Optional. A binary body, base64 encoded, instead of `body` |
+    | variants          | list       | Optional. Alternative responses, see below               |
+    | chaos             | dictionary | Optional. Latency, bandwidth and failures to simulate, see below |
+    | template          | boolean    | Optional. Render body and header values as templates, see below |
+    | sequence          | dictionary | Optional. Responses to serve in turn, see below          |
+
+    Where the server has a body store (`MOCK_BODY_STORE`), binary and large bodies are served from files, with `ETag`
+    and `Range` support. Without one, text bodies are kept in the database and binary bodies are refused.
+
+    A path may also be a pattern: a `{name}` segment matches any single segment and a final `*` segment matches the
+    rest of the path, such as `user/{id}/details/` or `files/*`. Exact paths always take priority over patterns.
+
+    Each variant has a `match` object, with any of `method`, `query` (parameters) and `headers` (values) the request
+    must have, and its own `status_code`, `content_type`, `custom_headers` and `body` (status code and content type
+    default to those of the path). The first variant the request matches is served, or the path response if none does:
+
+        "variants": [
+            {"match": {"method": "POST"}, "status_code": 201, "body": "created"},
+            {"match": {"query": {"page": "2"}, "headers": {"X-Debug": "1"}}, "body": "page 2"}
+        ]
+
+    `chaos` makes the path slow or unreliable. `delay` is in milliseconds, either fixed or drawn from a
+    `uniform` ([min, max]), `normal` ([mean, standard deviation]) or `percentiles` distribution, `bandwidth` (bytes per
+    second) throttles the body and `failure_rate` is the probability of answering `failure_status` (503) instead.
+    Delays are at most 30 seconds and bandwidths at least 100 bytes per second (`MOCK_MAX_DELAY` and
+    `MOCK_MIN_BANDWIDTH` on your own copy), and a throttled body is sent faster if it would take longer than that:
+
+        "chaos": {
+            "delay": {"percentiles": {"50": 80, "95": 300, "99": 1200}},
+            "bandwidth": 65536,
+            "failure_rate": 0.05
+        }
+
+    `sequence` answers each request with the next of its `responses` (same fields as variants, without `match`),
+    instead of the path response, such as two failures before a success to test retries. Once all were served, mode
+    `last` (the default) keeps serving the last one and `cycle` starts over. Variants still take priority.
+    Sequences are shared by every worker and start over with [Reset](#reset):
+
+        "sequence": {
+            "mode": "last",
+            "responses": [
+                {"status_code": 503, "body": "try again"},
+                {"status_code": 503, "body": "try again"},
+                {"status_code": 200, "body": "{\\"ok\\": true}"}
+            ]
+        }
+
+    With `template`, the body and custom header values (of the path, its variants and sequence) are
+    [Jinja2](http://jinja.pocoo.org/docs/dev/templates/) templates, rendered for each request with `method`, `path`,
+    `params` (the `{name}` segments of a pattern), `args` (query), `headers`, `json` (the request body parsed, if JSON),
+    `body`, `counter(name)` (1, 2, 3... for each call with the same name), `now()` and `uuid()`. Templates run
+    sandboxed, with a time and size budget, and without the `center`, `indent`, `wordwrap`, `batch` and `slice`
+    filters or `lipsum()`:
+
+        {
+            "path": "users/{id}",
+            "status_code": 201,
+            "content_type": "application/json",
+            "template": true,
+            "custom_headers": { "Location": "/users/{{ params.id }}" },
+            "body": "{\\"id\\": {{ params.id }}, \\"seq\\": {{ counter('users') }}, \\"name\\": \\"{{ json.name }}\\"}"
+        }
+
+    ###### Example Input
+
+        {
+            "path": "login/",
+            "status_code": 400,
+            "content_type": "application/json",
+            "custom_headers": { "X-My-API-Version": "1" },
+            "body": "{\\\"code\\\": \\\"invalid_login\\\"}"
+        }
+
+    ###### Example Response
+
+        < HTTP/1.1 200 OK
+        < Content-Type: application/json
+
+        {
+            "message": "ok",
+            "path_url": "http://mom.skmobi.com/mock/MeB3aNo4yDXrtNH6/login/",
+            "path_secure_url": "https://mom.skmobi.com/mock/MeB3aNo4yDXrtNH6/login/"
+        }
+    """
+
+    if not storage.has_token(token):
+        abort(404, 'Invalid token')
+
+    data = request.get_json()
+    try:
+        fields = path_fields(data)
+    except KeyError as e:
+        abort(400, 'Missing required field: %s' % e.args[0])
+    except ValueError as e:
+        abort(400, e.args[0])
+    path = fields['path']
+    check_path_quota(token, [path], app.config['MOCK_MAX_PATHS'])
+    storage.save_paths(token, [fields])
+    storage.commit()
+    invalidate(token, path)
+    counters.reset(token, 'sequence/%s' % path)
+    return jsonify(message='ok', **path_urls(token, path))
+
+
+@app.route('/setup/<token>/bulk/', methods=['POST'])
+def setup_bulk(token):
+    """
+    ### Bulk Setup
+    Setup many mock paths at once.
+
+    Takes a list of path definitions, each with the same fields as [Setup](#setup), either as a JSON array or as
+    newline delimited JSON (one definition per line). All of them are created or replaced in a single transaction.
+
+        POST /setup/:token/bulk/
+        Content-Type: application/json
+
+    or
+
+        POST /setup/:token/bulk/
+        Content-Type: application/x-ndjson
+
+    ###### Example Input
+
+        [
+            {"path": "login/", "status_code": 200, "content_type": "application/json", "body": "{}"},
+            {"path": "logout/", "status_code": 204}
+        ]
+
+    ###### Example Response
+
+        < HTTP/1.1 200 OK
+        < Content-Type: application/json
+
+        {
+            "message": "ok",
+            "results": [
+                {
+                    "message": "ok",
+                    "path_url": "http://mom.skmobi.com/mock/MeB3aNo4yDXrtNH6/login/",
+                    "path_secure_url": "https://mom.skmobi.com/mock/MeB3aNo4yDXrtNH6/login/"
+                },
+                {
+                    "message": "Missing required field: content_type"
+                }
+            ]
+        }
+    """
+
+    if not storage.has_token(token):
+        abort(404, 'Invalid token')
+
+    if request.mimetype == 'application/x-ndjson':
+        try:
+            items = [json.loads(line) for line in request.get_data().splitlines() if line.strip()]
+        except ValueError:
+            abort(400, 'Failed to decode JSON object')
+    else:
+        items = request.get_json()
+        if type(items) != list:
+            abort(400, 'Expected a list of path definitions')
+
+    results = []
+    definitions = OrderedDict()
+    for item in items:
+        try:
+            if type(item) != dict:
+                raise ValueError('Invalid path definition')
+            fields = path_fields(item)
+        except KeyError as e:
+            results.append(dict(message='Missing required field: %s' % e.args[0]))
+        except ValueError as e:
+            results.append(dict(message=e.args[0]))
+        else:
+            definitions[fields['path']] = fields
+            results.append(dict(message='ok', **path_urls(token, fields['path'])))
+
+    check_path_quota(token, definitions.keys(), app.config['MOCK_MAX_PATHS'])
+    save_paths(token, definitions.values())
+    storage.commit()
+    for path in definitions:
+        invalidate(token, path)
+        counters.reset(token, 'sequence/%s' % path)
+    return jsonify(message='ok', results=results)
+
+
+@app.route('/setup/<token>/reset', methods=['POST'])
+def setup_reset(token):
+    """
+    ### Reset
+    Restart response sequences and template counters.
+
+    Without parameters, every sequence and `counter()` of the token starts over. With `path`, only the sequence of
+    that path (for a pattern, the pattern itself, such as *user/{id}/*) does. Changing a path with [Setup](#setup),
+    [Bulk Setup](#bulk-setup) or [Import](#import) also restarts its sequence.
+
+        POST /setup/:token/reset?path=login/
+
+    ###### Example Response
+
+        < HTTP/1.1 200 OK
+        < Content-Type: application/json
+
+        {
+            "message": "ok"
+        }
+    """
+
+    if not storage.has_token(token):
+        abort(404, 'Invalid token')
+
+    path = request.args.get('path')
+    if path is None:
+        counters.reset(token)
+    else:
+        counters.reset(token, 'sequence/%s' % path)
+    return jsonify(message='ok')
+
+
+@app.route('/setup/<token>/proxy', methods=['POST'])
+def setup_proxy(token):
+    """
+    ### Proxy
+    Record mock paths from a real API.
+
+    Once a token has an `upstream`, requests to [Mock](#mock) that no path matches are forwarded to it (the path and
+    query appended to the upstream URL) and its response is returned. `GET` responses, unless server errors, are
+    recorded as paths of the token and served from then on, so the upstream is called once per path: the recording
+    ignores the query and request headers, [Export](#export) and edit it for anything finer. Set `upstream` to `null`
+    to stop proxying, recorded paths stay.
+
+    Proxying is only available on servers with `MOCK_PROXY` set, and upstreams on loopback, private or link-local
+    addresses are refused.
+
+        POST /setup/:token/proxy
+        Content-Type: application/json
+
+    ###### Example Input
+
+        {
+            "upstream": "https://api.example.com/v1/"
+        }
+
+    ###### Example Response
+
+        < HTTP/1.1 200 OK
+        < Content-Type: application/json
+
+        {
+            "message": "ok"
+        }
+    """
+
+    if not app.config['MOCK_PROXY']:
+        abort(403, 'Proxying is disabled on this server')
+
+    if not storage.has_token(token):
+        abort(404, 'Invalid token')
+
+    data = request.get_json()
+    if type(data) != dict or 'upstream' not in data:
+        abort(400, 'Missing required field: upstream')
+    upstream = data['upstream']
+    if upstream is not None:
+        if not isinstance(upstream, basestring):
+            abort(400, 'Invalid upstream')
+        if not upstream.endswith('/'):
+            upstream += '/'
+        parts = urlparse.urlsplit(upstream)
+        if parts.scheme not in ('http', 'https') or not parts.netloc or len(upstream) > 255:
+            abort(400, 'Invalid upstream')
+        # checked again on every connection, the name may resolve differently by then
+        try:
+            upstream_pool.address(parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        except UpstreamRefused as e:
+            abort(400, str(e))
+        except socket.error:
+            abort(400, 'Invalid upstream')
+    storage.set_upstream(token, upstream)
+    return jsonify(message='ok')
+
+
+@app.route('/setup/<token>/export', methods=['GET'])
+def setup_export(token):
+    """
+    ### Export
+    Export all the mock paths of a token.
+
+    Streams newline delimited JSON, one path definition per line with the same fields as [Setup](#setup).
+    The output can be given back to [Import](#import), on this token or any other.
+
+        GET /setup/:token/export
+
+    ###### Example Response
+
+        < HTTP/1.1 200 OK
+        < Content-Type: application/x-ndjson
+
+        {"path": "login/", "status_code": 400, "content_type": "application/json", "custom_headers": {}, "body": "{}"}
+        {"path": "logout/", "status_code": 204, "content_type": "text/plain", "custom_headers": {}, "body": null}
+    """
+
+    if not storage.has_token(token):
+        abort(404, 'Invalid token')
+
+    def generate():
+        for definition in export_paths(token):
+            yield json.dumps(definition) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@app.route('/setup/<token>/import', methods=['POST'])
+def setup_import(token):
+    """
+    ### Import
+    Import mock paths from an export.
+
+    Reads newline delimited JSON, one path definition per line with the same fields as [Setup](#setup), and creates
+    or replaces all of them in a single transaction. With `replace=1` the paths of the token that are not in the
+    input are removed, restoring the exact set that was exported. Then any invalid line fails the whole import with
+    a `400` listing the errors, and the token keeps its paths.
+
+        POST /setup/:token/import?replace=1
+        Content-Type: application/x-ndjson
+
+    ###### Example Response
+
+        < HTTP/1.1 200 OK
+        < Content-Type: application/json
+
+        {
+            "message": "ok",
+            "imported": 1,
+            "errors": [
+                {"line": 2, "message": "Missing required field: status_code"}
+            ]
+        }
+    """
+
+    if not storage.has_token(token):
+        abort(404, 'Invalid token')
+
+    replace = request.args.get('replace') in ('1', 'true')
+    imported, errors = import_paths(token, request.stream, replace=replace, max_paths=app.config['MOCK_MAX_PATHS'])
+    if replace and errors:
+        resp = jsonify(message='Invalid lines, nothing imported', imported=0, errors=errors)
+        resp.status_code = 400
+        return resp
+    return jsonify(message='ok', imported=imported, errors=errors)
+
+
+@app.route('/setup/<token>/requests', methods=['GET'])
+def setup_requests(token):
+    """
+    ### Requests
+    List the last requests made to the mock paths of a token.
+
+    Only available when the server records requests (`MOCK_RECORD_REQUESTS`). The last 100 requests of each token are
+    kept, `dropped` counts the older ones that are no longer available. Requests are listed oldest first, pass the
+    returned `cursor` to get only newer ones, so polling returns each request once.
+
+        GET /setup/:token/requests?cursor=0&limit=100
+
+    ###### Example Response
+
+        < HTTP/1.1 200 OK
+        < Content-Type: application/json
+
+        {
+            "cursor": 1042,
+            "dropped": 0,
+            "requests": [
+                {
+                    "id": 1042,
+                    "method": "POST",
+                    "path": "login/",
+                    "query": "",
+                    "headers": {"Content-Type": "application/json", "Host": "mom.skmobi.com"},
+                    "body": "{\"user\": \"fopina\"}",
+                    "matched": "login/",
+                    "status_code": 400,
+                    "latency": 1.2,
+                    "created_on": "2016-05-21T10:31:48"
+                }
+            ]
+        }
+    """
+
+    if not storage.has_token(token):
+        abort(404, 'Invalid token')
+
+    cursor = request.args.get('cursor', 0, type=int)
+    limit = max(1, min(request.args.get('limit', 100, type=int), 1000))
+    requests, dropped = storage.get_requests(token, cursor, limit)
+    return jsonify(
+        cursor=requests[-1]['id'] if requests else cursor,
+        dropped=dropped,
+        requests=requests,
+    )
+
+
+def export_paths(token, batch_size=500):
+    """Yield the path definitions of `token`, loading `batch_size` paths at a time"""
+    return storage.export_paths(token, batch_size)
+
+
+def import_paths(token, lines, replace=False, batch_size=500, max_paths=None):
+    """
+    Create or replace paths of `token` from an iterable of JSON lines,
+    saving `batch_size` of them at a time, and commit, unless that leaves
+    it with more than `max_paths` paths. With `replace`, nothing is
+    committed (the existing paths are kept) if any line failed.
+    Returns the number of paths imported and the lines that failed.
+    """
+    if replace:
+        delete_paths(token)
+
+    imported = 0
+    errors = []
+    batch = []
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+            if type(data) != dict:
+                raise ValueError('Invalid path definition')
+            batch.append(path_fields(data))
+        except KeyError as e:
+            errors.append(dict(line=number, message='Missing required field: %s' % e.args[0]))
+        except ValueError as e:
+            errors.append(dict(line=number, message=str(e)))
+        if len(batch) >= batch_size:
+            check_path_quota(token, [fields['path'] for fields in batch], max_paths)
+            save_paths(token, batch)
+            imported += len(batch)
+            batch = []
+    if replace and errors:
+        storage.rollback()
+        return 0, errors
+    check_path_quota(token, [fields['path'] for fields in batch], max_paths)
+    save_paths(token, batch)
+    imported += len(batch)
+    storage.commit()
+    invalidate(token)
+    counters.reset(token)
+    return imported, errors
+
+
+def delete_paths(token):
+    """Remove every path of `token`, without committing"""
+    storage.delete_paths(token)
+
+
+def path_fields(data):
+    """
+    Validate a path definition as given to `setup` and return the
+    `MockPath` columns to store. Raises `KeyError` for missing fields
+    and `ValueError` for invalid ones.
+    """
+    path = data['path']
+    if not isinstance(path, basestring):
+        raise ValueError('Invalid path')
+    if path.startswith('/'):
+        path = path[1:]
+    if not path:
+        raise ValueError('Invalid path')
+    status_code = data['status_code']
+    content_type = data['content_type']
+    custom_headers = data.get('custom_headers')
+    if type(custom_headers) != dict:
+        custom_headers = {}
+    variants = data.get('variants')
+    if variants is not None:
+        if type(variants) != list:
+            raise ValueError('Invalid variants')
+        variants = json.dumps([variant_fields(variant, status_code, content_type) for variant in variants])
+    custom_headers = dict((name, unicode(value)) for name, value in custom_headers.iteritems())
+    body, body_file = body_fields(data)
+    sequence = sequence_fields(data, status_code, content_type)
+    template = bool(data.get('template'))
+    if template:
+        check_templates(custom_headers, body, body_file)
+        for response in json.loads(variants or '[]') + (json.loads(sequence)['responses'] if sequence else []):
+            check_templates(response['custom_headers'], response['body'], response['body_file'])
+    return dict(
+        path=path,
+        status_code=status_code,
+        content_type=content_type,
+        body=body,
+        body_file=body_file,
+        etag=response_etag(status_code, content_type, custom_headers, body, body_file),
+        updated_on=datetime.datetime.utcnow(),
+        headers_json=MockPath.encode_headers(custom_headers),
+        is_pattern=is_pattern(path),
+        variants_json=variants,
+        chaos_json=chaos_fields(data),
+        template=template,
+        sequence_json=sequence,
+    )
+
+
+def check_templates(custom_headers, body, body_file):
+    """Compile the templates of a response, raising `ValueError` if any is invalid"""
+    try:
+        if body_file is not None:
+            body = body_store.get(body_file).decode('utf-8')
+        for source in [body or u''] + custom_headers.values():
+            compile_template(source)
+    except (TemplateError, UnicodeDecodeError) as e:
+        raise ValueError('Invalid template: %s' % e)
+
+
+def chaos_fields(data):
+    chaos = data.get('chaos')
+    if chaos is None:
+        return None
+    if type(chaos) != dict:
+        raise ValueError('Invalid chaos')
+    Chaos.from_dict(chaos)
+    return json.dumps(chaos)
+
+
+def sequence_fields(data, status_code, content_type):
+    """The `sequence` of a definition as stored, responses are validated like variants"""
+    sequence = data.get('sequence')
+    if sequence is None:
+        return None
+    if type(sequence) != dict or type(sequence.get('responses')) != list or not sequence['responses']:
+        raise ValueError('Invalid sequence')
+    mode = sequence.get('mode', 'last')
+    if mode not in ('last', 'cycle'):
+        raise ValueError('Invalid sequence mode')
+    responses = []
+    for response in sequence['responses']:
+        if type(response) != dict:
+            raise ValueError('Invalid sequence response')
+        responses.append(response_fields(response, status_code, content_type))
+    return json.dumps(dict(mode=mode, responses=responses))
+
+
+def variant_fields(data, status_code, content_type):
+    """
+    Validate a response variant as given to `setup`, missing status code
+    and content type are those of the path
+    """
+    if type(data) != dict:
+        raise ValueError('Invalid variant')
+    match = data.get('match') or {}
+    if type(match) != dict:
+        raise ValueError('Invalid variant match')
+    method = match.get('method')
+    if method is not None:
+        if not isinstance(method, basestring):
+            raise ValueError('Invalid variant match')
+        method = method.upper()
+    conditions = {}
+    for kind in ('query', 'headers'):
+        values = match.get(kind) or {}
+        if type(values) != dict:
+            raise ValueError('Invalid variant match')
+        conditions[kind] = dict((name, unicode(value)) for name, value in values.iteritems())
+    return dict(
+        response_fields(data, status_code, content_type),
+        match=dict(method=method, query=conditions['query'], headers=conditions['headers']),
+    )
+
+
+def response_fields(data, status_code, content_type):
+    """The response of a variant or sequence entry, missing status code and content type are those of the path"""
+    custom_headers = data.get('custom_headers')
+    if type(custom_headers) != dict:
+        custom_headers = {}
+    custom_headers = dict((name, unicode(value)) for name, value in custom_headers.iteritems())
+    status_code = data.get('status_code', status_code)
+    content_type = data.get('content_type', content_type)
+    body, body_file = body_fields(data)
+    return dict(
+        status_code=status_code,
+        content_type=content_type,
+        custom_headers=custom_headers,
+        body=body,
+        body_file=body_file,
+        etag=response_etag(status_code, content_type, custom_headers, body, body_file),
+    )
+
+
+BASE64_RE = re.compile(r'^[A-Za-z0-9+/\s]*=?=?\s*$')
+
+
+def body_fields(data):
+    """
+    The `body` and `body_file` to store for the `body` (text) or
+    `body_base64` (binary) of a definition: binary and large bodies go
+    to `body_store`, others are kept inline. Without `MOCK_BODY_STORE`
+    set (the default one is in the temporary directory, which may not
+    outlive the process) text bodies are always kept inline and binary
+    ones are refused.
+    """
+    if data.get('body_base64') is not None:
+        encoded = data['body_base64']
+        if not isinstance(encoded, basestring) or not BASE64_RE.match(encoded):
+            raise ValueError('Invalid body_base64')
+        if app.config['MOCK_BODY_STORE'] is None:
+            raise ValueError('Binary bodies are not supported on this server, MOCK_BODY_STORE is not set')
+        try:
+            return None, body_store.put(base64.b64decode(encoded))
+        except TypeError:
+            raise ValueError('Invalid body_base64')
+    body = data.get('body')
+    if (
+        isinstance(body, basestring) and len(body) > app.config['MOCK_INLINE_BODY_SIZE'] and
+        app.config['MOCK_BODY_STORE'] is not None
+    ):
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        return None, body_store.put(body)
+    return body, None
+
+
+def path_urls(token, path):
+    return dict(
+        path_url='%smock/%s/%s' % (request.url_root, token, path),
+        path_secure_url='%smock/%s/%s' % (request.url_root.replace('http://', 'https://'), token, path),
+    )
+
+
+def save_paths(token, definitions):
+    """Create or replace the paths of `token` from `path_fields` results, without committing"""
+    storage.save_paths(token, definitions)
+
+
+@app.route('/mock/<token>/<path:path>', methods=['GET', 'POST', 'PUT', 'PATCH', 'DELETE'])
+def use_api(token, path):
+    """
+    ### Mock
+    Your mock API base URL.
+
+    This is your mock API "new" base URL. All the mock API paths you setup are available under `/mock/:token/` for `GET`, `POST`, `PUT`, `PATCH` and `DELETE` methods.
+    Responses with status 200 include `ETag` and `Last-Modified` headers (unless the mock sets its own), so clients
+    sending `If-None-Match` or `If-Modified-Since` get a `304 Not Modified` until the path is setup again.
+    Text bodies of 1KB or more are sent compressed (`Content-Encoding: gzip`, or `br` when the
+    [brotli](https://pypi.python.org/pypi/Brotli) package is installed) to clients that accept it, unless the mock sets
+    its own `Content-Encoding`.
+    Example (using token and path created in `register`and `setup`section examples):
+
+        $ curl -v https://mom.skmobi.com/mock/MeB3aNo4yDXrtNH6/login/
+        < HTTP/1.1 400 BAD REQUEST
+        < Content-Type: application/json
+        < Content-Length: 25
+        <
+        {"code": "invalid_login"}
+    """
+    g.mock_started = time.time()
+    compiled = response_cache.get(token, path)
+
+    if compiled is None:
+        stamp = response_cache.stamp(token, path)
+        ttl = None
+        if replica_storage is None:
+            pt, params = find_path(storage, token, path)
+        else:
+            pt, params = find_path(replica_storage, token, path)
+            if pt is None:
+                # not replicated yet, or not there at all
+                pt, params = find_path(storage, token, path)
+            else:
+                # the replica may still be catching up on a change
+                ttl = app.config['MOCK_REPLICA_CACHE_TTL']
+
+        if pt is None:
+            upstream = storage.get_upstream(token) if app.config['MOCK_PROXY'] else None
+            if upstream is None:
+                # only requests to existing tokens are recorded
+                if app.config['MOCK_RECORD_REQUESTS'] and storage.has_token(token):
+                    g.mock_token = token
+                abort(404, 'Method not found')
+            g.mock_token = token
+            return proxy(token, path, upstream, stamp)
+
+        compiled = CompiledMock.from_path(pt, params)
+        response_cache.put(token, path, compiled, stamp, ttl)
+
+    g.mock_token = token
+    g.mock_path = compiled.path
+    g.mock_params = compiled.params
+    if compiled.chaos is not None:
+        return compiled.chaos.serve(compiled.select(request))
+    return compiled.select(request).to_response()
+
+
+# hop-by-hop headers, RFC 2616 section 13.5.1
+HOP_BY_HOP_HEADERS = frozenset([
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailers', 'transfer-encoding',
+    'upgrade',
+])
+# not sent upstream, the upstream connection sets its own and recorded bodies should not be compressed
+PROXY_SKIP_REQUEST_HEADERS = HOP_BY_HOP_HEADERS | frozenset(['host', 'content-length', 'accept-encoding'])
+# not recorded, a mock sets its own
+PROXY_SKIP_RESPONSE_HEADERS = HOP_BY_HOP_HEADERS | frozenset(['content-length', 'content-type', 'date'])
+
+
+class UpstreamRefused(socket.error):
+    pass
+
+
+# (first address, prefix length) of the networks upstreams cannot be on
+PRIVATE_NETWORKS = {
+    socket.AF_INET: [
+        ('0.0.0.0', 8), ('10.0.0.0', 8), ('100.64.0.0', 10), ('127.0.0.0', 8), ('169.254.0.0', 16),
+        ('172.16.0.0', 12), ('192.0.0.0', 24), ('192.168.0.0', 16), ('198.18.0.0', 15), ('224.0.0.0', 3),
+    ],
+    socket.AF_INET6: [('::', 127), ('fc00::', 7), ('fe80::', 10), ('ff00::', 8)],
+}
+
+
+def address_number(family, address):
+    return int(binascii.hexlify(socket.inet_pton(family, address)), 16)
+
+
+def is_private_address(address):
+    """Whether `address` is a loopback, private, link-local, multicast or reserved IPv4 or IPv6 address"""
+    address = address.split('%', 1)[0]
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    number = address_number(family, address)
+    bits = 128 if family == socket.AF_INET6 else 32
+    if family == socket.AF_INET6 and number >> 32 == 0xffff:
+        # IPv4 mapped
+        family, number, bits = socket.AF_INET, number & 0xffffffff, 32
+    for network, prefix in PRIVATE_NETWORKS[family]:
+        if number >> (bits - prefix) == address_number(family, network) >> (bits - prefix):
+            return True
+    return False
+
+
+class UpstreamPool(object):
+    """
+    Keep-alive HTTP connections to proxy upstreams: after a response up
+    to `size` idle connections per host are kept for the next requests
+    instead of connecting again.
+
+    Unless `allow_private`, a new connection is refused if its host
+    resolves to a private address (`is_private_address`), and is then
+    made to the very address that was checked.
+    """
+    IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+
+    def __init__(self, size=10, timeout=10, allow_private=False):
+        self.size = size
+        self.timeout = timeout
+        self.allow_private = allow_private
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def address(self, host, port):
+        """The address to connect to for `host`, raises `UpstreamRefused` if it is not allowed"""
+        addresses = [sockaddr[0] for _, _, _, _, sockaddr in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)]
+        if not self.allow_private and any(is_private_address(address) for address in addresses):
+            raise UpstreamRefused('Upstream address not allowed: %s' % host)
+        return addresses[0]
+
+    def _connect(self, parts):
+        connection_class = httplib.HTTPSConnection if parts.scheme == 'https' else httplib.HTTPConnection
+        conn = connection_class(parts.netloc, timeout=self.timeout)
+        address = self.address(conn.host, conn.port)
+        create_connection = conn._create_connection
+        # Host and TLS server name stay those of the URL
+        conn._create_connection = lambda host_port, *args: create_connection((address, host_port[1]), *args)
+        return conn
+
+    def _checkout(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            return idle.pop() if idle else None
+
+    def _checkin(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """Close the idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.itervalues():
+            for conn in connections:
+                conn.close()
+
+    def request(self, method, url, headers, body=None):
+        """Send a request to `url`, returns the response status, headers (as a list) and body"""
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        target = urlparse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        conn = self._checkout(key)
+        reused = conn is not None
+        while True:
+            if conn is None:
+                conn = self._connect(parts)
+            try:
+                conn.request(method, target, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if not reused or method not in self.IDEMPOTENT_METHODS:
+                    raise
+                # the upstream closed the idle connection, try once more on a new one
+                conn, reused = None, False
+                continue
+            break
+        if response.will_close:
+            conn.close()
+        else:
+            self._checkin(key, conn)
+        return response.status, response.getheaders(), data
+
+
+class SingleFlight(object):
+    """
+    Calls with the same key that overlap run only once: the first caller
+    runs the function and the others wait for its result (or exception).
+    """
+
+    class Call(object):
+        __slots__ = ('done', 'result', 'error')
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self.Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = function()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class BackgroundWriter(object):
+    """
+    Base of the objects requests hand their writes to: `start` runs a
+    thread calling `write` (`flush` unless overridden) every `interval`
+    seconds in an app context, logging `failure` if it raises. With an
+    `interval` of None there is no thread, call `flush` instead.
+    """
+
+    failure = 'Background write failed'
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        """
+        Start the background thread of this process, unless it runs
+        already. Once per process, threads do not survive gunicorn forking
+        workers.
+        """
+        if self.interval is None or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        thread = threading.Thread(target=self._run, name=self.__class__.__name__)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                with app.app_context():
+                    self.write()
+            except Exception:
+                app.logger.exception(self.failure)
+
+    def write(self):
+        self.flush()
+
+    def flush(self):
+        raise NotImplementedError
+
+
+class PathRecorder(BackgroundWriter):
+    """
+    Saves the paths recorded by the proxy.
+
+    `record` only queues the definition, a background thread saves the
+    queue every `interval` seconds in one transaction, skipping paths set
+    up in the meantime. With an `interval` of None there is no thread,
+    call `flush` instead.
+    """
+
+    failure = 'Failed to save recorded paths'
+
+    def __init__(self, interval=0.5):
+        super(PathRecorder, self).__init__(interval)
+        self._pending = OrderedDict()
+
+    def record(self, token, fields):
+        with self._lock:
+            self._pending[token, fields['path']] = fields
+        self.start()
+
+    def flush(self):
+        """Save the queued paths, returns how many"""
+        with self._lock:
+            pending, self._pending = self._pending, OrderedDict()
+        saved = [
+            (token, fields) for (token, path), fields in pending.iteritems() if storage.get_path(token, path) is None
+        ]
+        if not saved:
+            return 0
+        tokens = OrderedDict()
+        for token, fields in saved:
+            tokens.setdefault(token, []).append(fields)
+        for token, definitions in tokens.iteritems():
+            storage.save_paths(token, definitions)
+        storage.commit()
+        for token, fields in saved:
+            invalidate(token, fields['path'])
+        return len(saved)
+
+
+def proxy(token, path, upstream, stamp=None):
+    """
+    Forward the current request, which no path of `token` matched, to
+    its `upstream`. Successful GET responses are recorded as paths and
+    served from the cache until saved: concurrent misses of the same
+    path share a single upstream request.
+    """
+    url = upstream + path
+    if request.query_string:
+        url += '?' + request.query_string
+    headers = dict(
+        (name, value) for name, value in request.headers.items() if name.lower() not in PROXY_SKIP_REQUEST_HEADERS
+    )
+
+    def forward():
+        return upstream_pool.request(request.method, url, headers, request.get_data() or None)
+
+    def fetch():
+        status_code, response_headers, data = forward()
+        if status_code >= 500:
+            return status_code, response_headers, data
+        definition = dict(
+            path=path,
+            status_code=status_code,
+            content_type=dict(response_headers).get('content-type', 'application/octet-stream'),
+            custom_headers=dict(
+                (name.title(), value) for name, value in response_headers
+                if name not in PROXY_SKIP_RESPONSE_HEADERS
+            ),
+        )
+        try:
+            definition['body'] = data.decode('utf-8')
+        except UnicodeDecodeError:
+            definition['body_base64'] = base64.b64encode(data)
+        fields = path_fields(definition)
+        path_recorder.record(token, fields)
+        compiled = CompiledMock.from_path(MemoryPath(None, token, fields))
+        response_cache.put(token, path, compiled, stamp)
+        return compiled
+
+    try:
+        if request.method == 'GET':
+            result = single_flight.do((token, path), fetch)
+        else:
+            result = forward()
+    except UpstreamRefused as e:
+        abort(403, str(e))
+    except (httplib.HTTPException, socket.error) as e:
+        abort(502, 'Upstream failed: %s' % (str(e) or e.__class__.__name__))
+
+    if isinstance(result, CompiledMock):
+        g.mock_path = path
+        return result.select(request).to_response()
+    status_code, response_headers, data = result
+    return Response(data, status_code, [
+        (name, value) for name, value in response_headers if name not in HOP_BY_HOP_HEADERS | set(['content-length'])
+    ])
+
+
+class RequestRecorder(BackgroundWriter):
+    """
+    Keeps the last `limit` requests of each token in `storage`.
+
+    `record` only appends to a bounded in-memory queue, a background
+    thread writes the queue every `interval` seconds in one batch and
+    trims each token back to `limit` rows. Requests that do not fit in
+    the queue, and those trimmed, are counted in `requests_dropped`.
+    With an `interval` of None there is no thread, call `flush` instead.
+    """
+
+    failure = 'Failed to write recorded requests'
+
+    def __init__(self, limit=100, queue_size=10000, interval=0.5, body_size=65536):
+        super(RequestRecorder, self).__init__(interval)
+        self.limit = limit
+        self.queue_size = queue_size
+        self.body_size = body_size
+        self._pending = []
+        self._dropped = {}
+
+    def record(self, entry):
+        with self._lock:
+            if len(self._pending) < self.queue_size:
+                self._pending.append(entry)
+            else:
+                self._dropped[entry['token_id']] = self._dropped.get(entry['token_id'], 0) + 1
+        self.start()
+
+    def flush(self):
+        """Write the queued requests, returns how many"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+            dropped, self._dropped = self._dropped, {}
+        if not pending and not dropped:
+            return 0
+        return storage.add_requests(pending, dropped, self.limit)
+
+
+@app.after_request
+def record_request(resp):
+    if request.endpoint == 'use_api' and app.config['MOCK_RECORD_REQUESTS'] and 'mock_token' in g:
+        recorder.record(dict(
+            token_id=request.view_args['token'],
+            method=request.method,
+            path=request.view_args['path'],
+            query_string=request.query_string.decode('utf-8', 'replace'),
+            headers=json.dumps(dict(request.headers)),
+            body=request.get_data()[:recorder.body_size].decode('utf-8', 'replace'),
+            matched=getattr(g, 'mock_path', None),
+            status_code=resp.status_code,
+            latency=(time.time() - g.mock_started) * 1000,
+            created_on=datetime.datetime.utcnow(),
+        ))
+    return resp
+
+
+class TokenExpiry(BackgroundWriter):
+    """
+    Keeps `mock_token.last_used` up to date and purges expired tokens.
+
+    With `track_last_use`, `touch` notes the token in memory, at most once
+    per `resolution` seconds, so serving requests causes no writes.
+    Otherwise it does nothing, expiry only depends on creation. `start`
+    runs a background thread in each worker that stores the noted tokens
+    every `interval` seconds with a single UPDATE and, if
+    `purge_interval` is set, calls `purge_tokens` and `purge_bodies`
+    that often. Only the process holding the lock on `lock_file` purges,
+    the others take over if it exits. With an `interval` of None there is
+    no thread, call `flush` instead.
+    """
+
+    failure = 'Failed to expire tokens'
+
+    def __init__(self, interval=10, resolution=60, purge_interval=None, track_last_use=False, lock_file=None):
+        super(TokenExpiry, self).__init__(interval)
+        self.resolution = resolution
+        self.purge_interval = purge_interval
+        self.track_last_use = track_last_use
+        self.lock_file = lock_file
+        self._touched = set()
+        self._noted = {}
+        self._last_purge = time.time()
+        self._lock_pid = None
+
+    def touch(self, token):
+        if not self.track_last_use:
+            return
+        now = time.time()
+        if self._noted.get(token, 0) > now - self.resolution:
+            return
+        with self._lock:
+            self._noted[token] = now
+            self._touched.add(token)
+
+    def start(self):
+        """Start the background thread of this process, if there is anything for it to do"""
+        if self.track_last_use or self.purge_interval is not None:
+            super(TokenExpiry, self).start()
+
+    def write(self):
+        self.flush()
+        if self.purge_interval is not None and time.time() - self._last_purge >= self.purge_interval:
+            self._last_purge = time.time()
+            if self.acquire():
+                purge_tokens()
+                purge_bodies()
+
+    def acquire(self):
+        """
+        Whether this process is the one purging: the first to lock
+        `lock_file` keeps it until it exits. Always, without a `lock_file`.
+        """
+        if self.lock_file is None or self._lock_pid == os.getpid():
+            return True
+        import fcntl
+        fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(fd)
+            return False
+        # left open, closing it would release the lock
+        self._lock_pid = os.getpid()
+        return True
+
+    def flush(self):
+        """Write the last use of the noted tokens, returns how many"""
+        with self._lock:
+            touched, self._touched = sorted(self._touched), set()
+            forget = time.time() - self.resolution
+            self._noted = dict((token, at) for token, at in self._noted.iteritems() if at > forget)
+        if touched:
+            storage.touch_tokens(touched)
+        return len(touched)
+
+
+@app.after_request
+def touch_token(resp):
+    if request.view_args and 'token' in request.view_args and resp.status_code < 400:
+        expiry.touch(request.view_args['token'])
+    return resp
+
+
+@app.teardown_appcontext
+def reset_storage(exc):
+    # drop whatever a failed request saved without committing
+    storage.rollback()
+
+
+def find_path(store, token, path):
+    """The path of `token` in `store` serving `path`, with the parameters of the pattern it matched, if any"""
+    pt = store.get_path(token, path)
+    if pt is not None:
+        return pt, None
+    pattern, params = pattern_index(token).match(path)
+    if pattern is None:
+        return None, None
+    return store.get_path(token, pattern), params
+
+
+def pattern_index(token):
+    """The `PatternIndex` of `token`, built from the database on first use"""
+    index = pattern_cache.get(token, '')
+    if index is None:
+        stamp = pattern_cache.stamp(token, '')
+        index = PatternIndex(storage.pattern_paths(token))
+        pattern_cache.put(token, '', index, stamp)
+    return index
+
+
+def purge_tokens(keep_days=None, batch_size=None):
+    """
+    Delete the tokens not created (or, with MOCK_EXPIRE_ON_LAST_USE, not
+    used) in the last `keep_days`, with their paths, headers and recorded
+    requests. Works through `batch_size` tokens per transaction so no
+    table stays locked for long. Returns the number of tokens deleted.
+    """
+    if keep_days is None:
+        keep_days = app.config['MOCK_EXPIRE_DAYS']
+    if batch_size is None:
+        batch_size = app.config['MOCK_PURGE_BATCH_SIZE']
+    last_date = datetime.datetime.now() - datetime.timedelta(days=keep_days)
+    column = 'last_used' if app.config['MOCK_EXPIRE_ON_LAST_USE'] else 'created_on'
+    purged = 0
+    while True:
+        tokens = storage.expired_tokens(column, last_date, batch_size)
+        if not tokens:
+            break
+        storage.delete_tokens(tokens)
+        for token in tokens:
+            invalidate(token)
+        counters.purge(tokens)
+        purged += len(tokens)
+    return purged
+
+
+def purge_bodies():
+    """Remove the `body_store` files no path refers to anymore"""
+    return body_store.purge(storage.body_files())
+
+
+def missing_columns():
+    """
+    The `table.column` names the models use but the database does not
+    have yet, or has with a shorter type, as after deploying a new
+    version before `migrate_db`. Queries on such a table fail until then,
+    so `./manage.py serve` and the gunicorn master refuse to start.
+    Always empty with memory storage.
+    """
+    if app.config['MOCK_STORAGE'] != 'sqlalchemy':
+        return []
+    inspector = db.inspect(db.engine)
+    tables = inspector.get_table_names()
+    missing = []
+    for table in db.metadata.sorted_tables:
+        existing = [c['name'] for c in inspector.get_columns(table.name)] if table.name in tables else []
+        missing.extend('%s.%s' % (table.name, column.name) for column in table.columns if column.name not in existing)
+        if table.name in tables:
+            missing.extend('%s.%s' % (table.name, column.name) for column in shorter_columns(inspector, table))
+    return missing
+
+
+def shorter_columns(inspector, table):
+    """
+    The `Text` columns of `table` the database still has as a limited
+    `VARCHAR`, such as `mock_path.body` (500 characters before bodies over
+    that were kept in the database). SQLite does not enforce lengths.
+    """
+    if db.engine.dialect.name == 'sqlite':
+        return []
+    lengths = dict((c['name'], getattr(c['type'], 'length', None)) for c in inspector.get_columns(table.name))
+    return [
+        column for column in table.columns
+        if isinstance(column.type, db.Text) and lengths.get(column.name) is not None
+    ]
+
+
+def migrate_db():
+    """
+    Bring a database created by an older version up to date: add the
+    missing tables, columns and indexes and move data into them.
+    Returns the number of paths whose custom headers were migrated.
+    """
+    db.create_all()
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = [c['name'] for c in inspector.get_columns(table.name)]
+        for column in table.columns:
+            if column.name not in existing:
+                db.session.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                    table.name, column.name, column.type.compile(dialect=db.engine.dialect)
+                ))
+        for column in shorter_columns(inspector, table):
+            if db.engine.dialect.name == 'mysql':
+                statement = 'ALTER TABLE %s MODIFY %s %s'
+            else:
+                statement = 'ALTER TABLE %s ALTER COLUMN %s TYPE %s'
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            db.session.execute(statement % (table.name, column.name, column_type))
+        existing = [i['name'] for i in inspector.get_indexes(table.name)]
+        db.session.commit()
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(db.engine)
+
+    db.session.query(MockToken).filter(MockToken.last_used.is_(None)).update({
+        MockToken.last_used: MockToken.created_on,
+    }, synchronize_session=False)
+    db.session.query(MockPath).filter(MockPath.is_pattern.is_(None)).update({
+        MockPath.is_pattern: MockPath.path.contains('{') | MockPath.path.contains('*'),
+    }, synchronize_session=False)
+    db.session.commit()
+    return migrate_headers()
+
+
+def migrate_headers(batch_size=500):
+    """
+    Move custom headers from `mock_header` rows into `mock_path.headers_json`.
+    Returns the number of paths migrated.
+    """
+    migrated = 0
+    while True:
+        paths = db.session.query(MockPath).filter(MockPath.headers_json.is_(None)).limit(batch_size).all()
+        if not paths:
+            break
+        path_ids = [pt.id for pt in paths]
+        custom_headers = dict((path_id, {}) for path_id in path_ids)
+        for header in db.session.query(MockHeader).filter(MockHeader.path_id.in_(path_ids)):
+            custom_headers[header.path_id][header.name] = header.value
+        for pt in paths:
+            pt.set_custom_headers(custom_headers[pt.id])
+        db.session.query(MockHeader).filter(MockHeader.path_id.in_(path_ids)).delete(synchronize_session=False)
+        db.session.commit()
+        migrated += len(paths)
+    return migrated
+
+
+def path_responses(pt):
+    """The responses of the variants and sequence of a path, as stored"""
+    responses = json.loads(pt.variants_json) if pt.variants_json is not None else []
+    if pt.sequence_json is not None:
+        responses.extend(json.loads(pt.sequence_json)['responses'])
+    return responses
+
+
+def response_definition(response):
+    """A stored variant or sequence response as `setup` input"""
+    response.pop('etag', None)
+    body_file = response.pop('body_file', None)
+    if body_file is not None:
+        response['body_base64'] = base64.b64encode(body_store.get(body_file))
+    return response
+
+
+class PathMixin(object):
+    """What `MockPath` and `MemoryPath` share, on top of their `PATH_FIELDS` attributes"""
+    __slots__ = ()
+
+    def custom_headers(self):
+        return json.loads(self.headers_json)
+
+    def variants(self):
+        if self.variants_json is None:
+            return []
+        return json.loads(self.variants_json)
+
+    def definition(self):
+        """This path as `setup` input"""
+        definition = dict(
+            path=self.path,
+            status_code=self.status_code,
+            content_type=self.content_type,
+            custom_headers=self.custom_headers(),
+            body=self.body,
+        )
+        if self.body_file is not None:
+            definition['body_base64'] = base64.b64encode(body_store.get(self.body_file))
+        if self.chaos_json is not None:
+            definition['chaos'] = json.loads(self.chaos_json)
+        if self.template:
+            definition['template'] = True
+        if self.variants_json is not None:
+            definition['variants'] = [response_definition(variant) for variant in self.variants()]
+        if self.sequence_json is not None:
+            sequence = json.loads(self.sequence_json)
+            sequence['responses'] = [response_definition(response) for response in sequence['responses']]
+            definition['sequence'] = sequence
+        return definition
+
+
+class MockToken(db.Model):
+    __table_args__ = (
+        db.Index('_token_created_ix', 'created_on'),
+        db.Index('_token_last_used_ix', 'last_used'),
+    )
+
+    token = db.Column(db.String(16), primary_key=True)
+    created_on = db.Column(db.DateTime, server_default=db.func.now())
+    # set by the client rather than the server so it also works on migrated tables
+    last_used = db.Column(db.DateTime, default=db.func.now())
+    requests_dropped = db.Column(db.Integer)
+    upstream = db.Column(db.String(255))
+
+    def __init__(self, token=None):
+        self.token = token
+
+    def __repr__(self):
+        return '<MockToken %r>' % (self.token)
+
+
+class MockPath(PathMixin, db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('path', 'token_id', name='_path_token_uc'),
+        db.Index('_token_path_ix', 'token_id', 'path'),
+        db.Index('_token_pattern_ix', 'token_id', 'is_pattern'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    token_id = db.Column(db.String(16), db.ForeignKey('mock_token.token'), nullable=False)
+    path = db.Column(db.String(200), nullable=False)
+    status_code = db.Column(db.Integer, nullable=False)
+    content_type = db.Column(db.String(100), nullable=False)
+    body = db.Column(db.Text)
+    body_file = db.Column(db.String(64))
+    etag = db.Column(db.String(32))
+    updated_on = db.Column(db.DateTime)
+    headers_json = db.Column(db.Text)
+    is_pattern = db.Column(db.Boolean, default=False)
+    variants_json = db.Column(db.Text)
+    chaos_json = db.Column(db.Text)
+    template = db.Column(db.Boolean, default=False)
+    sequence_json = db.Column(db.Text)
+
+    token = db.relationship('MockToken', backref=db.backref('paths', lazy='dynamic'))
+
+    def __init__(self, token, path):
+        self.token_id = token
+        self.path = path
+
+    def custom_headers(self):
+        """
+        Custom headers as a dictionary, from `headers_json` or, for paths
+        not yet migrated, from their `MockHeader` rows
+        """
+        if self.headers_json is not None:
+            return json.loads(self.headers_json)
+        return dict((header.name, header.value) for header in self.headers.all())
+
+    def set_custom_headers(self, custom_headers):
+        self.headers_json = self.encode_headers(custom_headers)
+
+    @staticmethod
+    def encode_headers(custom_headers):
+        return json.dumps(dict(
+            (name, unicode(value)) for name, value in custom_headers.iteritems()
+        ))
+
+
+class MockHeader(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('path_id', 'name', name='_path_name_uc'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    path_id = db.Column(db.Integer, db.ForeignKey('mock_path.id'), nullable=False, index=True)
+    name = db.Column(db.String(100), nullable=False)
+    value = db.Column(db.String(100), nullable=False)
+
+    path = db.relationship('MockPath', backref=db.backref('headers', lazy='dynamic'))
+
+    def __init__(self, path_id, name, value):
+        self.path_id = path_id
+        self.name = name
+        self.value = value
+
+
+class MockRequest(db.Model):
+    __table_args__ = (
+        db.Index('_token_request_ix', 'token_id', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    token_id = db.Column(db.String(16), db.ForeignKey('mock_token.token'), nullable=False)
+    method = db.Column(db.String(10), nullable=False)
+    path = db.Column(db.Text, nullable=False)
+    query_string = db.Column(db.Text)
+    headers = db.Column(db.Text)
+    body = db.Column(db.Text)
+    matched = db.Column(db.String(200))
+    status_code = db.Column(db.Integer)
+    latency = db.Column(db.Float)
+    created_on = db.Column(db.DateTime)
+
+    def to_dict(self):
+        return dict(
+            id=self.id,
+            method=self.method,
+            path=self.path,
+            query=self.query_string,
+            headers=json.loads(self.headers),
+            body=self.body,
+            matched=self.matched,
+            status_code=self.status_code,
+            latency=self.latency,
+            created_on=self.created_on.isoformat(),
+        )
+
+
+sql_bakery = baked.bakery()
+
+
+class ReplicaSession(orm.Session):
+    """A session on the `replica` bind of `SQLALCHEMY_BINDS`, for lookups that can lag behind a little"""
+
+    def __init__(self, **options):
+        orm.Session.__init__(self, bind=db.get_engine(app, 'replica'), **options)
+
+
+replica_session = orm.scoped_session(ReplicaSession, scopefunc=_app_ctx_stack.__ident_func__)
+
+
+@app.teardown_appcontext
+def remove_replica_session(response_or_exc):
+    replica_session.remove()
+    return response_or_exc
+
+
+def pool_stats():
+    """Size, checked out and overflow connections of every database with a `QueuePool`, by bind"""
+    stats = {}
+    for bind in [None] + list(app.config['SQLALCHEMY_BINDS'] or ()):
+        pool = db.get_engine(app, bind).pool
+        if isinstance(pool, QueuePool):
+            stats[bind or 'primary'] = (pool.size(), pool.checkedout(), max(pool.overflow(), 0))
+    return stats
+
+
+PATH_FIELDS = (
+    'path', 'status_code', 'content_type', 'body', 'body_file', 'etag', 'updated_on', 'headers_json', 'is_pattern',
+    'variants_json', 'chaos_json', 'template', 'sequence_json',
+)
+
+
+class SQLStorage(object):
+    """
+    Tokens and paths in the SQLAlchemy models, the default `MOCK_STORAGE`.
+
+    Path changes stay in the session until `commit`, the other writes
+    commit straight away. Given a `session`, such as `replica_session`,
+    it works on that one instead of `db.session`.
+    """
+
+    def __init__(self, session=None):
+        self.session = db.session if session is None else session
+
+    def has_token(self, token):
+        return self.session.query(MockToken.token).filter_by(token=token).first() is not None
+
+    def add_tokens(self, tokens):
+        """Insert new tokens, False (and nothing inserted) if any already exists"""
+        try:
+            self.session.bulk_insert_mappings(MockToken, [dict(token=token) for token in tokens])
+            self.session.commit()
+        except IntegrityError:
+            self.session.rollback()
+            return False
+        return True
+
+    def get_path(self, token, path):
+        # the hottest lookup, its SQL is only compiled once
+        query = sql_bakery(lambda session: session.query(MockPath))
+        query += lambda q: q.filter(MockPath.token_id == bindparam('token'), MockPath.path == bindparam('path'))
+        return query(self.session()).params(token=token, path=path).first()
+
+    def get_upstream(self, token):
+        return self.session.query(MockToken.upstream).filter_by(token=token).scalar()
+
+    def count_paths(self, token):
+        return self.session.query(db.func.count(MockPath.id)).filter_by(token_id=token).scalar()
+
+    def existing_paths(self, token, paths, chunk_size=500):
+        """Which of `paths` `token` already has"""
+        paths = list(paths)
+        existing = []
+        for start in xrange(0, len(paths), chunk_size):
+            existing.extend(path for (path,) in self.session.query(MockPath.path).filter(
+                MockPath.token_id == token,
+                MockPath.path.in_(paths[start:start + chunk_size]),
+            ))
+        return existing
+
+    def recent_paths(self, limit):
+        """Up to `limit` paths, not patterns, of the most recently used tokens first"""
+        return self.session.query(MockPath).join(MockToken, MockToken.token == MockPath.token_id).filter(
+            MockPath.is_pattern.isnot(True),
+        ).order_by(MockToken.last_used.desc()).limit(limit).all()
+
+    def set_upstream(self, token, upstream):
+        self.session.query(MockToken).filter_by(token=token).update({
+            MockToken.upstream: upstream,
+        }, synchronize_session=False)
+        self.session.commit()
+
+    def pattern_paths(self, token):
+        return [path for (path,) in self.session.query(MockPath.path).filter_by(token_id=token, is_pattern=True)]
+
+    def save_paths(self, token, definitions, chunk_size=500):
+        definitions = list(definitions)
+        for start in xrange(0, len(definitions), chunk_size):
+            chunk = dict((fields['path'], fields) for fields in definitions[start:start + chunk_size])
+            existing = self.session.query(MockPath.id, MockPath.path, MockPath.headers_json).filter(
+                MockPath.token_id == token,
+                MockPath.path.in_(chunk.keys()),
+            ).all()
+
+            updates = []
+            legacy_ids = []
+            for path_id, path, headers_json in existing:
+                fields = dict(chunk.pop(path), id=path_id)
+                updates.append(fields)
+                if headers_json is None:
+                    legacy_ids.append(path_id)
+            if legacy_ids:
+                self.session.query(MockHeader).filter(MockHeader.path_id.in_(legacy_ids)).delete(
+                    synchronize_session=False
+                )
+            if updates:
+                self.session.bulk_update_mappings(MockPath, updates)
+            if chunk:
+                self.session.bulk_insert_mappings(MockPath, [dict(fields, token_id=token) for fields in chunk.values()])
+
+    def delete_paths(self, token):
+        path_ids = self.session.query(MockPath.id).filter(MockPath.token_id == token)
+        self.session.query(MockHeader).filter(MockHeader.path_id.in_(path_ids.subquery())).delete(
+            synchronize_session=False
+        )
+        self.session.query(MockPath).filter(MockPath.token_id == token).delete(synchronize_session=False)
+
+    def commit(self):
+        self.session.commit()
+
+    def rollback(self):
+        self.session.rollback()
+
+    def export_paths(self, token, batch_size=500):
+        last_id = 0
+        while True:
+            paths = self.session.query(MockPath).filter(
+                MockPath.token_id == token,
+                MockPath.id > last_id,
+            ).order_by(MockPath.id).limit(batch_size).all()
+            if not paths:
+                break
+            for pt in paths:
+                yield pt.definition()
+            last_id = paths[-1].id
+            self.session.expunge_all()
+
+    def expired_tokens(self, column, last_date, limit):
+        """Up to `limit` tokens whose `column` (created_on or last_used) is before `last_date`"""
+        column = getattr(MockToken, column)
+        return [token for (token,) in self.session.query(MockToken.token).filter(column < last_date).limit(limit)]
+
+    def delete_tokens(self, tokens):
+        """Delete `tokens` with their paths, headers and recorded requests"""
+        path_ids = self.session.query(MockPath.id).filter(MockPath.token_id.in_(tokens))
+        self.session.query(MockHeader).filter(MockHeader.path_id.in_(path_ids.subquery())).delete(
+            synchronize_session=False
+        )
+        for model in (MockPath, MockRequest):
+            self.session.query(model).filter(model.token_id.in_(tokens)).delete(synchronize_session=False)
+        self.session.query(MockToken).filter(MockToken.token.in_(tokens)).delete(synchronize_session=False)
+        self.session.commit()
+
+    def add_requests(self, entries, dropped, limit):
+        """
+        Insert recorded requests (`MockRequest` columns) and add `dropped`
+        (counts by token) to `requests_dropped`, along with the requests
+        trimmed to keep the last `limit` of each token. Requests of tokens
+        that no longer exist are left out. Returns how many were inserted.
+        """
+        if entries:
+            try:
+                self.session.bulk_insert_mappings(MockRequest, entries)
+            except IntegrityError:
+                # tokens purged since their requests were queued, drop just those
+                self.session.rollback()
+                tokens = set(entry['token_id'] for entry in entries)
+                known = set(token for (token,) in self.session.query(MockToken.token).filter(
+                    MockToken.token.in_(tokens)
+                ))
+                entries = [entry for entry in entries if entry['token_id'] in known]
+                dropped = dict((token, count) for token, count in dropped.iteritems() if token in known)
+                self.session.bulk_insert_mappings(MockRequest, entries)
+        dropped = dict(dropped)
+        for token in set(entry['token_id'] for entry in entries):
+            oldest_kept = self.session.query(MockRequest.id).filter_by(token_id=token).order_by(
+                MockRequest.id.desc()
+            ).offset(limit - 1).limit(1).scalar()
+            if oldest_kept is not None:
+                trimmed = self.session.query(MockRequest).filter(
+                    MockRequest.token_id == token,
+                    MockRequest.id < oldest_kept,
+                ).delete(synchronize_session=False)
+                if trimmed:
+                    dropped[token] = dropped.get(token, 0) + trimmed
+        for token, count in dropped.iteritems():
+            self.session.query(MockToken).filter_by(token=token).update({
+                MockToken.requests_dropped: db.func.coalesce(MockToken.requests_dropped, 0) + count,
+            }, synchronize_session=False)
+        self.session.commit()
+        return len(entries)
+
+    def get_requests(self, token, cursor, limit):
+        """Up to `limit` recorded requests of `token` after the `cursor` id, as dicts, and how many were dropped"""
+        requests = self.session.query(MockRequest).filter(
+            MockRequest.token_id == token,
+            MockRequest.id > cursor,
+        ).order_by(MockRequest.id).limit(limit).all()
+        dropped = self.session.query(MockToken.requests_dropped).filter_by(token=token).scalar() or 0
+        return [r.to_dict() for r in requests], dropped
+
+    def count_rows(self):
+        """How many rows each table has, by table name"""
+        return dict(
+            (model.__tablename__, self.session.query(db.func.count('*')).select_from(model).scalar())
+            for model in (MockToken, MockPath, MockHeader, MockRequest)
+        )
+
+    def touch_tokens(self, tokens, chunk_size=500):
+        """Set the last use of `tokens` to now"""
+        for i in xrange(0, len(tokens), chunk_size):
+            self.session.query(MockToken).filter(MockToken.token.in_(tokens[i:i + chunk_size])).update({
+                MockToken.last_used: db.func.now(),
+            }, synchronize_session=False)
+        self.session.commit()
+
+    def body_files(self):
+        """Digests of every `body_store` file a path, variant or sequence response refers to"""
+        referenced = set(digest for (digest,) in self.session.query(MockPath.body_file).filter(
+            MockPath.body_file.isnot(None)
+        ))
+        for pt in self.session.query(MockPath.variants_json, MockPath.sequence_json).filter(db.or_(
+            MockPath.variants_json.contains('"body_file": "'),
+            MockPath.sequence_json.contains('"body_file": "'),
+        )):
+            referenced.update(response['body_file'] for response in path_responses(pt) if response.get('body_file'))
+        return referenced
+
+
+class MemoryToken(object):
+    __slots__ = ('token', 'created_on', 'last_used', 'requests_dropped', 'upstream', 'paths', 'requests')
+
+    def __init__(self, token, created_on=None, last_used=None):
+        self.token = token
+        self.created_on = created_on or datetime.datetime.now()
+        self.last_used = last_used or self.created_on
+        self.requests_dropped = None
+        self.upstream = None
+        self.paths = {}
+        self.requests = []
+
+
+class MemoryPath(PathMixin):
+    __slots__ = ('id', 'token_id') + PATH_FIELDS
+
+    def __init__(self, id, token_id, fields):
+        self.id = id
+        self.token_id = token_id
+        for name in PATH_FIELDS:
+            setattr(self, name, fields.get(name))
+
+
+class MemoryStorage(object):
+    """
+    Tokens, paths and recorded requests in dicts of slotted records, for
+    CI and load tests where even SQLite is the bottleneck.
+
+    Without a `directory` the data only lives in this process. With one,
+    each token is also kept in `<token>.json` there: `commit` rewrites
+    the files of the tokens it changed, under a lock every process takes,
+    and bumps their version in `channel`. Other workers reload a token
+    when they see its version change, and a new process starts from the
+    files, so they double as a snapshot. Created before gunicorn forks
+    (`preload_app`), workers share the loaded records copy-on-write.
+    Path ids are allocated under the same lock, from a `.next_id` file,
+    so they are unique across processes.
+    """
+    DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+    def __init__(self, directory=None, channel=None):
+        self.directory = directory
+        self.channel = channel or LocalChannel()
+        self._tokens = {}
+        self._versions = {}
+        self._next_id = 1
+        self._lock = threading.RLock()
+        self._pending = threading.local()
+        if directory is not None:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._sync()
+
+    def _key(self, token):
+        return 'storage/' + token
+
+    def _filename(self, token):
+        return os.path.join(self.directory, token + '.json')
+
+    def _token(self, token):
+        """The record of `token`, reloaded first if another process changed it"""
+        if self.directory is not None and self._versions.get(token) != self.channel.version(self._key(token)):
+            self._load(token)
+        return self._tokens.get(token)
+
+    def _sync(self):
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.json'):
+                self._token(filename[:-len('.json')])
+
+    def _load(self, token):
+        version = self.channel.version(self._key(token))
+        try:
+            with open(self._filename(token)) as f:
+                data = json.load(f)
+        except IOError:
+            with self._lock:
+                self._tokens.pop(token, None)
+                self._versions.pop(token, None)
+            return
+        record = MemoryToken(token, self._parse_date(data['created_on']), self._parse_date(data['last_used']))
+        record.requests_dropped = data['requests_dropped']
+        record.upstream = data.get('upstream')
+        record.requests = data.get('requests', [])
+        for fields in data['paths']:
+            fields['updated_on'] = self._parse_date(fields['updated_on'])
+            record.paths[fields['path']] = MemoryPath(fields['id'], token, fields)
+        with self._lock:
+            self._tokens[token] = record
+            self._versions[token] = version
+            if data['paths']:
+                self._next_id = max(self._next_id, max(fields['id'] for fields in data['paths']) + 1)
+
+    def _parse_date(self, value):
+        return None if value is None else datetime.datetime.strptime(value, self.DATE_FORMAT)
+
+    def _format_date(self, value):
+        return None if value is None else value.strftime(self.DATE_FORMAT)
+
+    def _store(self, record):
+        """Write `record` to its file (if any) and tell the other processes, holding `_locked`"""
+        if self.directory is None:
+            return
+        paths = []
+        for pt in sorted(record.paths.itervalues(), key=lambda pt: pt.id):
+            fields = dict((name, getattr(pt, name)) for name in PATH_FIELDS)
+            fields['id'] = pt.id
+            fields['updated_on'] = self._format_date(pt.updated_on)
+            paths.append(fields)
+        filename = self._filename(record.token)
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(dict(
+                token=record.token,
+                created_on=self._format_date(record.created_on),
+                last_used=self._format_date(record.last_used),
+                requests_dropped=record.requests_dropped,
+                upstream=record.upstream,
+                paths=paths,
+                requests=record.requests,
+            ), f)
+        os.rename(filename + '.tmp', filename)
+        self._bump(record.token)
+
+    def _bump(self, token):
+        self.channel.bump(self._key(token))
+        self._versions[token] = self.channel.version(self._key(token))
+
+    def _locked(self, apply):
+        """Call `apply` holding this process's lock and, with a `directory`, every other process's"""
+        with self._lock:
+            if self.directory is None:
+                return apply()
+            import fcntl
+            fd = os.open(os.path.join(self.directory, '.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX)
+                return apply()
+            finally:
+                os.close(fd)
+
+    def has_token(self, token):
+        return self._token(token) is not None
+
+    def add_tokens(self, tokens):
+        """Insert new tokens, False (and nothing inserted) if any already exists"""
+        def apply():
+            if any(self._token(token) is not None for token in tokens):
+                return False
+            for token in tokens:
+                record = self._tokens[token] = MemoryToken(token)
+                self._store(record)
+            return True
+        return self._locked(apply)
+
+    def get_path(self, token, path):
+        record = self._token(token)
+        if record is None:
+            return None
+        return record.paths.get(path)
+
+    def get_upstream(self, token):
+        record = self._token(token)
+        return None if record is None else record.upstream
+
+    def count_paths(self, token):
+        record = self._token(token)
+        return 0 if record is None else len(record.paths)
+
+    def existing_paths(self, token, paths):
+        """Which of `paths` `token` already has"""
+        record = self._token(token)
+        return [] if record is None else [path for path in paths if path in record.paths]
+
+    def recent_paths(self, limit):
+        """Up to `limit` paths, not patterns, of the most recently used tokens first"""
+        if self.directory is not None:
+            self._sync()
+        paths = []
+        for record in sorted(self._tokens.values(), key=lambda record: record.last_used, reverse=True):
+            paths.extend(pt for pt in record.paths.itervalues() if not pt.is_pattern)
+            if len(paths) >= limit:
+                break
+        return paths[:limit]
+
+    def set_upstream(self, token, upstream):
+        def apply():
+            record = self._token(token)
+            if record is not None:
+                record.upstream = upstream
+                self._store(record)
+        self._locked(apply)
+
+    def pattern_paths(self, token):
+        record = self._token(token)
+        if record is None:
+            return []
+        return [pt.path for pt in record.paths.values() if pt.is_pattern]
+
+    def save_paths(self, token, definitions):
+        self._operations().append((token, list(definitions)))
+
+    def delete_paths(self, token):
+        self._operations().append((token, None))
+
+    def _operations(self):
+        if not hasattr(self._pending, 'operations'):
+            self._pending.operations = []
+        return self._pending.operations
+
+    def commit(self):
+        operations, self._pending.operations = self._operations(), []
+        if not operations:
+            return
+
+        def apply():
+            self._read_next_id()
+            changed = OrderedDict()
+            for token, definitions in operations:
+                record = self._token(token)
+                if record is None:
+                    continue
+                if definitions is None:
+                    record.paths = {}
+                else:
+                    for fields in definitions:
+                        # new records rather than updates, readers may be compiling the old ones
+                        old = record.paths.get(fields['path'])
+                        if old is None:
+                            path_id, self._next_id = self._next_id, self._next_id + 1
+                        else:
+                            path_id = old.id
+                        record.paths[fields['path']] = MemoryPath(path_id, token, fields)
+                changed[token] = record
+            for record in changed.itervalues():
+                self._store(record)
+            self._write_next_id()
+        self._locked(apply)
+
+    def _read_next_id(self):
+        """Catch up with the ids other processes allocated, holding `_locked`"""
+        if self.directory is None:
+            return
+        try:
+            with open(os.path.join(self.directory, '.next_id')) as f:
+                self._next_id = max(self._next_id, int(f.read()))
+        except (IOError, ValueError):
+            pass
+
+    def _write_next_id(self):
+        if self.directory is None:
+            return
+        with open(os.path.join(self.directory, '.next_id'), 'w') as f:
+            f.write(str(self._next_id))
+
+    def rollback(self):
+        self._pending.operations = []
+
+    def export_paths(self, token, batch_size=500):
+        record = self._token(token)
+        if record is None:
+            return
+        for pt in sorted(record.paths.values(), key=lambda pt: pt.id):
+            yield pt.definition()
+
+    def expired_tokens(self, column, last_date, limit):
+        """Up to `limit` tokens whose `column` (created_on or last_used) is before `last_date`"""
+        if self.directory is not None:
+            self._sync()
+        expired = []
+        for token, record in self._tokens.items():
+            if getattr(record, column) < last_date:
+                expired.append(token)
+                if len(expired) >= limit:
+                    break
+        return expired
+
+    def delete_tokens(self, tokens):
+        """Delete `tokens` with their paths and recorded requests"""
+        def apply():
+            for token in tokens:
+                self._tokens.pop(token, None)
+                if self.directory is not None:
+                    try:
+                        os.remove(self._filename(token))
+                    except OSError:
+                        pass
+                    self._bump(token)
+        self._locked(apply)
+
+    def add_requests(self, entries, dropped, limit):
+        """
+        Keep recorded requests (`MockRequest` columns) and add `dropped`
+        (counts by token) to `requests_dropped`, along with the requests
+        trimmed to keep the last `limit` of each token. Requests of tokens
+        that no longer exist are left out. Returns how many were kept.
+        """
+        def apply():
+            changed = {}
+            added = 0
+            for entry in entries:
+                record = self._token(entry['token_id'])
+                if record is None:
+                    continue
+                request_id = record.requests[-1]['id'] + 1 if record.requests else 1
+                record.requests.append(MockRequest(id=request_id, **entry).to_dict())
+                changed[record.token] = record
+                added += 1
+            counts = dict(dropped)
+            for record in changed.itervalues():
+                if len(record.requests) > limit:
+                    counts[record.token] = counts.get(record.token, 0) + len(record.requests) - limit
+                    record.requests = record.requests[-limit:]
+            for token, count in counts.iteritems():
+                record = self._token(token)
+                if record is not None:
+                    record.requests_dropped = (record.requests_dropped or 0) + count
+                    changed[token] = record
+            for record in changed.itervalues():
+                self._store(record)
+            return added
+        return self._locked(apply)
+
+    def get_requests(self, token, cursor, limit):
+        """Up to `limit` recorded requests of `token` after the `cursor` id, as dicts, and how many were dropped"""
+        record = self._token(token)
+        if record is None:
+            return [], 0
+        return [r for r in record.requests if r['id'] > cursor][:limit], record.requests_dropped or 0
+
+    def count_rows(self):
+        """How many tokens, paths and recorded requests there are, named after the tables of `SQLStorage`"""
+        if self.directory is not None:
+            self._sync()
+        records = self._tokens.values()
+        return {
+            'mock_token': len(records),
+            'mock_path': sum(len(record.paths) for record in records),
+            'mock_request': sum(len(record.requests) for record in records),
+        }
+
+    def touch_tokens(self, tokens):
+        """Set the last use of `tokens` to now"""
+        def apply():
+            now = datetime.datetime.now()
+            for token in tokens:
+                record = self._token(token)
+                if record is not None:
+                    record.last_used = now
+                    self._store(record)
+        self._locked(apply)
+
+    def body_files(self):
+        """Digests of every `body_store` file a path, variant or sequence response refers to"""
+        if self.directory is not None:
+            self._sync()
+        referenced = set()
+        for record in self._tokens.values():
+            for pt in record.paths.values():
+                if pt.body_file is not None:
+                    referenced.add(pt.body_file)
+                referenced.update(response['body_file'] for response in path_responses(pt) if response.get('body_file'))
+        return referenced
+
+
+def make_storage(config):
+    """
+    Build the storage described by `MOCK_STORAGE`: `'sqlalchemy'`, `'memory'`
+    (kept in `MOCK_STORAGE_DIR` if set) or any object with the `SQLStorage` methods
+    """
+    kind = config['MOCK_STORAGE']
+    if kind == 'sqlalchemy':
+        return SQLStorage()
+    if kind == 'memory':
+        return MemoryStorage(config['MOCK_STORAGE_DIR'], response_cache.channel)
+    return kind
+
+
+def make_replica_storage(config):
+    """
+    The storage `use_api` looks paths up in first: the `replica` bind of
+    `SQLALCHEMY_BINDS` if there is one, otherwise None (only `storage`)
+    """
+    if config['MOCK_STORAGE'] == 'sqlalchemy' and 'replica' in (config['SQLALCHEMY_BINDS'] or ()):
+        return SQLStorage(replica_session)
+    return None
+
+
+def make_expiry(config):
+    import tempfile
+    return TokenExpiry(
+        purge_interval=config['MOCK_PURGE_INTERVAL'],
+        track_last_use=config['MOCK_EXPIRE_ON_LAST_USE'],
+        lock_file=config['MOCK_PURGE_LOCK_FILE'] or os.path.join(tempfile.gettempdir(), 'myownmocker-purge.lock'),
+    )
+
+
+def make_upstream_pool(config):
+    return UpstreamPool(config['MOCK_PROXY_POOL_SIZE'], config['MOCK_PROXY_TIMEOUT'], config['MOCK_PROXY_PRIVATE'])
+
+
+class LazyGlobal(object):
+    """
+    Stands in for the module global `name` until first used, then builds
+    it with `factory(app.config)` and takes its place, so later lookups
+    find the object itself. Importing the module (for `./manage.py
+    initdb`, say) builds nothing: no memory-mapped files, no Jinja2
+    environment, no pools.
+    """
+
+    def __init__(self, name, factory):
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_lock', threading.Lock())
+
+    def _get(self):
+        with self._lock:
+            if '_value' not in self.__dict__:
+                object.__setattr__(self, '_value', self._factory(app.config))
+            if globals().get(self._name) is self:
+                globals()[self._name] = self._value
+        return self._value
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._get(), name, value)
+
+    def __repr__(self):
+        return '<LazyGlobal %s>' % self._name
+
+
+def make_templates(config):
+    compiled_templates.clear()
+    return TemplateEnvironment(
+        config['MOCK_TEMPLATE_TIMEOUT'], config['MOCK_TEMPLATE_MAX_OUTPUT'], config['MOCK_TEMPLATE_MAX_RANGE'],
+    )
+
+
+def make_response_cache(config):
+    return ResponseCache(
+        config['MOCK_CACHE_SIZE'],
+        channel=make_channel(config),
+        max_stale=config['MOCK_CACHE_MAX_STALE'],
+    )
+
+
+def make_pattern_cache(config):
+    return ResponseCache(
+        config['MOCK_PATTERN_CACHE_SIZE'],
+        channel=response_cache.channel,
+        max_stale=config['MOCK_CACHE_MAX_STALE'],
+    )
+
+
+def make_metrics(config):
+    return Metrics(config['MOCK_METRICS_DIR'], [rule.endpoint for rule in app.url_map.iter_rules()])
+
+
+# the module globals that depend on `app.config`, with what builds them
+GLOBALS = (
+    ('body_store', make_body_store),
+    ('templates', make_templates),
+    ('counters', make_counters),
+    ('response_cache', make_response_cache),
+    ('pattern_cache', make_pattern_cache),
+    ('metrics', make_metrics),
+    ('upstream_pool', make_upstream_pool),
+    ('single_flight', lambda config: SingleFlight()),
+    ('path_recorder', lambda config: PathRecorder()),
+    ('recorder', lambda config: RequestRecorder(config['MOCK_RECORD_LIMIT'])),
+    ('rate_limiter', make_rate_limiter),
+    ('expiry', make_expiry),
+    ('storage', make_storage),
+)
+
+
+def configure():
+    """
+    Forget everything built from `app.config`, each global is built again
+    from the current settings on first use
+    """
+    global replica_storage
+    for name, factory in GLOBALS:
+        globals()[name] = LazyGlobal(name, factory)
+    # compared to None, so never a stand-in
+    replica_storage = make_replica_storage(app.config)
+
+
+def create_app(config=None):
+    """
+    The app, configured with `config` (a dict or the filename of a Python
+    config file) on top of the defaults and environment variables.
+
+    There is one app per process, this reconfigures it: caches, stores
+    and background writers are built again for the new settings, on
+    first use like the database engine, so preloading the app in a
+    gunicorn master (see `gunicorn_config.py`) does not open connections
+    the workers would share.
+    """
+    if isinstance(config, basestring):
+        app.config.from_pyfile(os.path.abspath(config))
+    elif config is not None:
+        app.config.update(config)
+    configure()
+    return app
+
+
+def warm_up(limit=None):
+    """
+    Get a new process ready to serve: connect to the database and compile
+    the paths of the most recently used tokens into the response cache,
+    up to `limit` (the cache size by default). Returns how many.
+    """
+    if limit is None:
+        limit = response_cache.max_size
+    warmed = 0
+    for pt in storage.recent_paths(limit):
+        stamp = response_cache.stamp(pt.token_id, pt.path)
+        try:
+            compiled = CompiledMock.from_path(pt)
+        except MissingBody:
+            # left for the mock calls to report
+            continue
+        response_cache.put(pt.token_id, pt.path, compiled, stamp)
+        warmed += 1
+    storage.rollback()
+    return warmed
+
+
+def post_fork():
+    """
+    Reset what a forked worker must not share with its parent and start
+    its background threads. Database connections are handled by
+    `check_connection_pid` on their own.
+    """
+    global upstream_pool, single_flight
+    # dropped, not closed: the sockets still belong to the parent
+    upstream_pool = make_upstream_pool(app.config)
+    single_flight = SingleFlight()
+    expiry.start()
+
+
+def worker_exit():
+    """Clean up after a worker process, before it exits"""
+    metrics.close()
+
+
+@event.listens_for(Pool, 'connect')
+def record_connection_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(Pool, 'checkout')
+def check_connection_pid(dbapi_connection, connection_record, connection_proxy):
+    # a connection opened before a fork must not be used by two processes,
+    # forget it (without closing it under the parent) and connect again
+    if connection_record.info.get('pid', os.getpid()) != os.getpid():
+        connection_record.connection = connection_proxy.connection = None
+        raise DisconnectionError('Connection opened by process %d' % connection_record.info['pid'])
+
+
+# only stand-ins, nothing is built until used
+configure()
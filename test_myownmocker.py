@@ -3,6 +3,10 @@
 import myownmocker
 import unittest
 import json
+import os
+import shutil
+import subprocess
+import tempfile
 
 
 class MOMTestCase(unittest.TestCase):
@@ -13,10 +17,21 @@ class MOMTestCase(unittest.TestCase):
         self.app = myownmocker.app.test_client()
         self.db = myownmocker.db
         self.db.create_all()
+        myownmocker.response_cache.clear()
+        myownmocker.recorder.interval = None
+        myownmocker.expiry = myownmocker.TokenExpiry(interval=None)
+        myownmocker.counters = myownmocker.LocalCounters()
+        myownmocker.rate_limiter = myownmocker.RateLimiter()
+        myownmocker.path_recorder.interval = None
+        self.body_store_dir = tempfile.mkdtemp()
+        myownmocker.app.config['MOCK_BODY_STORE'] = self.body_store_dir
+        myownmocker.body_store.directory = self.body_store_dir
 
     def tearDown(self):
         self.db.session.remove()
         self.db.drop_all()
+        myownmocker.app.config['MOCK_BODY_STORE'] = None
+        shutil.rmtree(self.body_store_dir)
 
     def test_index(self):
         res = self.app.get('/')
@@ -36,7 +51,7 @@ class MOMTestCase(unittest.TestCase):
             from mock import patch
         except ImportError:
             self.skipTest('requires mock, run: pip install mock')
-        with patch('random.SystemRandom.choice', return_value='a'):
+        with patch('os.urandom', side_effect=lambda n: 'a' * n):
             # register once
             res, _ = self._register()
             self.assertEqual(res.status_code, 200)
@@ -70,6 +85,61 @@ class MOMTestCase(unittest.TestCase):
         self.assertEqual(j['setup_secure_url'], 'https://localhost/setup/%s/' % token)
         self.assertEqual(j['mock_base_secure_url'], 'https://localhost/mock/%s/' % token)
 
+    def test_register_count(self):
+        res = self.app.get('/register/?count=20')
+        self.assertEqual(res.status_code, 200)
+        tokens = json.loads(res.data)['tokens']
+        self.assertEqual(len(set(t['token'] for t in tokens)), 20)
+        self.assertEqual(tokens[0]['mock_base_url'], 'http://localhost/mock/%s/' % tokens[0]['token'])
+        self.assertEqual(self.db.session.query(myownmocker.MockToken).count(), 20)
+
+        for count in ('0', '101', 'x'):
+            res = self.app.get('/register/?count=%s' % count)
+            self.assertEqual(res.status_code, 400)
+        self.assertEqual(self.db.session.query(myownmocker.MockToken).count(), 20)
+
+    def test_register_concurrent(self):
+        import itertools
+        import threading
+        try:
+            from mock import patch
+        except ImportError:
+            self.skipTest('requires mock, run: pip install mock')
+        tmpdir = tempfile.mkdtemp()
+        myownmocker.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///%s' % os.path.join(tmpdir, 'mom.db')
+        self.db.create_all()
+        # the first candidates are drawn twice, each collision costing one of the 5 attempts
+        lock = threading.Lock()
+        candidates = itertools.chain((0, 0, 1, 1, 2, 2, 3, 3), itertools.count(4))
+
+        def generate(count, length=16):
+            with lock:
+                return ['%016d' % next(candidates) for _ in xrange(count)]
+
+        results = []
+
+        def worker():
+            client = myownmocker.app.test_client()
+            for _ in xrange(10):
+                res = client.get('/register/')
+                results.append((res.status_code, json.loads(res.data).get('token')))
+
+        try:
+            with patch('myownmocker.generate_tokens', side_effect=generate):
+                threads = [threading.Thread(target=worker) for _ in xrange(8)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            self.assertEqual(set(status for status, _ in results), set([200]))
+            self.assertEqual(len(set(token for _, token in results)), 80)
+            self.assertEqual(self.db.session.query(myownmocker.MockToken).count(), 80)
+        finally:
+            self.db.session.remove()
+            self.db.drop_all()
+            myownmocker.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+            shutil.rmtree(tmpdir)
+
     def test_setup_fail_invalid_token(self):
         res = self.app.post('/setup/invalidToken/', data='{"a":"1"}', content_type='application/json')
         self.assertEqual(res.status_code, 404)
@@ -150,6 +220,108 @@ class MOMTestCase(unittest.TestCase):
         self.assertEqual(j['path_url'], 'http://localhost/mock/%s/value' % token)
         self.assertEqual(j['path_secure_url'], 'https://localhost/mock/%s/value' % token)
 
+    def test_setup_bulk(self):
+        token = self.test_path()
+        res = self.app.post(
+            '/setup/%s/bulk/' % token,
+            content_type='application/json',
+            data=json.dumps([
+                {'path': 'value', 'status_code': 201, 'content_type': 'text/plain', 'body': 'replaced'},
+                {'path': '/other', 'status_code': 200, 'content_type': 'text/plain',
+                 'custom_headers': {'X-Other': 1}},
+                {'path': 'broken', 'status_code': 200},
+                'garbage',
+                {'path': 123, 'status_code': 200, 'content_type': 'text/plain'},
+            ]),
+        )
+        self.assertEqual(res.status_code, 200)
+        j = json.loads(res.data)
+        self.assertEqual([r['message'] for r in j['results']], [
+            'ok', 'ok', 'Missing required field: content_type', 'Invalid path definition', 'Invalid path',
+        ])
+        self.assertEqual(j['results'][1]['path_url'], 'http://localhost/mock/%s/other' % token)
+
+        res = self.app.get('/mock/%s/value' % token)
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(res.data, 'replaced')
+        self.assertNotIn('X-My-Header', res.headers)
+        res = self.app.get('/mock/%s/other' % token)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['X-Other'], '1')
+        res = self.app.get('/mock/%s/broken' % token)
+        self.assertEqual(res.status_code, 404)
+
+    def test_setup_bulk_ndjson(self):
+        _, token = self._register()
+        lines = [
+            json.dumps({'path': 'path/%d' % i, 'status_code': 200, 'content_type': 'text/plain', 'body': str(i)})
+            for i in xrange(3)
+        ]
+        res = self.app.post('/setup/%s/bulk/' % token, content_type='application/x-ndjson', data='\n'.join(lines))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(json.loads(res.data)['results']), 3)
+        res = self.app.get('/mock/%s/path/2' % token)
+        self.assertEqual(res.data, '2')
+
+        res = self.app.post('/setup/%s/bulk/' % token, content_type='application/x-ndjson', data='{"a"')
+        self.assertEqual(res.status_code, 400)
+        res = self.app.post('/setup/%s/bulk/' % token, content_type='application/json', data='{"a": 1}')
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(json.loads(res.data)['message'], 'Expected a list of path definitions')
+        res = self.app.post('/setup/invalidToken/bulk/', content_type='application/json', data='[]')
+        self.assertEqual(res.status_code, 404)
+
+    def test_setup_export_import(self):
+        token = self.test_path()
+        self._setup(token, 'other', 200, 'text/plain', body=u'\u2713')
+
+        res = self.app.get('/setup/%s/export' % token)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Type'], 'application/x-ndjson')
+        lines = res.data.splitlines()
+        self.assertEqual([json.loads(line)['path'] for line in lines], ['value', 'other'])
+        self.assertEqual(json.loads(lines[0])['custom_headers'], {'X-My-Header': '123', 'X-My-Header2': '123'})
+
+        _, token2 = self._register()
+        self._setup(token2, 'stale', 200, 'text/plain')
+        data = '\n'.join(lines + ['{"path": "broken"}', 'garbage'])
+        # replacing with invalid lines changes nothing
+        res = self.app.post('/setup/%s/import?replace=1' % token2, data='not json\n{"path": 1}',
+                            content_type='application/x-ndjson')
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual([e['line'] for e in json.loads(res.data)['errors']], [1, 2])
+        res = self.app.post('/setup/%s/import?replace=1' % token2, data=data, content_type='application/x-ndjson')
+        self.assertEqual(res.status_code, 400)
+        j = json.loads(res.data)
+        self.assertEqual(j['imported'], 0)
+        self.assertEqual([e['line'] for e in j['errors']], [3, 4])
+        self.assertEqual(j['errors'][0]['message'], 'Missing required field: status_code')
+        self.assertEqual(self.app.get('/mock/%s/stale' % token2).status_code, 200)
+        self.assertEqual(self.app.get('/mock/%s/value' % token2).status_code, 404)
+
+        # without replace, the valid lines are imported
+        res = self.app.post('/setup/%s/import' % token, data=data, content_type='application/x-ndjson')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['imported'], 2)
+
+        res = self.app.post('/setup/%s/import?replace=1' % token2, data='\n'.join(lines),
+                            content_type='application/x-ndjson')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['imported'], 2)
+
+        res = self.app.get('/mock/%s/value' % token2)
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(res.headers['X-My-Header'], '123')
+        res = self.app.get('/mock/%s/other' % token2)
+        self.assertEqual(res.data.decode('utf-8'), u'\u2713')
+        res = self.app.get('/mock/%s/stale' % token2)
+        self.assertEqual(res.status_code, 404)
+
+        res = self.app.get('/setup/invalidToken/export')
+        self.assertEqual(res.status_code, 404)
+        res = self.app.post('/setup/invalidToken/import', data='')
+        self.assertEqual(res.status_code, 404)
+
     def test_path_invalid(self):
         _, token = self._register()
 
@@ -159,6 +331,11 @@ class MOMTestCase(unittest.TestCase):
         j = json.loads(res.data)
         self.assertEqual(j['message'], 'Method not found')
 
+        for path in (123, None, '', '/'):
+            res = self._setup(token, path, 200, 'text/plain')
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(json.loads(res.data)['message'], 'Invalid path')
+
     def test_path(self):
         _, token = self._register()
 
@@ -185,6 +362,1088 @@ class MOMTestCase(unittest.TestCase):
         self.assertEqual(res.data, 'test')
         return token
 
+    def test_path_pattern(self):
+        _, token = self._register()
+        self._setup(token, 'user/{id}/details/', 200, 'text/plain', body='pattern')
+        self._setup(token, 'user/me/details/', 200, 'text/plain', body='exact')
+        self._setup(token, 'files/*', 200, 'text/plain', body='glob')
+
+        res = self.app.get('/mock/%s/user/123/details/' % token)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data, 'pattern')
+        res = self.app.get('/mock/%s/user/me/details/' % token)
+        self.assertEqual(res.data, 'exact')
+        res = self.app.get('/mock/%s/files/a/b.txt' % token)
+        self.assertEqual(res.data, 'glob')
+        res = self.app.get('/mock/%s/user/123/other/' % token)
+        self.assertEqual(res.status_code, 404)
+
+        # changing the pattern replaces the responses already served through it
+        self._setup(token, 'user/{id}/details/', 200, 'text/plain', body='pattern2')
+        res = self.app.get('/mock/%s/user/123/details/' % token)
+        self.assertEqual(res.data, 'pattern2')
+
+    def test_path_variants(self):
+        _, token = self._register()
+        res = self.app.post(
+            '/setup/%s/' % token,
+            content_type='application/json',
+            data=json.dumps({
+                'path': 'items/',
+                'status_code': 200,
+                'content_type': 'application/json',
+                'body': 'list',
+                'variants': [
+                    {'match': {'method': 'post'}, 'status_code': 201, 'body': 'created',
+                     'custom_headers': {'Location': '/items/1'}},
+                    {'match': {'query': {'page': 2}}, 'body': 'page 2'},
+                    {'match': {'method': 'GET', 'headers': {'X-Debug': '1'}, 'query': {'page': 2}},
+                     'content_type': 'text/plain', 'body': 'debug page 2'},
+                ],
+            }),
+        )
+        self.assertEqual(res.status_code, 200)
+
+        res = self.app.get('/mock/%s/items/' % token)
+        self.assertEqual((res.status_code, res.data), (200, 'list'))
+        res = self.app.post('/mock/%s/items/' % token)
+        self.assertEqual((res.status_code, res.data), (201, 'created'))
+        self.assertEqual(res.headers['Location'], 'http://localhost/items/1')
+        res = self.app.put('/mock/%s/items/?page=2' % token)
+        self.assertEqual((res.status_code, res.data), (200, 'page 2'))
+        res = self.app.get('/mock/%s/items/?page=2' % token, headers={'X-Debug': '1'})
+        self.assertEqual((res.status_code, res.data), (200, 'page 2'))
+        self.assertEqual(res.headers['Content-Type'], 'application/json')
+        res = self.app.delete('/mock/%s/items/?page=3' % token)
+        self.assertEqual((res.status_code, res.data), (200, 'list'))
+
+        res = self.app.get('/setup/%s/export' % token)
+        self.assertEqual(len(json.loads(res.data)['variants']), 3)
+
+        res = self.app.post(
+            '/setup/%s/' % token,
+            content_type='application/json',
+            data=json.dumps({'path': 'items/', 'status_code': 200, 'content_type': 'text/plain', 'variants': ['x']}),
+        )
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(json.loads(res.data)['message'], 'Invalid variant')
+
+    def test_path_conditional(self):
+        token = self.test_path_resetup()
+        res = self.app.get('/mock/%s/value' % token)
+        etag = res.headers['ETag']
+        last_modified = res.headers['Last-Modified']
+
+        query = self.db.session.query
+        try:
+            self.db.session.query = None
+            res = self.app.get('/mock/%s/value' % token, headers={'If-None-Match': etag})
+            self.assertEqual(res.status_code, 304)
+            self.assertEqual(res.data, '')
+            self.assertEqual(res.headers['ETag'], etag)
+            res = self.app.get('/mock/%s/value' % token, headers={'If-Modified-Since': last_modified})
+            self.assertEqual(res.status_code, 304)
+            res = self.app.get('/mock/%s/value' % token, headers={'If-None-Match': '"other"'})
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.data, 'test2')
+            res = self.app.post('/mock/%s/value' % token, headers={'If-None-Match': etag})
+            self.assertEqual(res.status_code, 200)
+        finally:
+            self.db.session.query = query
+
+        self._setup(token, 'value', 200, 'text/html', body='test3')
+        res = self.app.get('/mock/%s/value' % token, headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+        # custom validators and non-200 responses are left alone
+        self._setup(token, 'value', 200, 'text/html', body='test3', custom_headers={'ETag': '"mine"'})
+        res = self.app.get('/mock/%s/value' % token, headers={'If-None-Match': '"mine"'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers.getlist('ETag'), ['"mine"'])
+        self.assertIn('Last-Modified', res.headers)
+        self._setup(token, 'value', 404, 'text/html', body='test3')
+        res = self.app.get('/mock/%s/value' % token)
+        self.assertNotIn('ETag', res.headers)
+        self.assertNotIn('Last-Modified', res.headers)
+
+    def test_path_large_body(self):
+        import base64
+        _, token = self._register()
+        body = 'x' * 1000
+        binary = ''.join(chr(i) for i in xrange(256))
+        self._setup(token, 'large', 200, 'text/plain', body=body)
+        self._setup(token, 'large2', 200, 'text/plain', body=body)
+        res = self.app.post('/setup/%s/' % token, content_type='application/json', data=json.dumps({
+            'path': 'binary', 'status_code': 200, 'content_type': 'image/png',
+            'body_base64': base64.b64encode(binary),
+        }))
+        self.assertEqual(res.status_code, 200)
+
+        pt = self.db.session.query(myownmocker.MockPath).filter_by(token_id=token, path='large').first()
+        self.assertIsNone(pt.body)
+        self.assertEqual(len(pt.body_file), 64)
+        # stored once for both paths
+        self.assertEqual(sum(len(files) for _, _, files in os.walk(self.body_store_dir)), 2)
+
+        res = self.app.get('/mock/%s/large' % token)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data, body)
+        self.assertEqual(res.headers['Content-Length'], '1000')
+        self.assertEqual(res.headers['Accept-Ranges'], 'bytes')
+        etag = res.headers['ETag']
+
+        res = self.app.get('/mock/%s/large' % token, headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, '')
+
+        res = self.app.get('/mock/%s/binary' % token, headers={'Range': 'bytes=10-19'})
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(res.data, binary[10:20])
+        self.assertEqual(res.headers['Content-Range'], 'bytes 10-19/256')
+
+        res = self.app.get('/setup/%s/export' % token)
+        exported = [json.loads(line) for line in res.data.splitlines()]
+        self.assertEqual(base64.b64decode(exported[2]['body_base64']), binary)
+
+        res = self.app.post('/setup/%s/' % token, content_type='application/json', data=json.dumps({
+            'path': 'binary', 'status_code': 200, 'content_type': 'image/png', 'body_base64': '!',
+        }))
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(json.loads(res.data)['message'], 'Invalid body_base64')
+
+    def test_path_large_body_without_store(self):
+        import base64
+        myownmocker.app.config['MOCK_BODY_STORE'] = None
+        _, token = self._register()
+        body = 'x' * 1000
+        self._setup(token, 'large', 200, 'text/plain', body=body)
+
+        pt = self.db.session.query(myownmocker.MockPath).filter_by(token_id=token, path='large').first()
+        self.assertEqual(pt.body, body)
+        self.assertIsNone(pt.body_file)
+        res = self.app.get('/mock/%s/large' % token)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data, body)
+
+        res = self.app.post('/setup/%s/' % token, content_type='application/json', data=json.dumps({
+            'path': 'binary', 'status_code': 200, 'content_type': 'image/png', 'body_base64': base64.b64encode('\x00'),
+        }))
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(
+            json.loads(res.data)['message'],
+            'Binary bodies are not supported on this server, MOCK_BODY_STORE is not set',
+        )
+
+    def test_path_compressed(self):
+        import gzip
+        import StringIO
+        _, token = self._register()
+        large = json.dumps([{'id': i, 'name': 'item %d' % i} for i in xrange(100)])
+        inline = json.dumps([{'id': i} for i in xrange(30)])
+        self._setup(token, 'large', 200, 'application/json', body=large)
+        self._setup(token, 'inline', 200, 'application/json; charset=utf-8', body=inline)
+        self._setup(token, 'small', 200, 'application/json', body='{}')
+        self._setup(token, 'encoded', 200, 'application/json', body=large, custom_headers={'Content-Encoding': 'x'})
+        self._setup(token, 'image', 200, 'image/svg', body=large)
+
+        def gunzip(data):
+            return gzip.GzipFile(fileobj=StringIO.StringIO(data)).read()
+
+        old_min_size = myownmocker.app.config['MOCK_COMPRESS_MIN_SIZE']
+        myownmocker.app.config['MOCK_COMPRESS_MIN_SIZE'] = 200
+        try:
+            for path, body in (('large', large), ('inline', inline)):
+                res = self.app.get('/mock/%s/%s' % (token, path), headers={'Accept-Encoding': 'gzip, deflate'})
+                self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+                self.assertEqual(res.headers['Vary'], 'Accept-Encoding')
+                self.assertLess(len(res.data), len(body))
+                self.assertEqual(int(res.headers['Content-Length']), len(res.data))
+                self.assertEqual(gunzip(res.data), body)
+                etag = res.headers['ETag']
+                self.assertTrue(etag.endswith('-gzip"'))
+                res = self.app.get('/mock/%s/%s' % (token, path), headers={
+                    'Accept-Encoding': 'gzip', 'If-None-Match': etag,
+                })
+                self.assertEqual(res.status_code, 304)
+
+                res = self.app.get('/mock/%s/%s' % (token, path), headers={'Accept-Encoding': 'gzip;q=0, identity'})
+                self.assertNotIn('Content-Encoding', res.headers)
+                self.assertEqual(res.headers['Vary'], 'Accept-Encoding')
+                self.assertEqual(res.data, body)
+                self.assertNotEqual(res.headers['ETag'], etag)
+
+            # compressed once, then served from the compiled response
+            self.assertTrue(os.path.exists(myownmocker.body_store.path(
+                myownmocker.MockPath.query.filter_by(path='large').one().body_file + '.gzip'
+            )))
+            compiled = myownmocker.response_cache.get(token, 'inline')
+            self.assertEqual(compiled.default.encoded('gzip').body, self.app.get(
+                '/mock/%s/inline' % token, headers={'Accept-Encoding': 'gzip'}
+            ).data)
+
+            for path in ('small', 'encoded', 'image'):
+                res = self.app.get('/mock/%s/%s' % (token, path), headers={'Accept-Encoding': 'gzip'})
+                self.assertNotIn('Vary', res.headers)
+                self.assertNotEqual(res.headers.get('Content-Encoding'), 'gzip')
+
+            if myownmocker.brotli is not None:
+                res = self.app.get('/mock/%s/large' % token, headers={'Accept-Encoding': 'gzip, br'})
+                self.assertEqual(res.headers['Content-Encoding'], 'br')
+                self.assertEqual(myownmocker.brotli.decompress(res.data), large)
+        finally:
+            myownmocker.app.config['MOCK_COMPRESS_MIN_SIZE'] = old_min_size
+
+    def test_purge_bodies(self):
+        _, token = self._register()
+        self._setup(token, 'large', 200, 'text/plain', body='x' * 1000)
+        self._setup(token, 'other', 200, 'text/plain', body='y' * 1000)
+        self._setup(token, 'other', 200, 'text/plain', body='y')
+        for dirpath, _, files in os.walk(self.body_store_dir):
+            for f in files:
+                os.utime(os.path.join(dirpath, f), (0, 0))
+        self.assertEqual(myownmocker.purge_bodies(), 1)
+        self.assertEqual(self.app.get('/mock/%s/large' % token).data, 'x' * 1000)
+
+        # set up again, the file is as good as new
+        for dirpath, _, files in os.walk(self.body_store_dir):
+            for f in files:
+                os.utime(os.path.join(dirpath, f), (0, 0))
+        myownmocker.body_store.put('x' * 1000)
+        self.assertEqual(myownmocker.body_store.purge(set()), 0)
+
+        # a file removed by hand
+        for dirpath, _, files in os.walk(self.body_store_dir):
+            for f in files:
+                os.remove(os.path.join(dirpath, f))
+        myownmocker.response_cache.clear()
+        res = self.app.get('/mock/%s/large' % token)
+        self.assertEqual(res.status_code, 500)
+        self.assertIn('is missing, set the path up again', json.loads(res.data)['message'])
+        # only 'other' is warmed up
+        self.assertEqual(myownmocker.warm_up(), 1)
+
+    def test_path_chaos(self):
+        try:
+            from mock import patch
+        except ImportError:
+            self.skipTest('requires mock, run: pip install mock')
+        _, token = self._register()
+
+        def setup_chaos(chaos, body='test'):
+            return self.app.post('/setup/%s/' % token, content_type='application/json', data=json.dumps({
+                'path': 'slow', 'status_code': 200, 'content_type': 'text/plain', 'body': body, 'chaos': chaos,
+            }))
+
+        self.assertEqual(setup_chaos({'delay': 200}).status_code, 200)
+        with patch('time.sleep') as sleep:
+            res = self.app.get('/mock/%s/slow' % token)
+        self.assertEqual(res.data, 'test')
+        sleep.assert_called_once_with(0.2)
+
+        setup_chaos({'bandwidth': 100}, body='x' * 250)
+        with patch('time.sleep') as sleep:
+            res = self.app.get('/mock/%s/slow' % token)
+            self.assertEqual(res.data, 'x' * 250)
+        # 10 bytes every 100ms
+        self.assertEqual([c[0][0] for c in sleep.call_args_list], [0.1] * 25)
+
+        setup_chaos({'failure_rate': 1, 'failure_status': 500})
+        res = self.app.get('/mock/%s/slow' % token)
+        self.assertEqual(res.status_code, 500)
+        self.assertEqual(res.headers['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(res.data)['message'], 'Simulated failure')
+
+        # a throttled body takes at most MOCK_MAX_DELAY
+        myownmocker.app.config['MOCK_MAX_DELAY'] = 1.0
+        try:
+            setup_chaos({'bandwidth': 100, 'delay': 500}, body='x' * 1000)
+            with patch('time.sleep') as sleep:
+                res = self.app.get('/mock/%s/slow' % token)
+                self.assertEqual(res.data, 'x' * 1000)
+            self.assertAlmostEqual(sum(c[0][0] for c in sleep.call_args_list), 1.5)
+        finally:
+            myownmocker.app.config['MOCK_MAX_DELAY'] = 30.0
+
+        for chaos in (
+            {'delay': -1}, {'delay': {'unknown': 1}}, {'failure_rate': 2}, {'bandwidth': 0}, 'slow',
+            {'delay': 86400000, 'bandwidth': 0.001}, {'delay': 30001}, {'delay': {'uniform': [0, 86400000]}},
+            {'delay': {'normal': [86400000, 1]}}, {'delay': {'percentiles': {'99': 86400000}}}, {'bandwidth': 99},
+        ):
+            res = setup_chaos(chaos)
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(json.loads(res.data)['message'], 'Invalid chaos')
+
+    def test_template(self):
+        _, token = self._register()
+
+        def setup_template(path, body, **data):
+            return self.app.post('/setup/%s/' % token, content_type='application/json', data=json.dumps(dict(
+                data, path=path, status_code=201, content_type='application/json', body=body, template=True,
+            )))
+
+        res = setup_template(
+            'users/{id}',
+            '{"id": {{ params.id }}, "seq": {{ counter("users") }}, "name": "{{ json.name }}", "q": "{{ args.q }}"}',
+            custom_headers={'X-User': '/users/{{ params.id }}'},
+            variants=[{'match': {'method': 'DELETE'}, 'status_code': 200, 'body': '{{ method }} {{ path }}'}],
+        )
+        self.assertEqual(res.status_code, 200)
+        for seq in (1, 2):
+            res = self.app.post('/mock/%s/users/7?q=x' % token, data=json.dumps({'name': 'mom'}),
+                                content_type='application/json')
+            self.assertEqual(res.status_code, 201)
+            self.assertEqual(json.loads(res.data), {'id': 7, 'seq': seq, 'name': 'mom', 'q': 'x'})
+            self.assertEqual(res.headers['X-User'], '/users/7')
+            self.assertNotIn('ETag', res.headers)
+        self.assertEqual(self.app.delete('/mock/%s/users/8' % token).data, 'DELETE users/8')
+
+        res = setup_template('broken', '{% for %}')
+        self.assertEqual(res.status_code, 400)
+        self.assertIn('Invalid template', json.loads(res.data)['message'])
+
+        # not a template unless asked for
+        self._setup(token, 'plain', 200, 'text/plain', body='{{ method }}')
+        self.assertEqual(self.app.get('/mock/%s/plain' % token).data, '{{ method }}')
+
+        exported = [json.loads(line) for line in self.app.get('/setup/%s/export' % token).data.splitlines()]
+        self.assertEqual([d.get('template') for d in exported], [True, None])
+
+    def test_template_compiled_once(self):
+        try:
+            from mock import patch
+        except ImportError:
+            self.skipTest('requires mock, run: pip install mock')
+        _, token = self._register()
+        templates = myownmocker.templates
+        with patch.object(templates, 'from_string', wraps=templates.from_string) as from_string:
+            self.app.post('/setup/%s/' % token, content_type='application/json', data=json.dumps(dict(
+                path='items/{id}', status_code=200, content_type='text/plain', body='item {{ params.id }} once',
+                template=True,
+            )))
+            for i in xrange(5):
+                self.assertEqual(self.app.get('/mock/%s/items/%d' % (token, i)).data, 'item %d once' % i)
+                myownmocker.response_cache.clear()
+            self.assertEqual(from_string.call_count, 1)
+
+    def test_template_budget(self):
+        _, token = self._register()
+        myownmocker.counters = myownmocker.LocalCounters(max_per_token=2)
+        for body, message in (
+            ('{% for i in range(100000) %}{% endfor %}', 'range larger than 1000'),
+            ('{% for i in range(1000) %}{% for j in range(1000) %}{% for k in range(1000) %}'
+             '{% endfor %}{% endfor %}{% endfor %}', 'took longer than 0.1s'),
+            ('{% set s = "x"*20000 %}{% for i in s %}{% for j in s %}{% endfor %}{% endfor %}ok',
+             'took longer than 0.1s'),
+            ('{{ "x" * 100000 }}', 'result larger than 65536'),
+            ('{{ 10 ** 100000 }}', 'exponent larger than 64'),
+            ('{{ "%99999999s" % "" }}', 'format width too large'),
+            ('{{ (\'x\'*60000).replace(\'x\', \'x\'*2000)|length }}', 'result larger than 65536'),
+            ('{{ (\'x\'*60000)|replace(\'x\', \'xx\')|length }}', 'result larger than 65536'),
+            ('{{ "{:>200000000}".format(1)|length }}', 'result larger than 65536'),
+            ('{{ "{}{}".format("x"*40000, "x"*40000)|length }}', 'result larger than 65536'),
+            ('{{ range(1000)|join("x"*60000)|length }}', 'result larger than 65536'),
+            ('{{ ("x"*60000).join(["a", "b", "c"])|length }}', 'result larger than 65536'),
+            ('{{ "%s%s"|format("x"*40000, "x") }}', 'result larger than 65536'),
+            ('{% set a = "x"*40000 %}{% set b = a+a %}{{ b|length }}', 'result larger than 65536'),
+            ('{% set a = "x"*40000 %}{{ (a ~ a)|length }}', 'result larger than 65536'),
+            ('{% set a = ["x"*40000] %}{% set b = a*2 %}{{ b|length }}', 'result larger than 65536'),
+            ('{{ "x".ljust(100000000)|length }}', 'result larger than 65536'),
+            ('{% set a = [] %}{% for i in range(10) %}{% set _ = a.append("x"*10000) %}{% endfor %}',
+             'result larger than 65536'),
+            ('{% for i in range(1000) %}{{ "x" * 1000 }}{% endfor %}', 'output larger than 65536 characters'),
+            ('{{ counter("x" * 101) }}', 'counter names are strings of up to 100 characters'),
+            ('{% for i in range(3) %}{{ counter(i|string) }}{% endfor %}', 'Too many counters, the limit is 2 per token'),
+            ('{{ "".__class__ }}', None),
+        ):
+            self.app.post('/setup/%s/' % token, content_type='application/json', data=json.dumps(dict(
+                path='bad', status_code=200, content_type='text/plain', body=body, template=True,
+            )))
+            res = self.app.get('/mock/%s/bad' % token)
+            if message is None:
+                # unsafe attributes are undefined in the sandbox
+                self.assertEqual(res.status_code, 200)
+                self.assertEqual(res.data, '')
+            else:
+                self.assertEqual(res.status_code, 500)
+                self.assertEqual(json.loads(res.data)['message'], 'Template failed: %s' % message)
+
+        # within the budget they work as usual
+        self.app.post('/setup/%s/' % token, content_type='application/json', data=json.dumps(dict(
+            path='good', status_code=200, content_type='text/plain', template=True,
+            body='{{ "a-b"|replace("-", "+") }} {{ [1, 2]|join(",") }} {{ "{}!".format("c") }} {{ "d" ~ 1 }} '
+                 '{{ "%s"|format("e") }} {{ "f".rjust(2) }} {{ "g" + "h" }}',
+        )))
+        self.assertEqual(self.app.get('/mock/%s/good' % token).data, 'a+b 1,2 c! d1 e  f gh')
+
+    def test_path_sequence(self):
+        _, token = self._register()
+
+        def setup_sequence(path, sequence, **data):
+            return self.app.post('/setup/%s/' % token, content_type='application/json', data=json.dumps(dict(
+                data, path=path, status_code=200, content_type='text/plain', body='default', sequence=sequence,
+            )))
+
+        res = setup_sequence('retry', {'responses': [
+            {'status_code': 503, 'body': 'try again'},
+            {'status_code': 503, 'body': 'try again'},
+            {'body': 'done', 'custom_headers': {'X-Try': '3'}},
+        ]}, variants=[{'match': {'method': 'DELETE'}, 'status_code': 204}])
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.app.delete('/mock/%s/retry' % token).status_code, 204)
+        codes = [self.app.get('/mock/%s/retry' % token).status_code for _ in range(5)]
+        self.assertEqual(codes, [503, 503, 200, 200, 200])
+        res = self.app.get('/mock/%s/retry' % token)
+        self.assertEqual(res.data, 'done')
+        self.assertEqual(res.headers['X-Try'], '3')
+
+        # starts over when reset or set up again
+        self.assertEqual(self.app.post('/setup/invalidToken/reset').status_code, 404)
+        res = self.app.post('/setup/%s/reset?path=retry' % token)
+        self.assertEqual(json.loads(res.data), {'message': 'ok'})
+        self.assertEqual(self.app.get('/mock/%s/retry' % token).status_code, 503)
+        self.app.post('/setup/%s/bulk/' % token, content_type='application/json', data=self.app.get(
+            '/setup/%s/export' % token
+        ).data.replace('\n', ''))
+        self.assertEqual(self.app.get('/mock/%s/retry' % token).status_code, 503)
+
+        setup_sequence('cycle/{id}', {'mode': 'cycle', 'responses': [{'body': 'a'}, {'body': 'b'}]})
+        self.assertEqual([self.app.get('/mock/%s/cycle/%d' % (token, i)).data for i in range(5)],
+                         ['a', 'b', 'a', 'b', 'a'])
+        self.app.post('/setup/%s/reset' % token)
+        self.assertEqual(self.app.get('/mock/%s/cycle/1' % token).data, 'a')
+        self.assertEqual(self.app.get('/mock/%s/retry' % token).status_code, 503)
+
+        exported = dict(
+            (d['path'], d) for d in map(json.loads, self.app.get('/setup/%s/export' % token).data.splitlines())
+        )
+        self.assertEqual(exported['cycle/{id}']['sequence']['mode'], 'cycle')
+        self.assertEqual(exported['retry']['sequence']['responses'][0], {
+            'status_code': 503, 'content_type': 'text/plain', 'custom_headers': {}, 'body': 'try again',
+        })
+
+        for sequence, message in (
+            ([], 'Invalid sequence'),
+            ({'responses': []}, 'Invalid sequence'),
+            ({'mode': 'random', 'responses': [{}]}, 'Invalid sequence mode'),
+            ({'responses': ['x']}, 'Invalid sequence response'),
+        ):
+            res = setup_sequence('bad', sequence)
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(json.loads(res.data)['message'], message)
+
+    def test_file_counters(self):
+        import multiprocessing
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'counters')
+            counters = myownmocker.FileCounters(filename, slots=64)
+            self.assertEqual(counters.incr('t1', 'a'), 1)
+
+            def hit():
+                worker = myownmocker.FileCounters(filename, slots=64)
+                for _ in range(200):
+                    worker.incr('t1', 'a')
+                    worker.incr('t2', 'a')
+
+            workers = [multiprocessing.Process(target=hit) for _ in range(4)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            self.assertEqual(counters.incr('t1', 'a'), 802)
+            self.assertEqual(counters.incr('t2', 'a'), 801)
+
+            counters.incr('t1', 'b')
+            counters.reset('t1', 'a')
+            self.assertEqual(counters.incr('t1', 'a'), 1)
+            self.assertEqual(counters.incr('t1', 'b'), 2)
+            counters.purge(['t1'])
+            self.assertEqual(counters.incr('t1', 'b'), 1)
+            self.assertEqual(counters.incr('t2', 'a'), 802)
+
+            # a full table evicts counters instead of refusing new ones
+            for i in range(100):
+                self.assertEqual(counters.incr('t3', str(i)), 1)
+            self.assertEqual(counters.incr('t3', '99'), 2)
+
+            # and a token cannot take it all
+            counters = myownmocker.FileCounters(os.path.join(tmpdir, 'limited'), slots=64, max_per_token=3)
+            for name in ('a', 'b', 'c'):
+                counters.incr('t1', name)
+            self.assertRaises(myownmocker.CounterLimitError, counters.incr, 't1', 'd')
+            self.assertEqual(counters.incr('t1', 'a'), 2)
+            self.assertEqual(counters.incr('t2', 'd'), 1)
+            counters.reset('t1', 'a')
+            self.assertEqual(counters.incr('t1', 'd'), 1)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def _upstream(self):
+        """A local stand-in for a real API, returns the server and the (method, path, client port) it was sent"""
+        import BaseHTTPServer
+        import SocketServer
+        import threading
+        import time
+        calls = []
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def respond(self):
+                calls.append((self.command, self.path, self.client_address[1]))
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                status_code, content_type = 200, 'application/json'
+                if self.path.startswith('/api/slow'):
+                    time.sleep(0.3)
+                elif self.path.startswith('/api/binary'):
+                    body, content_type = '\x89PNG\xff', 'image/png'
+                elif self.path.startswith('/api/error'):
+                    status_code = 500
+                if not body:
+                    body = json.dumps(dict(path=self.path, auth=self.headers.get('Authorization')))
+                self.send_response(status_code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('X-Upstream', 'yes')
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = respond
+
+            def log_message(self, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            # keep-alive connections hold a thread each
+            daemon_threads = True
+
+        server = Server(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server, calls
+
+    def _allow_proxy(self, allow_private=True):
+        myownmocker.app.config['MOCK_PROXY'] = True
+        myownmocker.upstream_pool = myownmocker.UpstreamPool(allow_private=allow_private)
+
+    def _disallow_proxy(self):
+        myownmocker.upstream_pool.close()
+        myownmocker.app.config['MOCK_PROXY'] = False
+        myownmocker.upstream_pool = myownmocker.make_upstream_pool(myownmocker.app.config)
+
+    def test_proxy(self):
+        _, token = self._register()
+        server, calls = self._upstream()
+        try:
+            upstream = 'http://127.0.0.1:%d/api' % server.server_port
+
+            def setup_proxy(token, data):
+                return self.app.post('/setup/%s/proxy' % token, content_type='application/json', data=json.dumps(data))
+
+            res = setup_proxy(token, {'upstream': upstream})
+            self.assertEqual(res.status_code, 403)
+            self.assertEqual(json.loads(res.data)['message'], 'Proxying is disabled on this server')
+            self._allow_proxy(allow_private=False)
+            res = setup_proxy(token, {'upstream': upstream})
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(json.loads(res.data)['message'], 'Upstream address not allowed: 127.0.0.1')
+            self._allow_proxy()
+
+            self.assertEqual(setup_proxy('invalidToken', {'upstream': upstream}).status_code, 404)
+            self.assertEqual(setup_proxy(token, {}).status_code, 400)
+            self.assertEqual(json.loads(setup_proxy(token, {'upstream': 'ftp://x/'}).data)['message'], 'Invalid upstream')
+            self.assertEqual(self.app.get('/mock/%s/users/1' % token).status_code, 404)
+            self.assertEqual(json.loads(setup_proxy(token, {'upstream': upstream}).data), {'message': 'ok'})
+
+            for _ in range(2):
+                res = self.app.get('/mock/%s/users/1?q=1' % token, headers={'Authorization': 'secret'})
+                self.assertEqual(res.status_code, 200)
+                self.assertEqual(json.loads(res.data), {'path': '/api/users/1?q=1', 'auth': 'secret'})
+                self.assertEqual(res.headers['X-Upstream'], 'yes')
+            res = self.app.get('/mock/%s/binary' % token)
+            self.assertEqual((res.content_type, res.data), ('image/png', '\x89PNG\xff'))
+            # errors and other methods are forwarded every time, not recorded
+            for _ in range(2):
+                self.assertEqual(self.app.get('/mock/%s/error' % token).status_code, 500)
+                res = self.app.post('/mock/%s/users/' % token, data='{"name": "mom"}')
+                self.assertEqual(json.loads(res.data), {'name': 'mom'})
+            self.assertEqual([call[:2] for call in calls], [
+                ('GET', '/api/users/1?q=1'), ('GET', '/api/binary'),
+                ('GET', '/api/error'), ('POST', '/api/users/'), ('GET', '/api/error'), ('POST', '/api/users/'),
+            ])
+            # one keep-alive connection
+            self.assertEqual(len(set(call[2] for call in calls)), 1)
+
+            self.assertEqual(myownmocker.path_recorder.flush(), 2)
+            myownmocker.response_cache.clear()
+            self.assertEqual(self.app.get('/mock/%s/binary' % token).data, '\x89PNG\xff')
+            exported = dict(
+                (d['path'], d) for d in map(json.loads, self.app.get('/setup/%s/export' % token).data.splitlines())
+            )
+            self.assertEqual(sorted(exported), ['binary', 'users/1'])
+            self.assertEqual(exported['users/1']['custom_headers']['X-Upstream'], 'yes')
+            self.assertNotIn('Content-Length', exported['users/1']['custom_headers'])
+            self.assertEqual(len(calls), 6)
+
+            # paths set up before the recording is saved win
+            self.app.get('/mock/%s/later' % token)
+            self._setup(token, 'later', 200, 'text/plain', body='mine')
+            self.assertEqual(myownmocker.path_recorder.flush(), 0)
+            self.assertEqual(self.app.get('/mock/%s/later' % token).data, 'mine')
+
+            setup_proxy(token, {'upstream': 'http://127.0.0.1:1/'})
+            res = self.app.get('/mock/%s/down' % token)
+            self.assertEqual(res.status_code, 502)
+            self.assertIn('Upstream failed', json.loads(res.data)['message'])
+            # checked again when connecting, and a disabled proxy is ignored
+            setup_proxy(token, {'upstream': upstream})
+            myownmocker.upstream_pool = myownmocker.UpstreamPool()
+            res = self.app.get('/mock/%s/elsewhere' % token)
+            self.assertEqual(res.status_code, 403)
+            self.assertEqual(json.loads(res.data)['message'], 'Upstream address not allowed: 127.0.0.1')
+            myownmocker.app.config['MOCK_PROXY'] = False
+            self.assertEqual(self.app.get('/mock/%s/elsewhere' % token).status_code, 404)
+            self._allow_proxy()
+            setup_proxy(token, {'upstream': None})
+            self.assertEqual(self.app.get('/mock/%s/down' % token).status_code, 404)
+        finally:
+            self._disallow_proxy()
+            server.shutdown()
+            server.server_close()
+
+    def test_proxy_single_flight(self):
+        import threading
+        tmpdir = tempfile.mkdtemp()
+        myownmocker.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///%s' % os.path.join(tmpdir, 'mom.db')
+        self.db.create_all()
+        server, calls = self._upstream()
+        results = []
+
+        def worker():
+            res = myownmocker.app.test_client().get('/mock/%s/slow' % token)
+            results.append((res.status_code, res.data))
+
+        self._allow_proxy()
+        try:
+            _, token = self._register()
+            self.app.post('/setup/%s/proxy' % token, content_type='application/json', data=json.dumps(dict(
+                upstream='http://127.0.0.1:%d/api/' % server.server_port,
+            )))
+            threads = [threading.Thread(target=worker) for _ in xrange(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(set(results), set([(200, json.dumps(dict(path='/api/slow', auth=None)))]))
+        finally:
+            self._disallow_proxy()
+            server.shutdown()
+            server.server_close()
+            self.db.session.remove()
+            self.db.drop_all()
+            myownmocker.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+            shutil.rmtree(tmpdir)
+
+    def test_private_addresses(self):
+        for address in ('127.0.0.1', '10.1.2.3', '172.31.0.1', '192.168.0.1', '169.254.169.254', '0.0.0.0', '::1',
+                        '::ffff:127.0.0.1', 'fe80::1%eth0', 'fd00::1'):
+            self.assertTrue(myownmocker.is_private_address(address), address)
+        for address in ('8.8.8.8', '172.32.0.1', '2001:4860:4860::8888'):
+            self.assertFalse(myownmocker.is_private_address(address), address)
+
+    def test_chaos_delays(self):
+        for delay, low, high in (
+            ({'uniform': [100, 200]}, 0.1, 0.2),
+            ({'normal': [100, 10]}, 0, 1),
+            ({'percentiles': {'50': 100, '99': 1000}}, 0, 1),
+        ):
+            chaos = myownmocker.Chaos.from_dict({'delay': delay})
+            for _ in xrange(100):
+                self.assertTrue(low <= chaos.delay() <= high)
+
+    def test_setup_requests(self):
+        token = self.test_path()
+        self.app.get('/mock/%s/value' % token)
+        self.assertEqual(myownmocker.recorder.flush(), 0)
+
+        myownmocker.app.config['MOCK_RECORD_REQUESTS'] = True
+        recorder_limit = myownmocker.recorder.limit
+        try:
+            self.app.post('/mock/%s/value?a=1' % token, data='hello', headers={'X-Client': 'test'})
+            self.app.get('/mock/%s/missing' % token)
+            self.assertEqual(myownmocker.recorder.flush(), 2)
+
+            res = self.app.get('/setup/%s/requests' % token)
+            self.assertEqual(res.status_code, 200)
+            j = json.loads(res.data)
+            self.assertEqual(j['dropped'], 0)
+            first, second = j['requests']
+            self.assertEqual(j['cursor'], second['id'])
+            self.assertEqual((first['method'], first['path'], first['query']), ('POST', 'value', 'a=1'))
+            self.assertEqual((first['body'], first['matched'], first['status_code']), ('hello', 'value', 202))
+            self.assertEqual(first['headers']['X-Client'], 'test')
+            self.assertEqual((second['matched'], second['status_code']), (None, 404))
+            # unknown tokens are not recorded
+            self.assertEqual(self.app.get('/mock/invalidToken/value').status_code, 404)
+            self.assertEqual(myownmocker.recorder.flush(), 0)
+
+            res = self.app.get('/setup/%s/requests?cursor=%d' % (token, j['cursor']))
+            j = json.loads(res.data)
+            self.assertEqual((j['requests'], j['cursor']), ([], second['id']))
+
+            # only the last ones are kept
+            myownmocker.recorder.limit = 3
+            for i in xrange(3):
+                self.app.get('/mock/%s/value?i=%d' % (token, i))
+            myownmocker.recorder.flush()
+            res = self.app.get('/setup/%s/requests?limit=2' % token)
+            j = json.loads(res.data)
+            self.assertEqual(j['dropped'], 2)
+            self.assertEqual([r['query'] for r in j['requests']], ['i=0', 'i=1'])
+        finally:
+            myownmocker.app.config['MOCK_RECORD_REQUESTS'] = False
+            myownmocker.recorder.limit = recorder_limit
+
+        res = self.app.get('/setup/invalidToken/requests')
+        self.assertEqual(res.status_code, 404)
+
+    def test_request_recorder_purged_token(self):
+        from sqlalchemy.exc import IntegrityError
+        _, token = self._register()
+        recorder = myownmocker.RequestRecorder(interval=None)
+        recorder.record(dict(token_id=token, method='GET', path='a'))
+        recorder.record(dict(token_id='purgedToken00000', method='GET', path='a'))
+        insert = self.db.session.bulk_insert_mappings
+        calls = []
+
+        def bulk_insert_mappings(model, mappings):
+            # SQLite does not enforce the foreign key, as other databases do
+            calls.append(mappings)
+            if any(entry['token_id'] == 'purgedToken00000' for entry in mappings):
+                raise IntegrityError('INSERT', {}, Exception('foreign key'))
+            insert(model, mappings)
+
+        self.db.session.bulk_insert_mappings = bulk_insert_mappings
+        try:
+            self.assertEqual(recorder.flush(), 1)
+        finally:
+            del self.db.session.bulk_insert_mappings
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(
+            [r.token_id for r in self.db.session.query(myownmocker.MockRequest)], [token],
+        )
+
+    def test_request_recorder_full(self):
+        _, token = self._register()
+        recorder = myownmocker.RequestRecorder(queue_size=1, interval=None)
+        recorder.record(dict(token_id=token, method='GET', path='a'))
+        recorder.record(dict(token_id=token, method='GET', path='b'))
+        self.assertEqual(recorder.flush(), 1)
+        self.assertEqual(self.db.session.query(myownmocker.MockToken).get(token).requests_dropped, 1)
+
+    def test_background_writer(self):
+        import threading
+        flushed = threading.Event()
+
+        class Writer(myownmocker.BackgroundWriter):
+            def flush(self):
+                if threading.current_thread().name == 'Writer':
+                    flushed.set()
+                    # park the thread, one waking up while the interpreter exits prints errors
+                    threading.Event().wait()
+
+        writer = Writer(interval=0.01)
+        writer.start()
+        thread_pid = writer._pid
+        writer.start()
+        self.assertTrue(flushed.wait(5))
+        self.assertEqual(thread_pid, os.getpid())
+        self.assertEqual(len([t for t in threading.enumerate() if t.name == 'Writer']), 1)
+
+        expiry = myownmocker.TokenExpiry(interval=0.01)
+        expiry.start()
+        self.assertIsNone(expiry._pid)
+
+    def test_metrics(self):
+        token = self.test_path()
+        self.app.get('/mock/%s/value' % token)
+        self.app.get('/mock/%s/value' % token)
+
+        res = self.app.get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Type'], 'text/plain; version=0.0.4')
+        lines = dict(line.rsplit(' ', 1) for line in res.data.splitlines() if not line.startswith('#'))
+        self.assertEqual(float(lines['mom_requests_total{route="use_api"}']), 3)
+        self.assertEqual(float(lines['mom_request_duration_seconds_bucket{route="use_api",le="+Inf"}']), 3)
+        self.assertEqual(float(lines['mom_requests_total{route="register"}']), 1)
+        self.assertGreater(float(lines['mom_db_queries_total{route="setup"}']), 0)
+        self.assertEqual(lines['mom_rows{table="mock_path"}'], '1')
+        self.assertGreaterEqual(float(lines['mom_cache_hits_total{cache="response"}']), 2)
+        # every endpoint of the app is reported on its own
+        self.assertEqual(float(lines['mom_requests_total{route="metrics_endpoint"}']), 0)
+        self.assertEqual(float(lines['mom_requests_total{route="other"}']), 0)
+
+    def test_metrics_processes(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            routes = ['register', 'use_api']
+            worker1 = myownmocker.Metrics(tmpdir, routes)
+            worker1.observe('use_api', 0.002, 1)
+            # another worker's file, filled through an in-memory instance
+            worker2 = myownmocker.Metrics(None, routes)
+            worker2.observe('use_api', 0.2, 0)
+            worker2.observe('unknown', 20, 0)
+            with open(os.path.join(tmpdir, 'metrics-%d-%d.bin' % (worker2.size, os.getppid())), 'wb') as f:
+                f.write(worker2._values())
+            # and one left by a worker that is gone
+            dead = subprocess.Popen(['true'])
+            dead.wait()
+            dead_file = os.path.join(tmpdir, 'metrics-%d-%d.bin' % (worker2.size, dead.pid))
+            with open(dead_file, 'wb') as f:
+                f.write(worker2._values())
+            text = worker1.render()
+            self.assertIn('mom_requests_total{route="use_api"} 2.0', text)
+            self.assertIn('mom_requests_total{route="other"} 1.0', text)
+            self.assertIn('mom_request_duration_seconds_bucket{route="use_api",le="0.0025"} 1.0', text)
+            self.assertIn('mom_request_duration_seconds_bucket{route="use_api",le="0.25"} 2.0', text)
+            self.assertIn('mom_db_queries_total{route="use_api"} 1.0', text)
+            self.assertFalse(os.path.exists(dead_file))
+
+            worker1.close()
+            self.assertEqual(len(os.listdir(tmpdir)), 1)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_rate_limiter(self):
+        try:
+            from mock import patch
+        except ImportError:
+            self.skipTest('requires mock, run: pip install mock')
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'limits')
+            # two processes' views of the same limits
+            worker1 = myownmocker.RateLimiter(filename, slots=64)
+            worker2 = myownmocker.RateLimiter(filename, slots=64)
+            with patch('myownmocker.time.time', return_value=1000.0) as now:
+                self.assertEqual(worker1.hit('a', 2, 10), 0)
+                self.assertEqual(worker2.hit('a', 2, 10), 0)
+                self.assertEqual(worker1.hit('a', 2, 10), 5.0)
+                self.assertEqual(worker1.hit('b', 2, 10, cost=2), 0)
+                now.return_value = 1005.0
+                self.assertEqual(worker2.hit('a', 2, 10), 0)
+                self.assertEqual(worker1.hit('a', 2, 10), 5.0)
+                self.assertEqual(worker1.hit('a', 2, 10, cost=3), 15.0)
+                now.return_value = 2000.0
+                self.assertEqual(worker1.hit('a', 2, 10, cost=2), 0)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_rate_limits(self):
+        config = myownmocker.app.config
+        old_config = dict((name, config[name]) for name in (
+            'MOCK_RATE_REGISTER', 'MOCK_RATE_SETUP', 'MOCK_RATE_MOCK', 'MOCK_MAX_PATHS', 'MOCK_TRUSTED_PROXIES',
+        ))
+        config.update(MOCK_RATE_REGISTER=(3, 60), MOCK_RATE_MOCK=(2, 60), MOCK_MAX_PATHS=2, MOCK_TRUSTED_PROXIES=1)
+        try:
+            _, token = self._register()
+            self.assertEqual(self.app.get('/register/?count=2').status_code, 200)
+            res = self.app.get('/register/?count=4')
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(json.loads(res.data)['message'], 'count must be between 1 and 3')
+            res = self.app.get('/register/')
+            self.assertEqual(res.status_code, 429)
+            self.assertEqual(res.headers['Retry-After'], '20')
+            self.assertEqual(json.loads(res.data)['message'], 'Rate limit exceeded (3 per 60s), retry in 20s')
+            # limited per client, behind one proxy
+            headers = {'X-Forwarded-For': '10.0.0.1, 10.0.0.2'}
+            self.assertEqual(self.app.get('/register/?count=3', headers=headers).status_code, 200)
+            self.assertEqual(self.app.get('/register/', headers=headers).status_code, 429)
+            self.assertEqual(self.app.get('/register/', headers={'X-Forwarded-For': '10.0.0.1'}).status_code, 200)
+
+            self.assertEqual(self._setup(token, 'a', 200, 'text/plain').status_code, 200)
+            self.assertEqual(self._setup(token, 'b', 200, 'text/plain').status_code, 200)
+            res = self._setup(token, 'c', 200, 'text/plain')
+            self.assertEqual(res.status_code, 429)
+            self.assertEqual(json.loads(res.data)['message'], 'Too many paths, the limit is 2 per token')
+            self.assertEqual(self._setup(token, 'a', 201, 'text/plain').status_code, 200)
+            res = self.app.post('/setup/%s/bulk/' % token, content_type='application/json', data=json.dumps([
+                {'path': 'a', 'status_code': 200, 'content_type': 'text/plain'},
+                {'path': 'c', 'status_code': 200, 'content_type': 'text/plain'},
+            ]))
+            self.assertEqual(res.status_code, 429)
+            res = self.app.post('/setup/%s/import' % token, content_type='application/x-ndjson', data=json.dumps(
+                {'path': 'c', 'status_code': 200, 'content_type': 'text/plain'},
+            ))
+            self.assertEqual(res.status_code, 429)
+
+            self.assertEqual(self.app.get('/mock/%s/a' % token).status_code, 201)
+            self.assertEqual(self.app.get('/mock/%s/b' % token).status_code, 200)
+            res = self.app.get('/mock/%s/a' % token)
+            self.assertEqual(res.status_code, 429)
+            self.assertEqual(res.headers['Retry-After'], '30')
+            self.assertEqual(self.app.get('/mock/invalidToken/a').status_code, 404)
+        finally:
+            config.update(old_config)
+
+    def test_create_app(self):
+        _, token = self._register()
+        for path in ('a', 'b', 'c', 'pattern/{id}'):
+            self._setup(token, path, 200, 'text/plain', body=path)
+        cache_size = myownmocker.app.config['MOCK_CACHE_SIZE']
+        tmpdir = tempfile.mkdtemp()
+        try:
+            config = os.path.join(tmpdir, 'mom.cfg')
+            with open(config, 'w') as f:
+                f.write('MOCK_CACHE_SIZE = 5\n')
+            self.assertIs(myownmocker.create_app(config), myownmocker.app)
+            # built on first use
+            self.assertIsInstance(vars(myownmocker)['response_cache'], myownmocker.LazyGlobal)
+            self.assertEqual(myownmocker.response_cache.max_size, 5)
+            self.assertIsInstance(vars(myownmocker)['response_cache'], myownmocker.ResponseCache)
+            self.assertIsInstance(vars(myownmocker)['rate_limiter'], myownmocker.LazyGlobal)
+            self.assertEqual(myownmocker.warm_up(), 3)
+            self.assertEqual(myownmocker.response_cache.get(token, 'b').default.body, 'b')
+            self.assertIsNone(myownmocker.response_cache.get(token, 'pattern/{id}'))
+
+            myownmocker.create_app({'MOCK_CACHE_SIZE': 2})
+            self.assertEqual(myownmocker.response_cache.max_size, 2)
+            self.assertEqual(myownmocker.warm_up(), 2)
+        finally:
+            myownmocker.create_app({'MOCK_CACHE_SIZE': cache_size})
+            shutil.rmtree(tmpdir)
+
+    def test_connection_after_fork(self):
+        import sqlalchemy
+        from sqlalchemy.pool import QueuePool
+        tmpdir = tempfile.mkdtemp()
+        try:
+            engine = sqlalchemy.create_engine('sqlite:///%s' % os.path.join(tmpdir, 'mom.db'), poolclass=QueuePool)
+            conn = engine.raw_connection()
+            inherited = conn.connection
+            conn.close()
+            conn = engine.raw_connection()
+            self.assertIs(conn.connection, inherited)
+            # as if opened by the parent of a forked worker
+            conn._connection_record.info['pid'] = -1
+            conn.close()
+            conn = engine.raw_connection()
+            self.assertIsNot(conn.connection, inherited)
+            conn.close()
+            # and left open for the parent
+            self.assertEqual(inherited.execute('SELECT 1').fetchall(), [(1,)])
+            engine.dispose()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_pool_pre_ping(self):
+        import sqlalchemy
+        from sqlalchemy.engine.url import make_url
+        from sqlalchemy.pool import QueuePool
+        tmpdir = tempfile.mkdtemp()
+        myownmocker.app.config['MOCK_POOL_PRE_PING'] = True
+        try:
+            info = make_url('sqlite:///%s' % os.path.join(tmpdir, 'mom.db'))
+            options = dict(poolclass=QueuePool, pool_reset_on_return=None)
+            myownmocker.db.apply_driver_hacks(myownmocker.app, info, options)
+            self.assertTrue(options['pool_pre_ping'])
+            engine = sqlalchemy.create_engine(info, **options)
+            conn = engine.raw_connection()
+            dropped = conn.connection
+            # as if the database closed it while idle in the pool
+            dropped.close()
+            conn.close()
+            conn = engine.raw_connection()
+            self.assertIsNot(conn.connection, dropped)
+            self.assertEqual(conn.cursor().execute('SELECT 1').fetchall(), [(1,)])
+            conn.close()
+            engine.dispose()
+        finally:
+            myownmocker.app.config['MOCK_POOL_PRE_PING'] = False
+            shutil.rmtree(tmpdir)
+
+    def test_read_replica(self):
+        config = myownmocker.app.config
+        old_config = dict((name, config[name]) for name in (
+            'SQLALCHEMY_DATABASE_URI', 'SQLALCHEMY_BINDS', 'SQLALCHEMY_POOL_SIZE', 'MOCK_REPLICA_CACHE_TTL',
+        ))
+        tmpdir = tempfile.mkdtemp()
+        primary = os.path.join(tmpdir, 'primary.db')
+        replica = os.path.join(tmpdir, 'replica.db')
+
+        def replicate():
+            myownmocker.replica_session.remove()
+            self.db.get_engine(myownmocker.app, 'replica').dispose()
+            shutil.copyfile(primary, replica)
+
+        self.db.session.remove()
+        try:
+            myownmocker.create_app({
+                'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + primary,
+                'SQLALCHEMY_BINDS': {'replica': 'sqlite:///' + replica},
+                'SQLALCHEMY_POOL_SIZE': 2,
+            })
+            self.db.create_all()
+            replicate()
+            self.assertIsNotNone(myownmocker.replica_storage)
+
+            _, token = self._register()
+            self._setup(token, 'a', 200, 'text/plain', body='first')
+            # writes only go to the primary, lookups fall back to it until replicated
+            self.assertIsNone(myownmocker.replica_storage.get_path(token, 'a'))
+            self.assertEqual(self.app.get('/mock/%s/a' % token).data, 'first')
+            replicate()
+            self.assertEqual(myownmocker.replica_storage.get_path(token, 'a').body, 'first')
+
+            self._setup(token, 'a', 200, 'text/plain', body='second')
+            # served as the replica has it, until the cache entry expires
+            self.assertEqual(self.app.get('/mock/%s/a' % token).data, 'first')
+            self.assertEqual(self.app.get('/mock/%s/a' % token).data, 'first')
+            replicate()
+            self.assertEqual(self.app.get('/mock/%s/a' % token).data, 'first')
+            myownmocker.response_cache.invalidate(token, 'a')
+            self.assertEqual(self.app.get('/mock/%s/a' % token).data, 'second')
+
+            config['MOCK_REPLICA_CACHE_TTL'] = 0
+            self._setup(token, 'a', 200, 'text/plain', body='third')
+            self.assertEqual(self.app.get('/mock/%s/a' % token).data, 'second')
+            replicate()
+            self.assertEqual(self.app.get('/mock/%s/a' % token).data, 'third')
+
+            res = self.app.get('/metrics')
+            self.assertIn('mom_db_pool_size{database="primary"} 2', res.data)
+            self.assertIn('mom_db_pool_size{database="replica"} 2', res.data)
+            self.assertIn('mom_db_pool_checked_out{database="primary"} ', res.data)
+        finally:
+            self.db.session.remove()
+            myownmocker.replica_session.remove()
+            for bind in (None, 'replica'):
+                self.db.get_engine(myownmocker.app, bind).dispose()
+            myownmocker.create_app(old_config)
+            self.db.create_all()
+            shutil.rmtree(tmpdir)
+
+    def test_pattern_index(self):
+        index = myownmocker.PatternIndex([
+            'user/{id}/details/',
+            'user/{name}/friends/{friend}',
+            'user/me/details/',
+            'files/*',
+            'files/{name}/meta',
+            '*/health',
+        ])
+        self.assertEqual(index.match('user/1/details/'), ('user/{id}/details/', {'id': '1'}))
+        self.assertEqual(index.match('user/me/details/'), ('user/me/details/', {}))
+        self.assertEqual(index.match('user/a/friends/b'), ('user/{name}/friends/{friend}', {'name': 'a', 'friend': 'b'}))
+        self.assertEqual(index.match('files/a/meta'), ('files/{name}/meta', {'name': 'a'}))
+        self.assertEqual(index.match('files/a/b/meta'), ('files/*', {'*': 'a/b/meta'}))
+        self.assertEqual(index.match('api/health'), ('*/health', {'*': 'api'}))
+        self.assertEqual(index.match('user/1/details'), (None, None))
+        self.assertEqual(index.match('files'), (None, None))
+
     def test_path_resetup(self):
         token = self.test_path()
 
@@ -213,6 +1472,114 @@ class MOMTestCase(unittest.TestCase):
         self.assertEqual(res.data, 'test2')
         return token
 
+    def test_path_cached(self):
+        token = self.test_path()
+        cache = myownmocker.response_cache
+        hits = cache.stats()['hits']
+
+        # a hit does not touch the database
+        query = self.db.session.query
+        try:
+            self.db.session.query = None
+            res = self.app.get('/mock/%s/value' % token)
+        finally:
+            self.db.session.query = query
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(res.headers['X-My-Header'], '123')
+        self.assertEqual(res.data, 'test')
+        self.assertEqual(cache.stats()['hits'], hits + 1)
+
+    def test_path_cache_purged(self):
+        import datetime
+
+        token = self.test_path()
+        self.assertIsNotNone(myownmocker.response_cache.get(token, 'value'))
+        t = self.db.session.query(myownmocker.MockToken).filter(myownmocker.MockToken.token == token).first()
+        t.created_on -= datetime.timedelta(days=2)
+        self.assertEqual(myownmocker.purge_tokens(), 1)
+        self.assertIsNone(myownmocker.response_cache.get(token, 'value'))
+
+    def test_response_cache_lru(self):
+        cache = myownmocker.ResponseCache(max_size=2)
+        cache.put('t1', 'a', 1)
+        cache.put('t1', 'b', 2)
+        self.assertEqual(cache.get('t1', 'a'), 1)
+        cache.put('t2', 'c', 3)
+        # 'b' was the least recently used
+        self.assertIsNone(cache.get('t1', 'b'))
+        self.assertEqual(cache.get('t2', 'c'), 3)
+        cache.invalidate('t1')
+        self.assertIsNone(cache.get('t1', 'a'))
+        self.assertEqual(cache.stats(), dict(size=1, max_size=2, hits=2, misses=2, evictions=1))
+
+        cache = myownmocker.ResponseCache(max_size=0)
+        cache.put('t1', 'a', 1)
+        self.assertIsNone(cache.get('t1', 'a'))
+
+    def test_response_cache_channel(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = '%s/versions' % tmpdir
+            # two workers sharing the same version file
+            cache1 = myownmocker.ResponseCache(channel=myownmocker.FileChannel(filename, slots=16))
+            cache2 = myownmocker.ResponseCache(channel=myownmocker.FileChannel(filename, slots=16), max_stale=60)
+            cache1.put('t1', 'a', 1)
+            cache2.put('t1', 'a', 1)
+            cache1.put('t1', 'b', 2)
+
+            cache2.invalidate('t1', 'a')
+            self.assertIsNone(cache1.get('t1', 'a'))
+
+            # cache2 keeps serving its copy until max_stale runs out
+            cache2.put('t1', 'b', 2)
+            cache1.invalidate('t1')
+            self.assertIsNone(cache1.get('t1', 'b'))
+            self.assertEqual(cache2.get('t1', 'b'), 2)
+            cache2.max_stale = 0
+            self.assertIsNone(cache2.get('t1', 'b'))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_migrate_headers(self):
+        token = self.test_path()
+        # back to the old layout, one mock_header row per header
+        pt = self.db.session.query(myownmocker.MockPath).filter_by(token_id=token).first()
+        self.db.session.add(myownmocker.MockHeader(pt.id, 'X-Old-Header', 'old'))
+        pt.headers_json = None
+        self.db.session.commit()
+        myownmocker.response_cache.clear()
+
+        res = self.app.get('/mock/%s/value' % token)
+        self.assertEqual(res.headers['X-Old-Header'], 'old')
+
+        self.assertEqual(myownmocker.migrate_headers(), 1)
+        self.assertEqual(self.db.session.query(myownmocker.MockHeader).count(), 0)
+        self.assertEqual(myownmocker.migrate_headers(), 0)
+        myownmocker.response_cache.clear()
+
+        res = self.app.get('/mock/%s/value' % token)
+        self.assertEqual(res.headers['X-Old-Header'], 'old')
+        self.assertNotIn('X-My-Header', res.headers)
+
+    def test_missing_columns(self):
+        self.assertEqual(myownmocker.missing_columns(), [])
+        # a mock_path table from before headers_json and the columns after it
+        self.db.session.execute('DROP TABLE mock_header')
+        self.db.session.execute('DROP TABLE mock_path')
+        self.db.session.execute(
+            'CREATE TABLE mock_path (id INTEGER PRIMARY KEY, token_id VARCHAR(16) NOT NULL, path VARCHAR(200) NOT NULL,'
+            ' status_code INTEGER NOT NULL, content_type VARCHAR(100) NOT NULL, body VARCHAR(500))'
+        )
+        self.db.session.commit()
+        missing = myownmocker.missing_columns()
+        self.assertIn('mock_path.headers_json', missing)
+        self.assertIn('mock_header.value', missing)
+        self.assertNotIn('mock_path.body', missing)
+
+        self.assertEqual(myownmocker.migrate_db(), 0)
+        self.assertEqual(myownmocker.missing_columns(), [])
+        self.test_path()
+
     def test_error_500(self):  # for coverage...
         # disable TESTING so the test app processes all exceptions as normal
         myownmocker.app.config['TESTING'] = False
@@ -221,12 +1588,12 @@ class MOMTestCase(unittest.TestCase):
         except ImportError:
             self.skipTest('requires mock, run: pip install mock')
         # screw something up to force error 500
-        with patch('random.SystemRandom', return_value=None):
+        with patch('os.urandom', side_effect=ValueError('no entropy')):
             res, _ = self._register()
             self.assertEqual(res.status_code, 500)
             self.assertEqual(res.headers['Content-Type'], 'application/json')
             j = json.loads(res.data)
-            self.assertEqual(j['message'], u"'NoneType' object has no attribute 'choice'")
+            self.assertEqual(j['message'], u'no entropy')
 
     def test_purge(self):
         import datetime
@@ -241,6 +1608,206 @@ class MOMTestCase(unittest.TestCase):
         self.assertEqual(myownmocker.purge_tokens(), 1)
         self.assertEqual(self.db.session.query(myownmocker.MockToken).count(), 1)
 
+    def test_purge_cascade(self):
+        import datetime
+        MockToken, MockPath, MockHeader, MockRequest = (
+            myownmocker.MockToken, myownmocker.MockPath, myownmocker.MockHeader, myownmocker.MockRequest,
+        )
+        tokens = [self._register()[1] for _ in xrange(3)]
+        for token in tokens:
+            self.app.post('/setup/%s/' % token, data=json.dumps(dict(
+                path='value', status_code=200, content_type='text/plain', body='v',
+            )), content_type='application/json')
+            path = self.db.session.query(MockPath).filter_by(token_id=token).one()
+            self.db.session.add(MockHeader(path.id, 'X-Legacy', '1'))
+            self.db.session.add(MockRequest(token_id=token, method='GET', path='value', headers='{}'))
+        self.db.session.query(MockToken).filter(MockToken.token.in_(tokens[:2])).update({
+            MockToken.created_on: datetime.datetime.now() - datetime.timedelta(days=3),
+        }, synchronize_session=False)
+        self.db.session.commit()
+        self.assertEqual(self.app.get('/mock/%s/value' % tokens[0]).status_code, 200)
+
+        self.assertEqual(myownmocker.purge_tokens(batch_size=1), 2)
+        for model in (MockPath, MockRequest):
+            self.assertEqual(set(token for (token,) in self.db.session.query(model.token_id)), set(tokens[2:]))
+        self.assertEqual(self.db.session.query(MockHeader).count(), 1)
+        self.assertEqual(self.app.get('/mock/%s/value' % tokens[0]).status_code, 404)
+
+    def test_purge_last_used(self):
+        import datetime
+        MockToken = myownmocker.MockToken
+        _, used = self._register()
+        _, unused = self._register()
+        self.db.session.query(MockToken).update({
+            MockToken.created_on: datetime.datetime.now() - datetime.timedelta(days=3),
+            MockToken.last_used: datetime.datetime.now() - datetime.timedelta(days=3),
+        }, synchronize_session=False)
+        self.db.session.commit()
+
+        self.app.post('/setup/%s/' % used, data=json.dumps(dict(
+            path='value', status_code=200, content_type='text/plain', body='v',
+        )), content_type='application/json')
+        # nothing to write unless expiring on last use
+        self.app.get('/mock/%s/value' % used)
+        self.assertEqual(myownmocker.expiry.flush(), 0)
+
+        myownmocker.expiry = myownmocker.TokenExpiry(interval=None, track_last_use=True)
+        self.app.get('/mock/%s/missing' % used)
+        self.assertEqual(myownmocker.expiry.flush(), 0)
+        for _ in xrange(3):
+            self.app.get('/mock/%s/value' % used)
+        # noted once, and not again until the resolution passes
+        self.assertEqual(myownmocker.expiry.flush(), 1)
+        self.app.get('/mock/%s/value' % used)
+        self.assertEqual(myownmocker.expiry.flush(), 0)
+
+        myownmocker.app.config['MOCK_EXPIRE_ON_LAST_USE'] = True
+        try:
+            self.assertEqual(myownmocker.purge_tokens(), 1)
+        finally:
+            myownmocker.app.config['MOCK_EXPIRE_ON_LAST_USE'] = False
+        self.assertEqual([token for (token,) in self.db.session.query(MockToken.token)], [used])
+
+    def test_purge_lock(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            lock_file = os.path.join(tmpdir, 'purge.lock')
+            expiry = myownmocker.TokenExpiry(interval=None, lock_file=lock_file)
+            self.assertTrue(expiry.acquire())
+            self.assertTrue(expiry.acquire())
+            # another worker does not purge while this one holds the lock
+            pid = os.fork()
+            if pid == 0:
+                os._exit(0 if expiry.acquire() else 1)
+            self.assertEqual(os.waitpid(pid, 0)[1] >> 8, 1)
+            self.assertTrue(myownmocker.TokenExpiry(interval=None).acquire())
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class MemoryStorageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        myownmocker.app.config['TESTING'] = True
+        self.app = myownmocker.app.test_client()
+        self.tmpdir = tempfile.mkdtemp()
+        self.channel = myownmocker.FileChannel(os.path.join(self.tmpdir, 'versions'))
+        self.sql_storage = myownmocker.storage
+        myownmocker.storage = myownmocker.MemoryStorage()
+        myownmocker.response_cache.clear()
+        myownmocker.pattern_cache.clear()
+        myownmocker.expiry = myownmocker.TokenExpiry(interval=None)
+        myownmocker.counters = myownmocker.LocalCounters()
+        myownmocker.rate_limiter = myownmocker.RateLimiter()
+
+    def tearDown(self):
+        myownmocker.storage = self.sql_storage
+        myownmocker.response_cache.clear()
+        myownmocker.pattern_cache.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def _setup(self, token, **data):
+        return self.app.post('/setup/%s/' % token, data=json.dumps(data), content_type='application/json')
+
+    def test_metrics(self):
+        token = json.loads(self.app.get('/register/').data)['token']
+        self._setup(token, path='a', status_code=200, content_type='text/plain', body='a')
+        res = self.app.get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('mom_rows{table="mock_token"} 1\n', res.data)
+        self.assertIn('mom_rows{table="mock_path"} 1\n', res.data)
+        self.assertIn('mom_rows{table="mock_request"} 0\n', res.data)
+
+    def test_endpoints(self):
+        token = json.loads(self.app.get('/register/').data)['token']
+        self.assertEqual(self._setup('invalidToken', path='a').status_code, 404)
+        res = self._setup(token, path='users/{id}', status_code=200, content_type='text/plain', body='user',
+                          custom_headers={'X-Mock': 'yes'})
+        self.assertEqual(res.status_code, 200)
+        self._setup(token, path='users/me', status_code=200, content_type='text/plain', body='me')
+
+        res = self.app.get('/mock/%s/users/42' % token)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data, 'user')
+        self.assertEqual(res.headers['X-Mock'], 'yes')
+        self.assertEqual(self.app.get('/mock/%s/users/me' % token).data, 'me')
+        self.assertEqual(self.app.get('/mock/%s/other' % token).status_code, 404)
+
+        res = self._setup(token, path='users/me', status_code=201, content_type='text/plain', body='again')
+        self.assertEqual(self.app.get('/mock/%s/users/me' % token).status_code, 201)
+
+        exported = self.app.get('/setup/%s/export' % token).data.splitlines()
+        self.assertEqual([json.loads(line)['path'] for line in exported], ['users/{id}', 'users/me'])
+        res = self.app.post('/setup/%s/import?replace=1' % token, data=exported[1],
+                            content_type='application/x-ndjson')
+        self.assertEqual(json.loads(res.data)['imported'], 1)
+        self.assertEqual(self.app.get('/mock/%s/users/42' % token).status_code, 404)
+
+        myownmocker.storage._tokens[token].created_on -= myownmocker.datetime.timedelta(days=3)
+        with myownmocker.app.app_context():
+            self.assertEqual(myownmocker.purge_tokens(), 1)
+        self.assertEqual(self.app.get('/mock/%s/users/me' % token).status_code, 404)
+
+    def test_requests(self):
+        token = json.loads(self.app.get('/register/').data)['token']
+        self._setup(token, path='a', status_code=200, content_type='text/plain', body='a')
+        myownmocker.app.config['MOCK_RECORD_REQUESTS'] = True
+        recorder = myownmocker.recorder
+        recorder_limit, recorder.limit = recorder.limit, 2
+        try:
+            for i in range(3):
+                self.app.get('/mock/%s/a?i=%d' % (token, i))
+            self.app.get('/mock/invalidToken/a')
+            self.assertEqual(recorder.flush(), 3)
+        finally:
+            myownmocker.app.config['MOCK_RECORD_REQUESTS'] = False
+            recorder.limit = recorder_limit
+        j = json.loads(self.app.get('/setup/%s/requests' % token).data)
+        self.assertEqual(j['dropped'], 1)
+        self.assertEqual([(r['id'], r['query']) for r in j['requests']], [(2, 'i=1'), (3, 'i=2')])
+        j = json.loads(self.app.get('/setup/%s/requests?cursor=2' % token).data)
+        self.assertEqual((j['cursor'], [r['query'] for r in j['requests']]), (3, ['i=2']))
+
+    def test_rollback(self):
+        storage = myownmocker.storage
+        self.assertTrue(storage.add_tokens(['token1']))
+        self.assertFalse(storage.add_tokens(['token2', 'token1']))
+        self.assertFalse(storage.has_token('token2'))
+        storage.save_paths('token1', [dict(path='a', status_code=200)])
+        storage.rollback()
+        storage.commit()
+        self.assertIsNone(storage.get_path('token1', 'a'))
+
+    def test_shared_directory(self):
+        directory = os.path.join(self.tmpdir, 'storage')
+        worker1 = myownmocker.MemoryStorage(directory, self.channel)
+        worker2 = myownmocker.MemoryStorage(directory, self.channel)
+
+        self.assertTrue(worker1.add_tokens(['token1']))
+        self.assertFalse(worker2.add_tokens(['token1']))
+        worker2.save_paths('token1', [dict(path='a', status_code=200, body='worker2', is_pattern=False)])
+        worker2.commit()
+        self.assertEqual(worker1.get_path('token1', 'a').body, 'worker2')
+        worker1.save_paths('token1', [dict(path='b/{id}', status_code=200, body='worker1', is_pattern=True)])
+        worker1.commit()
+        self.assertEqual(worker2.pattern_paths('token1'), ['b/{id}'])
+        self.assertEqual(worker2.get_path('token1', 'a').body, 'worker2')
+
+        # a new process starts from the files
+        restarted = myownmocker.MemoryStorage(directory, myownmocker.LocalChannel())
+        self.assertEqual(sorted(restarted.get_path('token1', path).id for path in ('a', 'b/{id}')), [1, 2])
+
+        # ids stay unique across tokens each process has not seen
+        self.assertTrue(worker1.add_tokens(['token2', 'token3']))
+        worker1.save_paths('token2', [dict(path='c', status_code=200, is_pattern=False)])
+        worker1.commit()
+        restarted.save_paths('token3', [dict(path='d', status_code=200, is_pattern=False)])
+        restarted.commit()
+        self.assertEqual((worker2.get_path('token2', 'c').id, worker2.get_path('token3', 'd').id), (3, 4))
+
+        worker2.delete_tokens(['token1'])
+        self.assertFalse(worker1.has_token('token1'))
+
 
 if __name__ == '__main__':
     unittest.main()